@@ -0,0 +1,87 @@
+import hashlib
+import io
+import json
+from dataclasses import dataclass
+
+import numpy
+
+from parascoring.scoring.Utils import WptDefinition, WptType, parse_wpt_file
+from parascoring.scoring.WaypointOptimizer import CompetitionIndex
+
+ARTIFACT_VERSION = 1
+ARTIFACT_NAME = 'competition.v{}.npz'.format(ARTIFACT_VERSION)
+WPT_TYPES = {wpt_type.value: wpt_type for wpt_type in WptType}
+
+
+@dataclass()
+class Competition:
+    wpt_data: dict
+    wpt_config: dict
+    index: CompetitionIndex
+    content_hash: str
+
+
+def competition_hash(wpt_bytes: bytes, wpt_config: dict) -> str:
+    """
+    Hash of a waypoint file and its config, the same whether they come from the text files or an artifact
+    """
+    digest = hashlib.sha256(wpt_bytes)
+    digest.update(json.dumps(wpt_config, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def compile_competition(wpt_file: str, wpt_config: dict) -> bytes:
+    """
+    Compile a waypoint file and config into an artifact holding the waypoint arrays and the prebuilt grid
+
+    :param wpt_file: path of the .wpt file
+    :param wpt_config: contents of competition.json
+    :return:
+    """
+    with open(wpt_file, "rb") as f:
+        wpt_bytes = f.read()
+    wpt_data = parse_wpt_file(wpt_file)
+    index = CompetitionIndex(wpt_data, wpt_config)
+    wpts = list(wpt_data.values())
+    # Grid cells of every waypoint with a wrapper, flattened with offsets
+    cell_keys = [index.grid.wrapper_cells(index.wrappers[wpt.name]) if wpt.name in index.wrappers else []
+                 for wpt in wpts]
+    buffer = io.BytesIO()
+    numpy.savez(buffer,
+                version=numpy.array(ARTIFACT_VERSION),
+                content_hash=numpy.array(competition_hash(wpt_bytes, wpt_config)),
+                config=numpy.array(json.dumps(wpt_config)),
+                name=numpy.array([wpt.name for wpt in wpts], dtype=str),
+                longitude=numpy.array([wpt.longitude for wpt in wpts], dtype=numpy.float64),
+                latitude=numpy.array([wpt.latitude for wpt in wpts], dtype=numpy.float64),
+                msl=numpy.array([wpt.msl for wpt in wpts], dtype=numpy.int32),
+                wpt_type=numpy.array([wpt.wpt_type.value for wpt in wpts], dtype=numpy.int8),
+                pts=numpy.array([wpt.pts for wpt in wpts], dtype=numpy.int32),
+                cell_offsets=numpy.cumsum([0] + [len(keys) for keys in cell_keys], dtype=numpy.int64),
+                cell_keys=numpy.array([key for keys in cell_keys for key in keys], dtype=numpy.int64))
+    return buffer.getvalue()
+
+
+def load_competition(data: bytes) -> Competition:
+    """
+    Load a compiled competition without parsing the waypoint file or rebuilding the grid
+
+    :param data: bytes written by compile_competition
+    :return:
+    """
+    with numpy.load(io.BytesIO(data), allow_pickle=False) as artifact:
+        version = int(artifact['version'])
+        if version != ARTIFACT_VERSION:
+            raise ValueError('Unsupported competition artifact version: {}'.format(version))
+        wpt_config = json.loads(str(artifact['config']))
+        offsets = artifact['cell_offsets'].tolist()
+        cell_keys = artifact['cell_keys'].tolist()
+        wpt_data = {}
+        wrapper_cells = {}
+        for i, (name, longitude, latitude, msl, wpt_type, pts) in enumerate(zip(
+                artifact['name'].tolist(), artifact['longitude'].tolist(), artifact['latitude'].tolist(),
+                artifact['msl'].tolist(), artifact['wpt_type'].tolist(), artifact['pts'].tolist())):
+            wpt_data[name] = WptDefinition(name, longitude, latitude, msl, WPT_TYPES[wpt_type], pts)
+            wrapper_cells[name] = cell_keys[offsets[i]:offsets[i + 1]]
+        content_hash = str(artifact['content_hash'])
+    return Competition(wpt_data, wpt_config, CompetitionIndex(wpt_data, wpt_config, wrapper_cells), content_hash)
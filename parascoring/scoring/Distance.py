@@ -0,0 +1,277 @@
+import math
+from typing import Optional
+
+import numpy
+
+from parascoring.scoring.Utils import get_distance_from_lat_lon_in_km, get_distances_from_lat_lon_in_km, \
+    ELLIPSOIDAL_MAX_ERROR_KM, WGS84_A, WGS84_F, WptDefinition
+
+DISTANCE_BATCH_SIZE = 256
+MAX_DISTANCE_WINDOWS = 1024
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+PROJECTION_EPSILON_KM = 0.001
+BOUNDS_SAFETY = 1.05
+# Bounds over every latitude of the WGS-84 radii of curvature and their rates of change per radian, used by
+# WptProjection.distortion: the smallest meridional radius, |d ln M / d lat|, |d ln N / d lat| and
+# |d2 ln N / d lat2|
+MIN_MERIDIONAL_KM = WGS84_A * (1 - WGS84_E2) / 1000
+MERIDIONAL_RATE = 3 * WGS84_E2 / (2 * (1 - WGS84_E2))
+PRIME_VERTICAL_RATE = WGS84_E2 / (2 * (1 - WGS84_E2))
+PRIME_VERTICAL_CURVATURE = WGS84_E2 / (1 - WGS84_E2) + WGS84_E2 ** 2 / (2 * (1 - WGS84_E2) ** 2)
+# Planar checks reaching closer to a pole, or distorting lengths more, go to the geodesic
+MAX_PLANAR_LAT = math.radians(89)
+MAX_DISTORTION = 0.5
+# Covers geodesic() and the squared comparisons rounding, both far below a micrometre
+ROUNDING_MARGIN_KM = 1e-9
+# Drift margins are cached by the distance of the fixes from the waypoint rounded up to this step
+MARGIN_REACH_STEP_KM = 0.25
+
+
+class GeodesicDistance:
+    """
+    Distance checks made by the waypoint trackers, one geodesic per call
+    """
+
+    def in_cylinder(self, igc_info, wpt: WptDefinition, cylinder_km) -> bool:
+        return cylinder_km >= get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
+                                                              wpt.latitude, wpt.longitude)
+
+    def within_drift(self, igc_info, start_igc, variance_meters) -> bool:
+        distance = get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
+                                                   start_igc.latitude, start_igc.longitude)
+        return distance * 1000 < variance_meters
+
+
+GEODESIC_DISTANCE = GeodesicDistance()
+
+
+class TrackDistance(GeodesicDistance):
+    """
+    Distance checks over a columnar track.
+
+    The engine sets index to the row being scored. The first check against a waypoint or landing start
+    runs the vectorized kernel for the next batch of fixes, later rows of that batch are a list lookup.
+    Kernel results within ELLIPSOIDAL_MAX_ERROR_KM of the limit are settled with the exact geodesic,
+    so every answer matches GeodesicDistance.
+    """
+
+    def __init__(self, track, batch_size: int = DISTANCE_BATCH_SIZE):
+        self.track = track
+        self.batch_size = batch_size
+        self.index = 0
+        # Checks answered, for ScoringMetrics
+        self.checks = 0
+        self._windows = {}
+
+    def in_cylinder(self, igc_info, wpt: WptDefinition, cylinder_km) -> bool:
+        return self._check(('wpt', wpt.name), wpt.latitude, wpt.longitude, cylinder_km, 1, False)
+
+    def within_drift(self, igc_info, start_igc, variance_meters) -> bool:
+        lon, lat = start_igc.latitude, start_igc.longitude
+        return self._check(('drift', lon, lat), lon, lat, variance_meters, 1000, True)
+
+    def _check(self, key, lon, lat, limit, scale, strict) -> bool:
+        self.checks += 1
+        window = self._windows.get(key)
+        i = self.index
+        if window is None or window[0] != (lon, lat, limit) or not window[1] <= i < window[1] + len(window[2]):
+            if len(self._windows) >= MAX_DISTANCE_WINDOWS:
+                self._windows = {k: w for k, w in self._windows.items() if w[1] + len(w[2]) > i}
+            window = ((lon, lat, limit), i, self._batch(lon, lat, limit, scale, strict))
+            self._windows[key] = window
+        return window[2][i - window[1]]
+
+    def _batch(self, lon, lat, limit, scale, strict):
+        stop = min(self.index + self.batch_size, len(self.track))
+        return within_distance(self.track.latitude[self.index:stop], self.track.longitude[self.index:stop],
+                               lon, lat, limit, scale, strict).tolist()
+
+
+def within_distance(lons, lats, lon, lat, limit, scale=1, strict=False) -> numpy.ndarray:
+    """
+    Mask of the points within limit of lon, lat, using the same comparison as GeodesicDistance.
+
+    Kernel results within ELLIPSOIDAL_MAX_ERROR_KM of the limit are settled with the exact geodesic.
+
+    :param lons: longitudes, in the swapped order of get_distance_from_lat_lon_in_km
+    :param lats:
+    :param lon:
+    :param lat:
+    :param limit: distance limit in km times scale
+    :param scale: 1000 to compare in meters
+    :param strict: distance < limit instead of distance <= limit
+    :return:
+    """
+    distances = get_distances_from_lat_lon_in_km(lons, lats, lon, lat) * scale
+    inside = distances < limit if strict else distances <= limit
+    for j in numpy.flatnonzero(numpy.abs(distances - limit) <= ELLIPSOIDAL_MAX_ERROR_KM * scale).tolist():
+        distance = get_distance_from_lat_lon_in_km(float(lons[j]), float(lats[j]), lon, lat) * scale
+        inside[j] = distance < limit if strict else distance <= limit
+    return inside
+
+
+class DistanceCounts:
+    """
+    How many distance checks each tier of WptProjection settled
+    """
+    __slots__ = ('bounds', 'planar', 'geodesic')
+
+    def __init__(self):
+        self.bounds = 0
+        self.planar = 0
+        self.geodesic = 0
+
+    def as_dict(self) -> dict:
+        return {'bounds': self.bounds, 'planar': self.planar, 'geodesic': self.geodesic}
+
+
+class WptProjection(GeodesicDistance):
+    """
+    Tiered distance checks around one waypoint.
+
+    1. bounds: a latitude/longitude box around the limit rejects fixes that are clearly outside
+    2. planar: local tangent plane (east, north in km) with the ellipsoid radii of curvature at the waypoint
+       and the east scale corrected linearly for latitude, settled with a squared distance comparison when
+       the fix is further than the error margin from the limit
+    3. geodesic: the exact geodesic, only for fixes within the margin of the limit
+
+    The margin is the larger of epsilon_km and a bound of the planar error derived from the ellipsoid, see
+    distortion and margin_km, so every answer matches GeodesicDistance with any epsilon_km, including 0.
+    """
+
+    def __init__(self, wpt: WptDefinition, epsilon_km: float = PROJECTION_EPSILON_KM,
+                 counts: DistanceCounts = None):
+        self.wpt = wpt
+        self.epsilon_km = epsilon_km
+        self.counts = counts if counts is not None else DistanceCounts()
+        # WptDefinition.longitude holds the latitude, see parse_wpt_file
+        self._lat = wpt.longitude
+        self._lon = wpt.latitude
+        lat_rad = math.radians(self._lat)
+        w = 1 - WGS84_E2 * math.sin(lat_rad) ** 2
+        self._prime_vertical_km = WGS84_A / math.sqrt(w) / 1000
+        meridional_km = WGS84_A * (1 - WGS84_E2) / w ** 1.5 / 1000
+        self._north_km = meridional_km * math.pi / 180
+        self._east_km = self._prime_vertical_km * math.cos(lat_rad) * math.pi / 180
+        self._half_tan = math.tan(lat_rad) * math.pi / 360
+        self._meridional_km = meridional_km
+        self._abs_lat_rad = abs(lat_rad)
+        self._abs_tan = abs(math.tan(lat_rad))
+        self._bounds = {}
+        self._margins = {}
+
+    def project(self, igc_info):
+        d_lat = igc_info.longitude - self._lat
+        d_lon = (igc_info.latitude - self._lon + 180) % 360 - 180
+        return d_lon * self._east_km * (1 - self._half_tan * d_lat), d_lat * self._north_km
+
+    def distortion(self, radius_km) -> Optional[float]:
+        """
+        Bound of the relative error of planar lengths within radius_km of the waypoint on the plane.
+
+        In north, east of unit length on the ellipsoid the Jacobian of project is [[0, b], [c, a]], with
+        c = M0 / M the meridional radius ratio, b = N0 cos(lat0) (1 - tan(lat0) d_lat / 2) / (N cos(lat)) the
+        east scale left by the linear correction and a = -N0 cos(lat0) tan(lat0) d_lon / (2 M) its shear. Its
+        distance to the swap of east and north, an isometry, is at most the Frobenius norm of (a, b - 1, c - 1),
+        which bounds each by its Taylor remainder over the latitudes within radius_km.
+
+        :param radius_km:
+        :return: None when the plane reaches too close to a pole
+        """
+        lat_reach = radius_km / self._meridional_km
+        half_tan_reach = self._abs_tan * lat_reach / 2
+        lat_max = self._abs_lat_rad + lat_reach
+        if half_tan_reach >= 0.5 or lat_max >= MAX_PLANAR_LAT:
+            return None
+        shear = self._abs_tan * radius_km / (1 - half_tan_reach) / (2 * MIN_MERIDIONAL_KM)
+        north = math.expm1(MERIDIONAL_RATE * lat_reach)
+        east = math.expm1((self._abs_tan / 2 + PRIME_VERTICAL_RATE) * lat_reach +
+                          half_tan_reach ** 2 / (2 * (1 - half_tan_reach)) +
+                          (1 / math.cos(lat_max) ** 2 + PRIME_VERTICAL_CURVATURE) * lat_reach ** 2 / 2)
+        return math.sqrt(shear * shear + north * north + east * east)
+
+    def margin_km(self, limit_km, reach_km=0.0) -> Optional[float]:
+        """
+        Error margin of comparing a planar distance with limit_km, between two points at most reach_km from the
+        waypoint on the plane.
+
+        With lengths off by at most a factor distortion, a planar distance inside limit_km - margin or outside
+        limit_km + margin is on the same side of limit_km as the geodesic when margin >= distortion * limit_km.
+        The straight line lies within reach_km, and a geodesic shorter than limit_km within
+        reach_km + 2 * limit_km, so the distortion is taken over that radius.
+
+        :param limit_km:
+        :param reach_km: 0 for distances from the waypoint
+        :return: None when the planar check cannot be bounded
+        """
+        key = (limit_km, math.ceil(reach_km / MARGIN_REACH_STEP_KM))
+        if key in self._margins:
+            return self._margins[key]
+        distortion = self.distortion(key[1] * MARGIN_REACH_STEP_KM + 2 * limit_km)
+        margin = None if distortion is None or distortion >= MAX_DISTORTION else \
+            max(self.epsilon_km, distortion * limit_km + ROUNDING_MARGIN_KM)
+        self._margins[key] = margin
+        return margin
+
+    def bounds(self, limit_km):
+        """
+        Latitude and longitude half widths in degrees of a box containing every point within limit_km
+        """
+        box = self._bounds.get(limit_km)
+        if box is None:
+            reach_km = (limit_km + self.epsilon_km) * BOUNDS_SAFETY
+            lat_half = reach_km / self._north_km
+            # The cylinder is widest in longitude at its edge furthest from the equator
+            cos_lat = math.cos(math.radians(min(abs(self._lat) + lat_half, 90)))
+            lon_half = 180 if cos_lat <= 0 else min(reach_km / (self._prime_vertical_km * cos_lat * math.pi / 180),
+                                                    180)
+            box = (lat_half, lon_half)
+            self._bounds[limit_km] = box
+        return box
+
+    def in_cylinder(self, igc_info, wpt: WptDefinition, cylinder_km) -> bool:
+        counts = self.counts
+        lat_half, lon_half = self.bounds(cylinder_km)
+        if abs(igc_info.longitude - self._lat) > lat_half or \
+                abs((igc_info.latitude - self._lon + 180) % 360 - 180) > lon_half:
+            counts.bounds += 1
+            return False
+        east, north = self.project(igc_info)
+        squared = east * east + north * north
+        margin = self.margin_km(cylinder_km)
+        if margin is not None:
+            inner = cylinder_km - margin
+            if inner > 0 and squared <= inner * inner:
+                counts.planar += 1
+                return True
+            outer = cylinder_km + margin
+            if squared > outer * outer:
+                counts.planar += 1
+                return False
+        counts.geodesic += 1
+        return GEODESIC_DISTANCE.in_cylinder(igc_info, wpt, cylinder_km)
+
+    def within_drift(self, igc_info, start_igc, variance_meters) -> bool:
+        counts = self.counts
+        limit_km = variance_meters / 1000
+        lat_half, lon_half = self.bounds(limit_km)
+        if abs(igc_info.longitude - start_igc.longitude) >= lat_half or \
+                abs((igc_info.latitude - start_igc.latitude + 180) % 360 - 180) >= lon_half:
+            counts.bounds += 1
+            return False
+        east, north = self.project(igc_info)
+        start_east, start_north = self.project(start_igc)
+        squared = (east - start_east) ** 2 + (north - start_north) ** 2
+        reach_squared = max(east * east + north * north, start_east * start_east + start_north * start_north)
+        margin = self.margin_km(limit_km, math.sqrt(reach_squared))
+        if margin is not None:
+            inner = limit_km - margin
+            if inner > 0 and squared < inner * inner:
+                counts.planar += 1
+                return True
+            outer = limit_km + margin
+            if squared >= outer * outer:
+                counts.planar += 1
+                return False
+        counts.geodesic += 1
+        return GEODESIC_DISTANCE.within_drift(igc_info, start_igc, variance_meters)
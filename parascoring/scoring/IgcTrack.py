@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+import numpy
+
+from parascoring.scoring.IgcUtils import IgcFix, IgcSource, BYTES_TYPES, DATE_PATTERN, EPOCH, date_to_epoch, \
+    decode_igc_basic_line, igc_source_lines, is_igc_path
+
+NEW_LINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+# B,HHMMSS,DDMMmmmN,DDDMMmmmE,V,PPPPP,GGGGG
+B_RECORD_LENGTH = 35
+B_RECORD_DIGITS = list(range(1, 14)) + list(range(15, 23)) + list(range(25, 35))
+B_RECORD_LETTERS = [14, 23]
+B_RECORD_VALID = 24
+DECIMAL_POWERS = 10 ** numpy.arange(5, dtype=numpy.int64)
+
+
+class IgcTrack:
+    """
+    Columnar storage of every B record in an IGC file.
+
+    time: <int64> seconds since the epoch, the HFDTE date plus the B record time of day
+    longitude, latitude: <float64> decimal degrees, same fields as IGCInfo
+    alt_pressure, alt_gps: <int32> altitudes in meters
+    valid: <bool> the B record carried the 'A' validity flag
+    """
+
+    def __init__(self, time, longitude, latitude, alt_pressure, alt_gps, valid):
+        self.time = numpy.asarray(time, dtype=numpy.int64)
+        self.longitude = numpy.asarray(longitude, dtype=numpy.float64)
+        self.latitude = numpy.asarray(latitude, dtype=numpy.float64)
+        self.alt_pressure = numpy.asarray(alt_pressure, dtype=numpy.int32)
+        self.alt_gps = numpy.asarray(alt_gps, dtype=numpy.int32)
+        self.valid = numpy.asarray(valid, dtype=bool)
+
+    def __len__(self):
+        return len(self.time)
+
+    def fix(self, i) -> IgcFix:
+        return IgcFix(int(self.time[i]), float(self.longitude[i]), float(self.latitude[i]),
+                      int(self.alt_pressure[i]), int(self.alt_gps[i]), bool(self.valid[i]))
+
+    def fixes(self):
+        for i in range(len(self)):
+            yield self.fix(i)
+
+    def get_datetime(self):
+        if len(self) == 0:
+            return None
+        return EPOCH + timedelta(seconds=int(self.time[0]))
+
+
+def parse_igc_track(igc: Iterable[str]) -> IgcTrack:
+    """
+    Read the lines of an IGC file into an IgcTrack, following the HFDTE handling of IGCParser
+
+    :param igc: iterable of IGC lines
+    :return:
+    """
+    date_epoch = None
+    time, longitude, latitude, alt_pressure, alt_gps, valid = [], [], [], [], [], []
+    for x in igc:
+        line = x.strip('\n')
+        if line.startswith('HFDTE'):
+            day, month, year = DATE_PATTERN.search(line).groups()
+            date_epoch = date_to_epoch(datetime(year=2000+int(year), month=int(month), day=int(day)))
+            continue
+        record = decode_igc_basic_line(line)
+        if record is None:
+            continue
+        if date_epoch is None:
+            raise ValueError('B record found before HFDTE date header')
+        seconds, long_decimal, lat_decimal, pressure, gps, is_valid = record
+        time.append(date_epoch + seconds)
+        longitude.append(long_decimal)
+        latitude.append(lat_decimal)
+        alt_pressure.append(pressure)
+        alt_gps.append(gps)
+        valid.append(is_valid)
+    return IgcTrack(time, longitude, latitude, alt_pressure, alt_gps, valid)
+
+
+def parse_igc_bytes(data: bytes) -> IgcTrack:
+    """
+    Decode the raw bytes of an IGC file into an IgcTrack.
+
+    B records are fixed width so every well formed record is decoded with array slicing at fixed offsets,
+    only records that do not match the B record layout go through decode_igc_basic_line.
+
+    :param data: contents of an IGC file
+    :return:
+    """
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    ends = numpy.flatnonzero((buf == NEW_LINE) | (buf == CARRIAGE_RETURN))
+    starts = numpy.concatenate(([0], ends + 1))
+    ends = numpy.concatenate((ends, [len(buf)]))
+    lengths = ends - starts
+    first = numpy.zeros(len(starts), dtype=numpy.uint8)
+    first[lengths > 0] = buf[starts[lengths > 0]]
+
+    b_lines = numpy.flatnonzero(first == ord('B'))
+    date_lines = [i for i in numpy.flatnonzero(first == ord('H')).tolist()
+                  if data.startswith(b'HFDTE', starts[i], ends[i])]
+
+    date_epochs = []
+    for i in date_lines:
+        line = data[starts[i]:ends[i]].decode('utf-8', errors='replace')
+        day, month, year = DATE_PATTERN.search(line).groups()
+        date_epochs.append(date_to_epoch(datetime(year=2000+int(year), month=int(month), day=int(day))))
+
+    count = len(b_lines)
+    seconds = numpy.zeros(count, dtype=numpy.int64)
+    longitude = numpy.zeros(count, dtype=numpy.float64)
+    latitude = numpy.zeros(count, dtype=numpy.float64)
+    alt_pressure = numpy.zeros(count, dtype=numpy.int64)
+    alt_gps = numpy.zeros(count, dtype=numpy.int64)
+    valid = numpy.zeros(count, dtype=bool)
+    keep = numpy.ones(count, dtype=bool)
+
+    fast = lengths[b_lines] >= B_RECORD_LENGTH
+    rows = buf[starts[b_lines[fast], None] + numpy.arange(B_RECORD_LENGTH)]
+    digits = rows.astype(numpy.int64) - ord('0')
+    well_formed = numpy.all((digits[:, B_RECORD_DIGITS] >= 0) & (digits[:, B_RECORD_DIGITS] <= 9), axis=1)
+    well_formed &= numpy.all((rows[:, B_RECORD_LETTERS] >= ord('A')) & (rows[:, B_RECORD_LETTERS] <= ord('Z')),
+                             axis=1)
+    well_formed &= (rows[:, B_RECORD_VALID] == ord('A')) | (rows[:, B_RECORD_VALID] == ord('V'))
+    fast[fast] = well_formed
+    rows = rows[well_formed]
+    digits = digits[well_formed]
+
+    seconds[fast] = _number(digits, 1, 3) * 3600 + _number(digits, 3, 5) * 60 + _number(digits, 5, 7)
+    longitude[fast] = _signed_degrees(rows[:, 14], _number(digits, 7, 9), _number(digits, 9, 14))
+    latitude[fast] = _signed_degrees(rows[:, 23], _number(digits, 15, 18), _number(digits, 18, 23))
+    valid[fast] = rows[:, B_RECORD_VALID] == ord('A')
+    alt_pressure[fast] = _number(digits, 25, 30)
+    alt_gps[fast] = _number(digits, 30, 35)
+
+    for j in numpy.flatnonzero(~fast).tolist():
+        i = b_lines[j]
+        record = decode_igc_basic_line(data[starts[i]:ends[i]].decode('utf-8', errors='replace'))
+        if record is None:
+            keep[j] = False
+            continue
+        seconds[j], longitude[j], latitude[j], alt_pressure[j], alt_gps[j], valid[j] = record
+
+    b_lines = b_lines[keep]
+    date_index = numpy.searchsorted(numpy.asarray(date_lines, dtype=numpy.int64), b_lines) - 1
+    if len(b_lines) and date_index[0] < 0:
+        raise ValueError('B record found before HFDTE date header')
+    time = numpy.asarray(date_epochs, dtype=numpy.int64)[date_index] + seconds[keep]
+    return IgcTrack(time, longitude[keep], latitude[keep], alt_pressure[keep], alt_gps[keep], valid[keep])
+
+
+def _number(digits, start, stop):
+    return digits[:, start:stop] @ DECIMAL_POWERS[stop - start - 1::-1]
+
+
+def _signed_degrees(direction, degrees, thousandths_of_minutes):
+    # Same operations as deg_to_dec so the result matches the regex path bit for bit
+    sign = numpy.where((direction == ord('S')) | (direction == ord('W')), -1, 1)
+    return sign * (degrees + (thousandths_of_minutes / 1000) / 60.0 + 0 / 3600)
+
+
+def load_igc_track(file_name: str) -> IgcTrack:
+    with open(file_name, "rb") as f:
+        return parse_igc_bytes(f.read())
+
+
+def read_igc_track(igc: IgcSource) -> IgcTrack:
+    """
+    Read an IgcTrack from a path, the bytes of an IGC file, a binary or text file object such as a streaming
+    response body, or an iterable of lines, without writing anything to disk
+
+    :param igc:
+    :return:
+    """
+    if is_igc_path(igc):
+        return load_igc_track(igc)
+    if isinstance(igc, BYTES_TYPES):
+        return parse_igc_bytes(bytes(igc))
+    if hasattr(igc, 'read'):
+        data = igc.read()
+        return parse_igc_bytes(data.encode('utf-8') if isinstance(data, str) else data)
+    return parse_igc_track(igc_source_lines(igc))
+
+
+def order_igc_tracks(tracks: List[IgcTrack]) -> List[IgcTrack]:
+    return sorted(tracks, key=lambda track: track.get_datetime())
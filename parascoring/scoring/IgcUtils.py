@@ -1,10 +1,21 @@
+import calendar
+import io
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List
+from functools import lru_cache
+from typing import IO, Iterable, List, Optional, Union
 
+from parascoring.scoring.Instrumentation import ScoringMetrics, stage
 from parascoring.scoring.Utils import deg_to_dec
 
+EPOCH = datetime(year=1970, month=1, day=1)
+# A path, the contents of an IGC file, a binary or text file object, or an iterable of lines
+IgcSource = Union[str, os.PathLike, bytes, bytearray, memoryview, IO, Iterable[str], Iterable[bytes]]
+BYTES_TYPES = (bytes, bytearray, memoryview)
+
 
 @dataclass
 class IGCInfo:
@@ -26,11 +37,64 @@ class IGCInfo:
     alt_gps: int
     valid: bool
 
+    @property
+    def timestamp(self) -> int:
+        return date_to_epoch(self.time)
+
+
+class IgcFix:
+    """
+    Compact fix for the scoring hot path, the time is kept as integer seconds since the epoch
+    and only turned into a datetime when a score report is formatted.
+    """
+    __slots__ = ('timestamp', 'longitude', 'latitude', 'alt_pressure', 'alt_gps', 'valid')
+
+    def __init__(self, timestamp: int, longitude: float, latitude: float, alt_pressure: int, alt_gps: int,
+                 valid: bool):
+        self.timestamp = timestamp
+        self.longitude = longitude
+        self.latitude = latitude
+        self.alt_pressure = alt_pressure
+        self.alt_gps = alt_gps
+        self.valid = valid
+
+    @property
+    def time(self) -> datetime:
+        return EPOCH + timedelta(seconds=self.timestamp)
+
+    def __eq__(self, other):
+        if not isinstance(other, IgcFix):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def to_list(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values: list) -> 'IgcFix':
+        return cls(*values)
+
+    def __repr__(self):
+        return 'IgcFix(time={!r}, longitude={}, latitude={}, alt_pressure={}, alt_gps={}, valid={})'.format(
+            self.time, self.longitude, self.latitude, self.alt_pressure, self.alt_gps, self.valid)
+
+
+def to_igc_fix(igc_info) -> IgcFix:
+    if isinstance(igc_info, IgcFix):
+        return igc_info
+    return IgcFix(igc_info.timestamp, igc_info.longitude, igc_info.latitude, igc_info.alt_pressure,
+                  igc_info.alt_gps, igc_info.valid)
+
+
+def date_to_epoch(date: datetime) -> int:
+    return calendar.timegm(date.timetuple())
+
 
 DATE_PATTERN = re.compile("([0-9]{2})([0-9]{2})([0-9]{2})")
 BASIC_IGC_LINE = re.compile("^B([0-9]{2})([0-9]{2})([0-9]{2})(.{8})(.{9})([AV])([0-9]{5})([0-9]{5})")
 LAT_RE = re.compile("([0-9]{3})([0-9]{2})([0-9]{3})([A-Z])")
 LONG_RE = re.compile("([0-9]{2})([0-9]{2})([0-9]{3})([A-Z])")
+ORDER_SCAN_WORKERS = 8
 
 # 'B1103254441910S1697874EA0063100596'
 class IGCParser:
@@ -64,15 +128,56 @@ class IGCFileParser(IGCParser):
         if self._start_datetime:
             return self._start_datetime
 
-        with open(self.file_name, "r") as f:
-            for line in f:
-                self.parse_igc_line(line)
-                if self._start_datetime:
-                    break
+        self._start_datetime = get_igc_start_datetime(self.file_name)
         return self._start_datetime
 
 
+def scan_igc_start_datetime(igc: Iterable[str]):
+    """
+    Read IGC lines only until the first valid B record, decoding nothing but the HFDTE header and that record
+
+    :param igc: iterable of IGC lines
+    :return: datetime of the first fix or None
+    """
+    date = None
+    for x in igc:
+        if x.startswith('HFDTE'):
+            day, month, year = DATE_PATTERN.search(x).groups()
+            date = datetime(year=2000+int(year), month=int(month), day=int(day))
+        elif x.startswith('B'):
+            igc_info = parse_igc_basic_line(x.strip('\n'), date)
+            if igc_info:
+                return igc_info.time
+    return None
+
+
+def get_igc_start_datetime(file_name: str):
+    stat = os.stat(file_name)
+    return _get_igc_start_datetime(file_name, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=4096)
+def _get_igc_start_datetime(file_name: str, mtime_ns: int, size: int):
+    # mtime and size are part of the cache key so a replaced file is scanned again
+    with open(file_name, "r") as f:
+        return scan_igc_start_datetime(f)
+
+
 def parse_igc_basic_line(line: str, date: datetime):
+    record = decode_igc_basic_line(line)
+    if record is None:
+        return None
+    seconds, long_decimal, lat_decimal, alt_pressure, alt_gps, valid = record
+    return IGCInfo(date + timedelta(seconds=seconds), long_decimal, lat_decimal, alt_pressure, alt_gps, valid)
+
+
+def decode_igc_basic_line(line: str):
+    """
+    Decode a B record without building an IGCInfo
+
+    :param line:
+    :return: (<seconds into the day>, <long>, <lat>, <alt_pressure>, <alt_gps>, <valid>) or None
+    """
     if not line or not line.startswith('B'):
         return None
     m = BASIC_IGC_LINE.search(line)
@@ -89,20 +194,83 @@ def parse_igc_basic_line(line: str, date: datetime):
     long_groups = LONG_RE.match(lon)
     long_decimal = deg_to_dec(long_groups[4], int(long_groups[1]),
                               float(long_groups[2] + '.' + long_groups[3]), 0)
-    return IGCInfo(date + timedelta(hours=int(time_hours), minutes=int(time_min), seconds=int(time_sec)),
-                   long_decimal, lat_decimal, int(alt_pressure), int(alt_gps), valid == 'A')
-
-
-def order_igc_files(igc_list: List[str]) -> List[str]:
-    ordered_igc_files = []
-    for file in igc_list:
-        igc_parser = IGCFileParser(file)
-        inserted = False
-        for i in range(len(ordered_igc_files)):
-            if igc_parser.get_datetime() < ordered_igc_files[i].get_datetime():
-                ordered_igc_files.insert(i, igc_parser)
-                inserted = True
-                break
-        if len(ordered_igc_files) == 0 or not inserted:
-            ordered_igc_files.append(igc_parser)
-    return [parser.file_name for parser in ordered_igc_files]
+    return (int(time_hours) * 3600 + int(time_min) * 60 + int(time_sec),
+            long_decimal, lat_decimal, int(alt_pressure), int(alt_gps), valid == 'A')
+
+
+def is_igc_path(igc: IgcSource) -> bool:
+    return isinstance(igc, (str, os.PathLike))
+
+
+def igc_source_lines(igc: IgcSource) -> Iterable[str]:
+    """
+    Lines of an IGC source that is not a path, bytes are decoded as utf-8
+
+    :param igc:
+    :return:
+    """
+    if isinstance(igc, BYTES_TYPES):
+        igc = io.BytesIO(igc)
+    for line in igc:
+        yield line.decode('utf-8', errors='replace') if isinstance(line, BYTES_TYPES) else line
+
+
+def rewindable_igc_source(igc: IgcSource) -> IgcSource:
+    """
+    The source itself if it can be read more than once, otherwise its contents read into memory:
+    non seekable binary file objects, such as a streaming response body, to their bytes, and non seekable text
+    file objects and iterators to a list of lines. Text is never returned as a str, which would be taken for a path.
+
+    :param igc:
+    :return:
+    """
+    if is_igc_path(igc) or isinstance(igc, BYTES_TYPES):
+        return igc
+    if hasattr(igc, 'read'):
+        if hasattr(igc, 'seekable') and igc.seekable():
+            return igc
+        contents = igc.read()
+        return contents.splitlines(keepends=True) if isinstance(contents, str) else contents
+    if iter(igc) is igc:
+        return list(igc)
+    return igc
+
+
+def get_igc_source_start_datetime(igc: IgcSource):
+    """
+    Datetime of the first fix of a path, bytes, seekable file object or list of lines, leaving file objects
+    at the position they were at
+
+    :param igc:
+    :return:
+    """
+    if is_igc_path(igc):
+        return get_igc_start_datetime(igc)
+    if hasattr(igc, 'read'):
+        position = igc.tell()
+        try:
+            return scan_igc_start_datetime(igc_source_lines(igc))
+        finally:
+            igc.seek(position)
+    return scan_igc_start_datetime(igc_source_lines(igc))
+
+
+def order_igc_files(igc_list: List[IgcSource], metrics: Optional[ScoringMetrics] = None) -> List[IgcSource]:
+    """
+    Order IGC sources by their first fix. Sources that can only be read once are read into memory and
+    returned as bytes or a list of lines in their place.
+
+    :param igc_list: paths, bytes, file objects or iterables of lines
+    :param metrics: times the scan as header_scan and counts the header_scans
+    :return:
+    """
+    with stage(metrics, 'header_scan'):
+        igc_list = [rewindable_igc_source(igc) for igc in igc_list]
+        if len(igc_list) < 2:
+            return igc_list
+        with ThreadPoolExecutor(max_workers=min(ORDER_SCAN_WORKERS, len(igc_list))) as executor:
+            start_datetimes = list(executor.map(get_igc_source_start_datetime, igc_list))
+    if metrics is not None:
+        metrics.count('header_scans', len(igc_list))
+    ordered = sorted(range(len(igc_list)), key=lambda i: start_datetimes[i])
+    return [igc_list[i] for i in ordered]
@@ -0,0 +1,103 @@
+from collections import defaultdict
+from time import perf_counter
+from typing import Callable, Optional
+
+# Receives ScoringMetrics.as_dict() after every scoring run, see set_metrics_hook
+_metrics_hook = None
+
+
+class ScoringMetrics:
+    """
+    Opt-in timings and counters of one scoring run.
+
+    Engines and the scorer only touch it once per file, track or waypoint check when it is given, a run
+    without one pays a None check per track.
+
+    timings, in seconds: header_scan, parse, index_lookup, distance, report
+    counters: files, header_scans, tracks, fixes, index_hits (fixes in a grid cell with waypoints),
+    candidate_waypoints (waypoints of those cells), assessed_fixes, distance_checks, geodesic_calls, skipped_fixes
+
+    The original engine has no index, it only reports distance, tracks, fixes and distance_checks.
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def add_time(self, name: str, seconds: float):
+        self.timings[name] += seconds
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def as_dict(self) -> dict:
+        fixes = self.counters.get('fixes')
+        return {
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+            'index_hit_rate': self.counters.get('index_hits', 0) / fixes if fixes else None,
+            'candidates_per_fix': self.counters.get('candidate_waypoints', 0) / fixes if fixes else None,
+        }
+
+
+class Stage:
+    """
+    Context manager adding the time spent in its block to a timing of ScoringMetrics
+    """
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics: ScoringMetrics, name: str):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.timings[self.name] += perf_counter() - self.start
+        return False
+
+
+class NoStage:
+    """
+    Stage of a run without metrics
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+def stage(metrics: Optional[ScoringMetrics], name: str):
+    return NO_STAGE if metrics is None else Stage(metrics, name)
+
+
+def set_metrics_hook(hook: Optional[Callable[[dict], None]]):
+    """
+    Collect metrics for every scoring run and pass them to hook, e.g. to publish them. None turns it off.
+
+    :param hook: called with ScoringMetrics.as_dict()
+    :return:
+    """
+    global _metrics_hook
+    _metrics_hook = hook
+
+
+def default_metrics() -> Optional[ScoringMetrics]:
+    """
+    Metrics for an engine created without any, only when a hook wants them
+    """
+    return ScoringMetrics() if _metrics_hook is not None else None
+
+
+def emit_metrics(metrics: Optional[ScoringMetrics]):
+    if metrics is not None and _metrics_hook is not None:
+        _metrics_hook(metrics.as_dict())
@@ -0,0 +1,91 @@
+from typing import List, Optional, Tuple
+
+import numpy
+
+from parascoring.scoring.Distance import within_distance
+from parascoring.scoring.IgcTrack import IgcTrack
+from parascoring.scoring.IgcUtils import IgcFix
+from parascoring.scoring.Utils import ELLIPSOIDAL_MAX_ERROR_KM, get_distances_from_lat_lon_in_km
+
+LANDING_CHUNK_ROWS = 64
+
+
+def find_landings(track: IgcTrack, rows: numpy.ndarray, start: Optional[IgcFix], alt_variance_meters,
+                  distance_variance_meters, time_landed_seconds, first_only: bool = True) \
+        -> Tuple[List[int], Optional[IgcFix]]:
+    """
+    Rows where the LandWpt state machine succeeds, for the rows of a track inside a landing cylinder.
+
+    The state machine keeps a start fix and moves it to the current fix whenever the altitude or drift
+    check against it fails, leaving the cylinder resets it. Rows are split into runs of consecutive rows,
+    then into still runs wherever one step moves 2 * distance_variance_meters or climbs
+    2 * alt_variance_meters, no start fix can survive such a step so the next run starts from its first
+    row. Runs spanning less than time_landed_seconds cannot land and are skipped, the others follow the
+    start fix with array comparisons over growing chunks of rows.
+
+    :param track:
+    :param rows: sorted rows inside the cylinder
+    :param start: start fix carried over from the previous chunk, applies when rows begins the chunk
+    :param alt_variance_meters:
+    :param distance_variance_meters:
+    :param time_landed_seconds:
+    :param first_only: stop at the first landing
+    :return: landing rows and the start fix after the last row
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    if not len(rows):
+        return [], None
+    lons = track.latitude
+    lats = track.longitude
+    times = track.time
+    alts = track.alt_gps
+    # A step that leaves the cylinder, or is too long or too steep for any start fix to hold across it
+    steps = get_distances_from_lat_lon_in_km(lons[rows[:-1]], lats[rows[:-1]], lons[rows[1:]], lats[rows[1:]])
+    breaks = numpy.flatnonzero(
+        (numpy.diff(rows) != 1) |
+        (steps * 1000 >= 2 * distance_variance_meters + ELLIPSOIDAL_MAX_ERROR_KM * 1000) |
+        (numpy.abs(numpy.diff(alts[rows].astype(numpy.int64))) > 2 * alt_variance_meters)) + 1
+    runs = numpy.split(rows, breaks)
+    landings = []
+    for k, run in enumerate(runs):
+        if k:
+            start = None
+        span_start = times[run].min() if start is None else min(times[run].min(), start.timestamp)
+        if times[run].max() - span_start < time_landed_seconds and k < len(runs) - 1:
+            continue
+        run_landings, start = _follow_start(track, run, start, alt_variance_meters, distance_variance_meters,
+                                            time_landed_seconds, first_only)
+        landings.extend(run_landings)
+        if landings and first_only:
+            break
+    return landings, start
+
+
+def _follow_start(track: IgcTrack, run: numpy.ndarray, start: Optional[IgcFix], alt_variance_meters,
+                  distance_variance_meters, time_landed_seconds, first_only: bool):
+    landings = []
+    position = 0
+    if start is None:
+        start = track.fix(int(run[0]))
+        position = 1
+    chunk = LANDING_CHUNK_ROWS
+    while position < len(run):
+        window = run[position:position + chunk]
+        held = (numpy.abs(track.alt_gps[window].astype(numpy.int64) - start.alt_gps) <= alt_variance_meters) & \
+            within_distance(track.latitude[window], track.longitude[window], start.latitude, start.longitude,
+                            distance_variance_meters, 1000, True)
+        failed = numpy.flatnonzero(~held)
+        end = int(failed[0]) if len(failed) else len(window)
+        landed = window[:end][track.time[window[:end]] - start.timestamp >= time_landed_seconds]
+        if len(landed):
+            landings.extend(landed[:1].tolist() if first_only else landed.tolist())
+            if first_only:
+                return landings, start
+        if len(failed):
+            start = track.fix(int(window[end]))
+            position += end + 1
+            chunk = LANDING_CHUNK_ROWS
+        else:
+            position += len(window)
+            chunk *= 2
+    return landings, start
@@ -0,0 +1,67 @@
+import math
+
+import numpy
+
+KM_PER_DEGREE = 111.0
+# Cell keys pack the latitude row and longitude column into one int
+CELL_ROW_STRIDE = 1 << 32
+
+
+class WaypointGrid:
+    """
+    Uniform latitude/longitude cell hash of waypoint cylinders.
+
+    A waypoint is stored in every cell its cylinder's bounding box overlaps, so one dictionary lookup
+    with the cell of a fix returns every waypoint that could contain it. Each cell keeps its waypoints
+    in a dict used as an ordered set, removing a tagged waypoint only touches its own cells.
+    """
+
+    def __init__(self, cell_km: float):
+        self.cell_deg = cell_km / KM_PER_DEGREE
+        self._inverse_cell = 1 / self.cell_deg
+        self.cells = {}
+        self._wrapper_cells = {}
+
+    def key(self, lat, lon) -> int:
+        return math.floor(lat * self._inverse_cell) * CELL_ROW_STRIDE + math.floor(lon * self._inverse_cell)
+
+    def keys(self, lats, lons):
+        rows = numpy.floor(lats * self._inverse_cell).astype(numpy.int64)
+        columns = numpy.floor(lons * self._inverse_cell).astype(numpy.int64)
+        return rows * CELL_ROW_STRIDE + columns
+
+    def add(self, wrapper, lat, lon, lat_half, lon_half):
+        """
+        Store wrapper in every cell overlapping lat +- lat_half, lon +- lon_half degrees
+        """
+        keys = []
+        for row in range(math.floor((lat - lat_half) * self._inverse_cell),
+                         math.floor((lat + lat_half) * self._inverse_cell) + 1):
+            for column in range(math.floor((lon - lon_half) * self._inverse_cell),
+                                math.floor((lon + lon_half) * self._inverse_cell) + 1):
+                keys.append(row * CELL_ROW_STRIDE + column)
+        self.add_cells(wrapper, keys)
+
+    def add_cells(self, wrapper, keys):
+        """
+        Store wrapper in cells computed earlier, see wrapper_cells
+        """
+        for key in keys:
+            self.cells.setdefault(key, {})[wrapper] = None
+        self._wrapper_cells[wrapper] = list(keys)
+
+    def wrapper_cells(self, wrapper) -> list:
+        return self._wrapper_cells.get(wrapper, [])
+
+    def remove(self, wrapper):
+        for key in self._wrapper_cells.pop(wrapper, []):
+            cell = self.cells[key]
+            del cell[wrapper]
+            if not cell:
+                del self.cells[key]
+
+    def get(self, key) -> dict:
+        return self.cells.get(key)
+
+    def __len__(self):
+        return len(self._wrapper_cells)
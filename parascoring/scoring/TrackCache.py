@@ -0,0 +1,128 @@
+import hashlib
+import io
+import os
+import re
+import tempfile
+import zipfile
+from typing import Optional
+
+import numpy
+
+from parascoring.scoring.IgcTrack import IgcTrack, parse_igc_bytes
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.v{}.npz'.format(CACHE_VERSION)
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+TRACK_COLUMNS = ['time', 'longitude', 'latitude', 'alt_pressure', 'alt_gps', 'valid']
+UNSAFE_KEY_CHARACTERS = re.compile('[^0-9A-Za-z_-]')
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def etag_key(etag: str) -> str:
+    """
+    S3 ETags come back quoted and multipart ETags contain a '-', keep them usable as file names
+    """
+    return UNSAFE_KEY_CHARACTERS.sub('_', etag.strip('"'))
+
+
+def track_to_bytes(track: IgcTrack) -> bytes:
+    buffer = io.BytesIO()
+    numpy.savez(buffer, **{column: getattr(track, column) for column in TRACK_COLUMNS})
+    return buffer.getvalue()
+
+
+def track_from_bytes(data: bytes) -> IgcTrack:
+    with numpy.load(io.BytesIO(data), allow_pickle=False) as columns:
+        return IgcTrack(*[columns[column] for column in TRACK_COLUMNS])
+
+
+class TrackCache:
+    """
+    Directory of parsed tracks stored as .npz sidecars keyed by content hash or S3 ETag.
+
+    Reads refresh the modification time of a sidecar, when the directory grows past max_bytes
+    the least recently used sidecars are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[IgcTrack]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                track = track_from_bytes(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Truncated or foreign file, drop it and let the caller parse again
+            self._remove(path)
+            return None
+        os.utime(path)
+        return track
+
+    def put(self, key: str, track: IgcTrack):
+        self.put_bytes(key, track_to_bytes(track))
+
+    def put_bytes(self, key: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        finally:
+            # Left behind only when the write failed
+            self._remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Evicted by a concurrent put
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_cached_igc_track(file_name: str, cache: TrackCache) -> IgcTrack:
+    """
+    Parse an IGC file unless a track with the same content hash is already in the cache
+
+    :param file_name:
+    :param cache:
+    :return:
+    """
+    with open(file_name, "rb") as f:
+        data = f.read()
+    key = content_key(data)
+    track = cache.get(key)
+    if track is None:
+        track = parse_igc_bytes(data)
+        cache.put(key, track)
+    return track
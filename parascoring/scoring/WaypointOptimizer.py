@@ -1,25 +1,37 @@
+import logging
+import math
 from abc import ABC
-from collections import defaultdict
-from datetime import timedelta
-
+from time import perf_counter
 import numpy
 
-from parascoring.scoring.IgcUtils import IGCInfo
-from parascoring.scoring.Utils import get_distance_from_lat_lon_in_km, WptType, WptDefinition
-from parascoring.scoring.WptOriginal import WptStatus
+from parascoring.scoring.IgcUtils import IGCInfo, IgcFix, to_igc_fix
+from parascoring.scoring.IgcTrack import IgcTrack
+from parascoring.scoring.Distance import DistanceCounts, GeodesicDistance, WptProjection, GEODESIC_DISTANCE, \
+    PROJECTION_EPSILON_KM
+from parascoring.scoring.Instrumentation import ScoringMetrics, default_metrics
+from parascoring.scoring.SpatialIndex import WaypointGrid
+from parascoring.scoring.Utils import WptType, WptDefinition, WptStatus, ELLIPSOIDAL_MAX_ERROR_KM, ecef_km
 from collections import OrderedDict
 
+logger = logging.getLogger()
+
+SCORING_STATE_VERSION = 1
+# Fewer skipped fixes than this and the reachability check is paused for as many fixes
+REACHABILITY_MIN_SKIP = 64
+
 
 class WptWrapper(ABC):
     wpt: WptDefinition
+    distance: GeodesicDistance
 
     def __init__(self, wpt: WptDefinition):
         self.wpt = wpt
+        self.distance = GEODESIC_DISTANCE
 
-    def submit(self, igc_info) -> WptStatus:
+    def submit(self, igc_info, starts: dict = None) -> WptStatus:
         pass
 
-    def reset(self):
+    def reset(self, starts: dict = None):
         pass
 
     def get_wpt(self):
@@ -34,50 +46,51 @@ class TagWaypoint(WptWrapper):
         super().__init__(wpt)
         self._wpt_config = wpt_config
 
-    def submit(self, igc_info) -> WptStatus:
-        if self._wpt_config['cylinder_km'] >= \
-                get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
-                                                self.wpt.latitude, self.wpt.longitude):
+    def submit(self, igc_info, starts: dict = None) -> WptStatus:
+        if self.distance.in_cylinder(igc_info, self.wpt, self._wpt_config['cylinder_km']):
             return WptStatus.SUCCESS
         return WptStatus.MISSED
 
 
 class LandWpt(WptWrapper):
-    start_igc: IGCInfo
+    """
+    Landing waypoint, the start fix of the landing window in progress is kept in a starts dict owned by
+    the scorer so one wrapper can be shared by many pilots. Without one the wrapper uses its own.
+    """
 
     def __init__(self, wpt: WptDefinition, wpt_config: dict):
         super().__init__(wpt)
         self._wpt_config = wpt_config
-        self.reset()
+        self._time_landed_seconds = wpt_config['time_landed_min'] * 60
+        self._starts = {}
 
-    def submit(self, igc_info) -> WptStatus:
-        wpt = self.wpt
-        if self._wpt_config['cylinder_km'] >= \
-                get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
-                                                wpt.latitude, wpt.longitude):
+    def submit(self, igc_info, starts: dict = None) -> WptStatus:
+        if starts is None:
+            starts = self._starts
+        distance = self.distance
+        if distance.in_cylinder(igc_info, self.wpt, self._wpt_config['cylinder_km']):
+            start_igc = starts.get(self)
             # If waypoint is active but was not in bounds and altitude is not constant reset start_time.
-            if not self.start_igc:
-                self.start_igc = igc_info
+            if not start_igc:
+                starts[self] = to_igc_fix(igc_info)
                 return WptStatus.ACTIVE
             alt_variance = self._wpt_config['time_altitude_var_meters']
             alt_gps_condition = \
-                numpy.abs(self.start_igc.alt_gps - igc_info.alt_gps) <= alt_variance
-            distance = get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
-                                                       self.start_igc.latitude, self.start_igc.longitude)
-            distance_condition = distance * 1000 < self._wpt_config['distance_variance_meters']
-            if self.start_igc and alt_gps_condition and distance_condition:
-                if (igc_info.time - self.start_igc.time) >= timedelta(minutes=self._wpt_config['time_landed_min']):
+                abs(start_igc.alt_gps - igc_info.alt_gps) <= alt_variance
+            if start_igc and alt_gps_condition and \
+                    distance.within_drift(igc_info, start_igc, self._wpt_config['distance_variance_meters']):
+                if (igc_info.timestamp - start_igc.timestamp) >= self._time_landed_seconds:
                     return WptStatus.SUCCESS
             else:
-                self.start_igc = igc_info
+                starts[self] = to_igc_fix(igc_info)
                 return WptStatus.ACTIVE
 
         else:
-            self.reset()
+            self.reset(starts)
         return WptStatus.MISSED
 
-    def reset(self):
-        self.start_igc = None
+    def reset(self, starts: dict = None):
+        (self._starts if starts is None else starts).pop(self, None)
 
 
 def waypoint_factory(wpt: WptDefinition, wpt_config) -> WptWrapper:
@@ -90,100 +103,273 @@ def waypoint_factory(wpt: WptDefinition, wpt_config) -> WptWrapper:
     return None
 
 
-class WaypointOptimizer:
-    def __init__(self, wpt_data: dict, wpt_config: dict):
+class CompetitionIndex:
+    """
+    Immutable part of the optimization table: the waypoint wrappers with their projections and the grid
+    of the cells their cylinders overlap. Build it once per competition and share it between the scorers
+    of every pilot, they only keep their own hits, removed waypoints and landing windows.
+
+    The distance counts are counted over every scorer sharing the index.
+    """
+
+    def __init__(self, wpt_data: dict, wpt_config: dict, wrapper_cells: dict = None):
+        """
+        :param wpt_data:
+        :param wpt_config:
+        :param wrapper_cells: waypoint name to grid cell keys from a compiled competition, skips the grid build
+        """
         self.wpt_data = wpt_data
         self.wpt_config = wpt_config
-        self.wpts_hit = OrderedDict()
-        self.long_wpts = defaultdict(set)
-        self.lat_wpts = defaultdict(set)
         self.precision_km = wpt_config['precision_km']
-        self.active_waypoints = set()
-        self.wpt_keys = defaultdict(list)
-        self._create_optimization_table()
+        self.projection_epsilon_km = wpt_config.get('projection_epsilon_km', PROJECTION_EPSILON_KM)
+        self.distance_counts = DistanceCounts()
+        self.grid = WaypointGrid(self.precision_km)
+        self.wrappers = {}
+        # Waypoint file order, breaks ties between waypoints hit on the same fix
+        self.wpt_order = {}
+        self._create_optimization_table(wrapper_cells)
 
-    def _create_optimization_table(self):
-        # Each decimal place 1.0 == 111km
+    def _create_optimization_table(self, wrapper_cells: dict = None):
+        # Grid cells are precision_km wide, each waypoint goes in every cell its cylinder overlaps
         for wpt in self.wpt_data.values():
             wrapper = waypoint_factory(wpt, self.wpt_config)
             if not wrapper:
                 continue
-            precision = numpy.abs(numpy.log10(self.precision_km / 111.0))
-            self.precision_decimal_place = int(numpy.ceil(precision))
-            precision_decimal_multiple = int(numpy.ceil(self.precision_km/111.0 * (10**self.precision_decimal_place)))
-            for i in range(0, precision_decimal_multiple + 1):
-                self._add_long_lat(wrapper, i)
-                if i > 0:
-                    self._add_long_lat(wrapper, -i)
-        print('Optimization table complete')
-
-    def _add_long_lat(self, wrapper, i):
-        lat = int(numpy.ceil(wrapper.get_wpt().latitude * (10 ** self.precision_decimal_place)) + i)
-        long = int(numpy.ceil(wrapper.get_wpt().longitude * (10 ** self.precision_decimal_place)) + i)
-        self.long_wpts[long].add(wrapper)
-        self.lat_wpts[lat].add(wrapper)
-        self.wpt_keys[wrapper].append((long, lat))
+            wrapper.distance = WptProjection(wpt, self.projection_epsilon_km, self.distance_counts)
+            if wrapper_cells is not None:
+                self.grid.add_cells(wrapper, wrapper_cells[wpt.name])
+            else:
+                lat_half, lon_half = wrapper.distance.bounds(self.wpt_config['cylinder_km'])
+                self.grid.add(wrapper, wpt.longitude, wpt.latitude, lat_half, lon_half)
+            self.wrappers[wpt.name] = wrapper
+            self.wpt_order[wrapper] = len(self.wpt_order)
+        # Waypoint centres in wpt_order, for the reachability check of WaypointOptimizer
+        self.wpt_ecef = ecef_km([wrapper.wpt.latitude for wrapper in self.wpt_order],
+                                [wrapper.wpt.longitude for wrapper in self.wpt_order]).reshape(-1, 3)
+        logger.info('Optimization table complete')
+
+
+class WaypointOptimizer:
+    def __init__(self, wpt_data: dict, wpt_config: dict, index: CompetitionIndex = None,
+                 metrics: ScoringMetrics = None):
+        self.wpt_data = wpt_data
+        self.wpt_config = wpt_config
+        self.index = index if index is not None else CompetitionIndex(wpt_data, wpt_config)
+        self.grid = self.index.grid
+        self.wrappers = self.index.wrappers
+        self.wpts_hit = OrderedDict()
+        # Tagged waypoints, the shared grid is never modified. dicts are used as ordered sets
+        self.removed = {}
+        self.land_starts = {}
+        # Latest fix time scored, a saved state can only be resumed with later tracks
+        self.last_timestamp = None
+        # dict used as an ordered set so waypoints are always assessed in the same order
+        self.active_waypoints = {}
+        # Optional upper bound of the pilot's ground speed, enables skipping fixes that cannot reach a waypoint
+        self.max_speed_kmh = wpt_config.get('max_speed_kmh')
+        self.skipped_fixes = 0
+        self._remaining = None
+        self.metrics = metrics if metrics is not None else default_metrics()
 
     def _remove_wpt(self, wpt_wrapper: WptWrapper):
-        list_long_lat = self.wpt_keys[wpt_wrapper]
-        for long, lat in list_long_lat:
-            self.long_wpts[long].remove(wpt_wrapper)
-            self.lat_wpts[lat].remove(wpt_wrapper)
+        self.removed[wpt_wrapper] = None
+        self._remaining = None
 
     def set_active(self, wpt):
-        self.active_waypoints.add(wpt)
+        self.active_waypoints[wpt] = None
 
     def check_igc_log(self, igc_info: IGCInfo):
-        long = int(numpy.ceil((10**self.precision_decimal_place)
-                              * igc_info.longitude))
-        near_wpts_long = set()
-        if long in self.long_wpts:
-            near_wpts_long = self.long_wpts[long]
-
-        lat = int(numpy.ceil((10**self.precision_decimal_place) * igc_info.latitude))
-        near_wpts_lat = set()
-        if lat in self.lat_wpts:
-            near_wpts_lat = self.lat_wpts[lat]
-
-        intersection = near_wpts_lat.intersection(near_wpts_long)
-        wpts_assess = intersection.union(self.active_waypoints)
+        self.last_timestamp = igc_info.timestamp
+        self._check_near_wpts(igc_info, self.grid.get(self.grid.key(igc_info.longitude, igc_info.latitude)))
+
+    def check_igc_track(self, track: IgcTrack):
+        """
+        Score a whole columnar track, only building a fix for the rows that have waypoints to assess
+        """
+        if not len(track):
+            return
+        metrics = self.metrics
+        if metrics is None:
+            self._check_igc_track(track, self._check_near_wpts)
+            return
+        counts = self.index.distance_counts
+        distance_checks = counts.bounds + counts.planar + counts.geodesic
+        geodesic_calls = counts.geodesic
+        skipped_fixes = self.skipped_fixes
+        distance_seconds = metrics.timings['distance']
+        start = perf_counter()
+        self._check_igc_track(track, self._timed_check_near_wpts)
+        # Everything but assessing the waypoints is spent finding them
+        metrics.add_time('index_lookup', perf_counter() - start - (metrics.timings['distance'] - distance_seconds))
+        cells = self.grid.cells
+        candidates = [len(cells.get(key, ())) for key in self.grid.keys(track.longitude, track.latitude).tolist()]
+        metrics.count('tracks')
+        metrics.count('fixes', len(track))
+        metrics.count('index_hits', len(candidates) - candidates.count(0))
+        metrics.count('candidate_waypoints', sum(candidates))
+        metrics.count('distance_checks', counts.bounds + counts.planar + counts.geodesic - distance_checks)
+        metrics.count('geodesic_calls', counts.geodesic - geodesic_calls)
+        metrics.count('skipped_fixes', self.skipped_fixes - skipped_fixes)
+
+    def _check_igc_track(self, track: IgcTrack, check_near_wpts):
+        last_timestamp = int(track.time.max())
+        if self.last_timestamp is None or last_timestamp > self.last_timestamp:
+            self.last_timestamp = last_timestamp
+        cells = self.grid.cells
+        keys = self.grid.keys(track.longitude, track.latitude).tolist()
+        if not self.max_speed_kmh or numpy.any(numpy.diff(track.time) < 0):
+            for i, key in enumerate(keys):
+                near_wpts = cells.get(key)
+                if not near_wpts and not self.active_waypoints:
+                    if self.land_starts:
+                        # Outside every cylinder, the landing windows in progress start over
+                        self.land_starts.clear()
+                    continue
+                check_near_wpts(track.fix(i), near_wpts)
+            return
+        next_check = 0
+        i = 0
+        while i < len(keys):
+            near_wpts = cells.get(keys[i])
+            if near_wpts or self.active_waypoints:
+                check_near_wpts(track.fix(i), near_wpts)
+            else:
+                if self.land_starts:
+                    self.land_starts.clear()
+                if i >= next_check:
+                    # Nothing to assess at this fix, skip the fixes too early to reach any remaining cylinder
+                    reachable = self._reachable_timestamp(track, i)
+                    skip_to = max(int(numpy.searchsorted(track.time, reachable, 'left')), i + 1)
+                    self.skipped_fixes += skip_to - i - 1
+                    if skip_to - i - 1 < REACHABILITY_MIN_SKIP:
+                        # Too close to a waypoint for the check to pay off, try again further on
+                        next_check = skip_to + REACHABILITY_MIN_SKIP
+                    i = skip_to
+                    continue
+            i += 1
+
+    def _reachable_timestamp(self, track: IgcTrack, i: int) -> float:
+        """
+        Earliest time the pilot at fix i can be inside the cylinder of a waypoint that is not tagged yet,
+        moving no faster than max_speed_kmh
+        """
+        if self._remaining is None:
+            removed = self.removed
+            self._remaining = self.index.wpt_ecef[[wpt not in removed for wpt in self.index.wpt_order]]
+        if not len(self._remaining):
+            return math.inf
+        # The chord to a waypoint is a lower bound of the geodesic
+        chord_squared = ((self._remaining - ecef_km(float(track.latitude[i]), float(track.longitude[i]))) ** 2).sum(1)
+        reach_km = math.sqrt(chord_squared.min()) - self.wpt_config['cylinder_km'] - ELLIPSOIDAL_MAX_ERROR_KM
+        if reach_km <= 0:
+            return -math.inf
+        return int(track.time[i]) + reach_km / self.max_speed_kmh * 3600
+
+    def _timed_check_near_wpts(self, igc_info, near_wpts):
+        start = perf_counter()
+        self._check_near_wpts(igc_info, near_wpts)
+        self.metrics.timings['distance'] += perf_counter() - start
+        self.metrics.counters['assessed_fixes'] += 1
+
+    def _check_near_wpts(self, igc_info, near_wpts):
+        # Copy, assessing a waypoint can remove it from the active waypoints
+        removed = self.removed
+        wpts_assess = [wpt for wpt in near_wpts if wpt not in removed] if near_wpts else []
+        for wpt in self.active_waypoints:
+            if not near_wpts or wpt not in near_wpts:
+                wpts_assess.append(wpt)
         for wpt in wpts_assess:
-            status = wpt.submit(igc_info)
+            status = wpt.submit(igc_info, self.land_starts)
             if status is WptStatus.SUCCESS:
-                if wpt in self.active_waypoints:
-                    self.active_waypoints.remove(wpt)
+                self.active_waypoints.pop(wpt, None)
+                wpt.reset(self.land_starts)
                 if not wpt.is_finish():
                     self._remove_wpt(wpt)
                 else:
                     if wpt.wpt.name in self.wpts_hit:
                         self.wpts_hit.pop(wpt.wpt.name)
-                self.wpts_hit[wpt.wpt.name] = ({'wpt_wrapper': wpt, 'igc_info': igc_info})
+                self.wpts_hit[wpt.wpt.name] = ({'wpt_wrapper': wpt, 'igc_info': to_igc_fix(igc_info)})
             elif status is WptStatus.ACTIVE:
-                self.active_waypoints.add(wpt)
+                self.active_waypoints[wpt] = None
             elif status is WptStatus.MISSED:
-                if wpt in self.active_waypoints:
-                    self.active_waypoints.remove(wpt)
+                self.active_waypoints.pop(wpt, None)
+
+    def get_distance_counts(self) -> dict:
+        """
+        Number of distance checks settled by the bounds box, the planar projection and the exact geodesic
+        """
+        return self.index.distance_counts.as_dict()
+
+    def get_skipped_fixes(self) -> int:
+        """
+        Number of fixes skipped because no untagged waypoint was reachable at max_speed_kmh
+        """
+        return self.skipped_fixes
+
+    def get_state(self) -> dict:
+        """
+        JSON serializable scoring state: the waypoints hit in order, the tagged waypoints no longer assessed,
+        the landing windows in progress and the last fix time scored
+        """
+        return {
+            'version': SCORING_STATE_VERSION,
+            'last_timestamp': self.last_timestamp,
+            'wpts_hit': [[name, hit['igc_info'].to_list()] for name, hit in self.wpts_hit.items()],
+            'removed': [wpt.wpt.name for wpt in self.removed],
+            'active': [wpt.wpt.name for wpt in self.active_waypoints],
+            'land_starts': {wpt.wpt.name: start_igc.to_list() for wpt, start_igc in self.land_starts.items()},
+        }
+
+    def load_state(self, state: dict):
+        """
+        Continue from a state saved by get_state with the same waypoints and config
+
+        :param state:
+        :return:
+        """
+        if state.get('version') != SCORING_STATE_VERSION:
+            raise ValueError('Unsupported scoring state version: {}'.format(state.get('version')))
+        self.last_timestamp = state['last_timestamp']
+        self.wpts_hit = OrderedDict()
+        for name, fix in state['wpts_hit']:
+            self.wpts_hit[name] = {'wpt_wrapper': self.wrappers[name], 'igc_info': IgcFix.from_list(fix)}
+        self.removed = {self.wrappers[name]: None for name in state['removed']}
+        self._remaining = None
+        self.active_waypoints = {self.wrappers[name]: None for name in state['active']}
+        self.land_starts = {self.wrappers[name]: IgcFix.from_list(fix)
+                            for name, fix in state['land_starts'].items()}
 
     def get_score_report(self) -> dict:
-        results = {}
-        start_pts = 0
-        if 'finish_penalty_pts' in self.wpt_config:
-            start_pts = int(self.wpt_config['finish_penalty_pts'])
-        total = start_pts
-        results['wpt_list'] = []
-        results['finish_time'] = None
-        wpts_hit = list(self.wpts_hit.values())
-        for wpt in wpts_hit:
-            total = total + wpt['wpt_wrapper'].wpt.pts
-
-            if wpt['wpt_wrapper'].is_finish():
-                if wpt == wpts_hit[-1]:
-                    total = total - start_pts
-                    results['finish_time'] = wpts_hit[-1]['igc_info'].time.strftime("%m/%d/%Y, %H:%M:%S")
-            else:
-                if wpt['wpt_wrapper'].wpt.pts != 0:
-                    print(wpt['igc_info'])
-                    results['wpt_list'].append({'wpt': wpt['wpt_wrapper'].wpt.name,
-                                                'time': wpt['igc_info'].time.strftime("%m/%d/%Y, %H:%M:%S")})
-        results['total'] = total
-        return results
+        return build_score_report(self.wpts_hit, self.wpt_config)
+
+
+def build_score_report(wpts_hit: OrderedDict, wpt_config: dict) -> dict:
+    """
+    Report of the waypoints hit in order, a FINISH hit last cancels the finish penalty
+
+    :param wpts_hit: waypoint name to {'wpt_wrapper', 'igc_info'}, in the order they were hit
+    :param wpt_config:
+    :return:
+    """
+    results = {}
+    start_pts = 0
+    if 'finish_penalty_pts' in wpt_config:
+        start_pts = int(wpt_config['finish_penalty_pts'])
+    total = start_pts
+    results['wpt_list'] = []
+    results['finish_time'] = None
+    wpts_hit = list(wpts_hit.values())
+    for wpt in wpts_hit:
+        total = total + wpt['wpt_wrapper'].wpt.pts
+
+        if wpt['wpt_wrapper'].is_finish():
+            if wpt == wpts_hit[-1]:
+                total = total - start_pts
+                results['finish_time'] = wpts_hit[-1]['igc_info'].time.strftime("%m/%d/%Y, %H:%M:%S")
+        else:
+            if wpt['wpt_wrapper'].wpt.pts != 0:
+                logger.debug(wpt['igc_info'])
+                results['wpt_list'].append({'wpt': wpt['wpt_wrapper'].wpt.name,
+                                            'time': wpt['igc_info'].time.strftime("%m/%d/%Y, %H:%M:%S")})
+    results['total'] = total
+    return results
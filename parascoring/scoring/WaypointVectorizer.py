@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from time import perf_counter
+
+import numpy
+
+from parascoring.scoring.Distance import within_distance
+from parascoring.scoring.IgcTrack import IgcTrack
+from parascoring.scoring.Instrumentation import ScoringMetrics, default_metrics
+from parascoring.scoring.Landing import find_landings
+from parascoring.scoring.WaypointOptimizer import CompetitionIndex, LandWpt, build_score_report
+
+
+class WaypointVectorizer:
+    """
+    Scores a whole columnar track per call instead of one fix at a time.
+
+    The waypoint grid gives the rows each waypoint could contain, the distance kernel turns them into an
+    in-cylinder mask per waypoint. A touch waypoint is hit on its first row inside the cylinder, a touch
+    FINISH on its last. Landing waypoints use find_landings over their in-cylinder rows, which gives the
+    landing times of the LandWpt state machine, reset whenever the pilot leaves the cylinder. Hits are
+    applied in row order, then waypoint file order, so the report matches WaypointOptimizer.
+    """
+
+    def __init__(self, wpt_data: dict, wpt_config: dict, index: CompetitionIndex = None,
+                 metrics: ScoringMetrics = None):
+        self.wpt_data = wpt_data
+        self.wpt_config = wpt_config
+        self.index = index if index is not None else CompetitionIndex(wpt_data, wpt_config)
+        self.grid = self.index.grid
+        self.wpts_hit = OrderedDict()
+        self.cylinder_km = wpt_config['cylinder_km']
+        # Tagged waypoints and landing windows in progress, the shared index is never modified
+        self.removed = set()
+        self.land_starts = {}
+        self.metrics = metrics if metrics is not None else default_metrics()
+
+    def _candidate_rows(self, track: IgcTrack) -> dict:
+        """
+        Rows of the track in a grid cell of each waypoint, one lookup per distinct cell
+        """
+        keys, cell_of_row = numpy.unique(self.grid.keys(track.longitude, track.latitude), return_inverse=True)
+        rows_by_cell = numpy.argsort(cell_of_row, kind='stable')
+        cell_starts = numpy.searchsorted(cell_of_row[rows_by_cell], numpy.arange(len(keys) + 1)).tolist()
+        cells = {}
+        for cell, key in enumerate(keys.tolist()):
+            for wrapper in self.grid.get(key) or ():
+                cells.setdefault(wrapper, []).append(cell)
+        candidates = {}
+        for wrapper, wrapper_cells in cells.items():
+            rows = [rows_by_cell[cell_starts[cell]:cell_starts[cell + 1]] for cell in wrapper_cells]
+            candidates[wrapper] = numpy.sort(numpy.concatenate(rows)) if len(rows) > 1 else numpy.sort(rows[0])
+        return candidates
+
+    def check_igc_track(self, track: IgcTrack):
+        if not len(track):
+            return
+        metrics = self.metrics
+        if metrics is not None:
+            start = perf_counter()
+        candidates = self._candidate_rows(track)
+        if metrics is not None:
+            metrics.add_time('index_lookup', perf_counter() - start)
+            start = perf_counter()
+            metrics.count('tracks')
+            metrics.count('fixes', len(track))
+            metrics.count('index_hits', len(numpy.unique(numpy.concatenate(list(candidates.values()))))
+                          if candidates else 0)
+            metrics.count('candidate_waypoints', sum(len(rows) for rows in candidates.values()))
+        self.land_starts = {wrapper: start_igc for wrapper, start_igc in self.land_starts.items()
+                            if wrapper in candidates}
+        hits = []
+        wpt_order = self.index.wpt_order
+        for wrapper, rows in candidates.items():
+            if wrapper in self.removed:
+                continue
+            wpt = wrapper.wpt
+            if metrics is not None:
+                metrics.count('distance_checks', len(rows))
+            inside = rows[within_distance(track.latitude[rows], track.longitude[rows],
+                                          wpt.latitude, wpt.longitude, self.cylinder_km)]
+            if isinstance(wrapper, LandWpt):
+                hit_rows = self._land_rows(wrapper, track, inside)
+            else:
+                hit_rows = inside.tolist()
+            if hit_rows:
+                hits.append((hit_rows[-1] if wrapper.is_finish() else hit_rows[0], wpt_order[wrapper], wrapper))
+        if metrics is not None:
+            metrics.add_time('distance', perf_counter() - start)
+        for row, _, wrapper in sorted(hits):
+            if not wrapper.is_finish():
+                self.removed.add(wrapper)
+            self.wpts_hit.pop(wrapper.wpt.name, None)
+            self.wpts_hit[wrapper.wpt.name] = {'wpt_wrapper': wrapper, 'igc_info': track.fix(row)}
+
+    def _land_rows(self, wrapper: LandWpt, track: IgcTrack, inside: numpy.ndarray) -> list:
+        """
+        Rows where the landing waypoint succeeds, the start fix carries over when the previous track
+        ended inside the cylinder and this one starts inside it
+        """
+        start = self.land_starts.pop(wrapper, None) if len(inside) and inside[0] == 0 else None
+        hit_rows, start = find_landings(track, inside, start, self.wpt_config['time_altitude_var_meters'],
+                                        self.wpt_config['distance_variance_meters'],
+                                        self.wpt_config['time_landed_min'] * 60, not wrapper.is_finish())
+        if len(inside) and inside[-1] == len(track) - 1:
+            self.land_starts[wrapper] = start
+        else:
+            self.land_starts.pop(wrapper, None)
+        return hit_rows
+
+    def get_score_report(self) -> dict:
+        return build_score_report(self.wpts_hit, self.wpt_config)
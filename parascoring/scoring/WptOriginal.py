@@ -1,17 +1,12 @@
 from dataclasses import dataclass
-from datetime import timedelta
-from enum import Enum
+from time import perf_counter
+from typing import Optional
 
-import numpy
-
-from parascoring.scoring.Utils import get_distance_from_lat_lon_in_km, WptType, WptDefinition
-from parascoring.scoring.IgcUtils import IGCInfo
-
-
-class WptStatus(Enum):
-    MISSED = 1
-    SUCCESS = 2
-    ACTIVE = 3
+from parascoring.scoring.Distance import GeodesicDistance, TrackDistance, GEODESIC_DISTANCE
+from parascoring.scoring.Utils import WptType, WptDefinition, WptStatus
+from parascoring.scoring.IgcUtils import IgcFix, to_igc_fix
+from parascoring.scoring.IgcTrack import IgcTrack
+from parascoring.scoring.Instrumentation import ScoringMetrics, default_metrics
 
 
 class TagWaypoints:
@@ -22,10 +17,9 @@ class TagWaypoints:
             if wpt.wpt_type == WptType.TOUCH:
                 self._wpt_list.append(wpt)
 
-    def submit(self, igc_info) -> WptDefinition:
+    def submit(self, igc_info, distance: GeodesicDistance = GEODESIC_DISTANCE) -> WptDefinition:
         for wpt in self._wpt_list:
-            if self._wpt_config['cylinder_km'] >= \
-                    get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude, wpt.latitude, wpt.longitude):
+            if distance.in_cylinder(igc_info, wpt, self._wpt_config['cylinder_km']):
                 self._wpt_list.remove(wpt)
                 return wpt
         return None
@@ -33,7 +27,7 @@ class TagWaypoints:
 
 @dataclass()
 class LandActiveWpt:
-    start_igc: IGCInfo
+    start_igc: IgcFix
     wpt: WptDefinition
 
     def __init__(self, wpt: WptDefinition):
@@ -48,32 +42,29 @@ class LandWaypoints:
     def __init__(self, wpt_data: dict, wpt_config: dict):
         self._wpt_list = []
         self._wpt_config = wpt_config
+        self._time_landed_seconds = wpt_config['time_landed_min'] * 60
         for wpt in wpt_data.values():
             if wpt.wpt_type == WptType.LAND:
                 self._wpt_list.append(LandActiveWpt(wpt=wpt))
 
-    def submit(self, igc_info) -> WptDefinition:
+    def submit(self, igc_info, distance: GeodesicDistance = GEODESIC_DISTANCE) -> WptDefinition:
         wpt_complete = None
         for wpt in self._wpt_list:
-            if self._wpt_config['cylinder_km'] >= \
-                    get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
-                                                    wpt.wpt.latitude, wpt.wpt.longitude):
+            if distance.in_cylinder(igc_info, wpt.wpt, self._wpt_config['cylinder_km']):
                 # If waypoint is active but was not in bounds and altitude is not constant reset start_time.
                 if not wpt.start_igc:
-                    wpt.start_igc = igc_info
+                    wpt.start_igc = to_igc_fix(igc_info)
                     continue
                 alt_variance = self._wpt_config['time_altitude_var_meters']
                 alt_gps_condition = \
-                    numpy.abs(wpt.start_igc.alt_gps - igc_info.alt_gps) <= alt_variance
-                distance = get_distance_from_lat_lon_in_km(igc_info.latitude, igc_info.longitude,
-                                                           wpt.start_igc.latitude, wpt.start_igc.longitude)
-                distance_condition = distance*1000 < self._wpt_config['distance_variance_meters']
-                if wpt.start_igc and alt_gps_condition and distance_condition:
-                    if (igc_info.time - wpt.start_igc.time) >= timedelta(minutes=self._wpt_config['time_landed_min']):
+                    abs(wpt.start_igc.alt_gps - igc_info.alt_gps) <= alt_variance
+                if wpt.start_igc and alt_gps_condition and \
+                        distance.within_drift(igc_info, wpt.start_igc, self._wpt_config['distance_variance_meters']):
+                    if (igc_info.timestamp - wpt.start_igc.timestamp) >= self._time_landed_seconds:
                         wpt_complete = wpt.wpt
                         self._wpt_list.remove(wpt)
                 else:
-                    wpt.start_igc = igc_info
+                    wpt.start_igc = to_igc_fix(igc_info)
 
             else:
                 wpt.reset()
@@ -82,17 +73,31 @@ class LandWaypoints:
 
 class WaypointCounter:
 
-    def __init__(self, wpt_data: dict, wpt_config: dict):
+    def __init__(self, wpt_data: dict, wpt_config: dict, metrics: Optional[ScoringMetrics] = None):
         self.wpt_data = wpt_data
         self.wpt_config = wpt_config
+        # Every check is a distance check, there is no index to time
+        self.metrics = metrics if metrics is not None else default_metrics()
         self.wpts_hit = []
         self.wpt_trackers = [TagWaypoints(wpt_data, wpt_config), LandWaypoints(wpt_data, wpt_config)]
 
-    def check_igc_log(self, igc_info):
+    def check_igc_log(self, igc_info, distance: GeodesicDistance = GEODESIC_DISTANCE):
         for tracker in self.wpt_trackers:
-            wpt = tracker.submit(igc_info)
+            wpt = tracker.submit(igc_info, distance)
             if wpt:
-                self.wpts_hit.append({'wpt': wpt, 'igc_info': igc_info})
+                self.wpts_hit.append({'wpt': wpt, 'igc_info': to_igc_fix(igc_info)})
+
+    def check_igc_track(self, track: IgcTrack):
+        track_distance = TrackDistance(track)
+        start = perf_counter()
+        for i, igc_info in enumerate(track.fixes()):
+            track_distance.index = i
+            self.check_igc_log(igc_info, track_distance)
+        if self.metrics is not None:
+            self.metrics.add_time('distance', perf_counter() - start)
+            self.metrics.count('tracks')
+            self.metrics.count('fixes', len(track))
+            self.metrics.count('distance_checks', track_distance.checks)
 
     def get_score_report(self) -> dict:
         results = {}
@@ -103,4 +108,21 @@ class WaypointCounter:
             results['wpt_list'].append({'wpt': wpt['wpt'].name,
                                         'time': wpt['igc_info'].time.strftime("%m/%d/%Y, %H:%M:%S")})
         results['total'] = total
-        return results
\ No newline at end of file
+        return results
+
+
+class ReferenceCounter(WaypointCounter):
+    """
+    WaypointCounter tagging every touch waypoint whose cylinder a fix is in, like the fast engines.
+
+    TagWaypoints gives a fix to the first touch waypoint of the competition file it is in, the others are tagged
+    on a later fix or never when the cylinders overlap. This is the only difference in the scoring of the fast
+    engines, which shadow mode compares with this counter.
+    """
+
+    def check_igc_log(self, igc_info, distance: GeodesicDistance = GEODESIC_DISTANCE):
+        for tracker in self.wpt_trackers:
+            wpt = tracker.submit(igc_info, distance)
+            while wpt:
+                self.wpts_hit.append({'wpt': wpt, 'igc_info': to_igc_fix(igc_info)})
+                wpt = tracker.submit(igc_info, distance) if isinstance(tracker, TagWaypoints) else None
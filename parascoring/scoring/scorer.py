@@ -1,47 +1,475 @@
+import copy
+import json
 import logging
-from typing import List
+import multiprocessing
+import os
+import random
+import threading
+import traceback
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
-from parascoring.scoring.IgcUtils import IGCParser, order_igc_files
-from parascoring.scoring.WaypointOptimizer import WaypointOptimizer
-from parascoring.scoring.WptOriginal import WaypointCounter
+import numpy
+
+from parascoring.scoring.IgcUtils import IgcFix, IgcSource, date_to_epoch, is_igc_path, order_igc_files
+from parascoring.scoring.IgcTrack import IgcTrack, parse_igc_track, order_igc_tracks, read_igc_track
+from parascoring.scoring.Instrumentation import ScoringMetrics, emit_metrics, stage
+from parascoring.scoring.WaypointOptimizer import CompetitionIndex, WaypointOptimizer
+from parascoring.scoring.WaypointVectorizer import WaypointVectorizer
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+ENGINES = {'optimized': WaypointOptimizer, 'vectorized': WaypointVectorizer}
+# Engines score_pilots and the *_with_metrics functions can run, the original one has no shared index
+PILOT_ENGINES = ('original',) + tuple(ENGINES)
+# Competition of a leaderboard worker process, built once by _init_worker
+_worker_competition = None
+# Set by set_shadow_mode
+_shadow_mode = None
+REPORT_TIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+
+def build_competition_index(wpt_file: dict, wpt_config: dict) -> CompetitionIndex:
+    """
+    Build the waypoint index once and pass it to the optimized or vectorized scoring of every pilot
+
+    :param wpt_file:
+    :param wpt_config:
+    :return:
+    """
+    return CompetitionIndex(wpt_file, wpt_config)
+
+
+def waypoint_counter(wpt_file: dict, wpt_config: dict, metrics: ScoringMetrics = None):
+    """
+    The original engine, only imported when it is used
+    """
+    from parascoring.scoring.WptOriginal import WaypointCounter
+    return WaypointCounter(wpt_file, wpt_config, metrics)
+
+
+def _engine(engine: str, wpt_file: dict, wpt_config: dict, index: Optional[CompetitionIndex],
+            metrics: Optional[ScoringMetrics]):
+    if engine == 'original':
+        return waypoint_counter(wpt_file, wpt_config, metrics)
+    return ENGINES[engine](wpt_file, wpt_config, index, metrics)
+
+
+def score_igcs(igc_list: List[IgcSource], wpt_file: dict, wpt_config: dict):
+    return _score_igcs(igc_list, waypoint_counter(wpt_file, wpt_config))
+
+
+def score_igcs_optimized(igc_list: List[IgcSource], wpt_file: dict, wpt_config: dict, index: CompetitionIndex = None):
+    return _score_igcs(igc_list, WaypointOptimizer(wpt_file, wpt_config, index))
+
+
+def score_igcs_vectorized(igc_list: List[IgcSource], wpt_file: dict, wpt_config: dict, index: CompetitionIndex = None):
+    return _score_igcs(igc_list, WaypointVectorizer(wpt_file, wpt_config, index))
+
+
+def score_igcs_with_metrics(igc_list: List[IgcSource], wpt_file: dict, wpt_config: dict,
+                            engine: str = 'optimized', index: CompetitionIndex = None) -> Tuple[dict, dict]:
+    """
+    Score IGC files and measure each stage, see ScoringMetrics
+
+    :param engine: key of PILOT_ENGINES
+    :return: score report and ScoringMetrics.as_dict()
+    """
+    metrics = ScoringMetrics()
+    score = _score_igcs(igc_list, _engine(engine, wpt_file, wpt_config, index, metrics))
+    return score, metrics.as_dict()
+
+
+def _score_igcs(igc_list: List[IgcSource], wpt_counter):
+    metrics = getattr(wpt_counter, 'metrics', None)
+    shadow = _sample_shadow(wpt_counter)
+    tracks = []
+    for igc in order_igc_files(igc_list, metrics):
+        if is_igc_path(igc):
+            logger.info('Using file: ' + str(igc))
+        track = score_igc(igc, wpt_counter)
+        if shadow is not None:
+            tracks.append(track)
+    score = _get_score_report(wpt_counter, metrics)
+    if shadow is not None:
+        shadow.submit(tracks, wpt_counter, score)
+    return score
+
 
-def score_igcs(igc_list: List[str], wpt_file: dict, wpt_config: dict):
-    return _score_igcs(igc_list, WaypointCounter(wpt_file, wpt_config))
+def score_igc_tracks(tracks: List[IgcTrack], wpt_file: dict, wpt_config: dict):
+    return _score_igc_tracks(tracks, waypoint_counter(wpt_file, wpt_config))
 
 
-def score_igcs_optimized(igc_list: List[str], wpt_file: dict, wpt_config: dict):
-    return _score_igcs(igc_list, WaypointOptimizer(wpt_file, wpt_config))
+def score_igc_tracks_optimized(tracks: List[IgcTrack], wpt_file: dict, wpt_config: dict,
+                               index: CompetitionIndex = None):
+    return _score_igc_tracks(tracks, WaypointOptimizer(wpt_file, wpt_config, index))
 
 
-def _score_igcs(igc_list: List[str], wpt_counter):
-    igc_list = order_igc_files(igc_list)
-    for file in igc_list:
-        logger.info('Using file: ' + file)
-        score_igc(file, wpt_counter)
-    return wpt_counter.get_score_report()
+def score_igc_tracks_vectorized(tracks: List[IgcTrack], wpt_file: dict, wpt_config: dict,
+                                index: CompetitionIndex = None):
+    return _score_igc_tracks(tracks, WaypointVectorizer(wpt_file, wpt_config, index))
 
 
-def score_igc(igc: str, wpt_counter):
+def score_igc_tracks_resumable(tracks: List[IgcTrack], wpt_file: dict, wpt_config: dict, state: dict = None,
+                               index: CompetitionIndex = None):
+    """
+    Score tracks continuing from a state saved after earlier tracks of the same pilot
+
+    :param tracks: the new tracks only when state is given, every one must start after the last fix scored
+    :param wpt_file:
+    :param wpt_config:
+    :param state: WaypointOptimizer.get_state() of the earlier tracks, or None to score from scratch
+    :param index: competition index shared between pilots, built from wpt_file and wpt_config when None
+    :return: score report and the state to save for the next call
+    """
+    wpt_counter = WaypointOptimizer(wpt_file, wpt_config, index)
+    if state is not None:
+        wpt_counter.load_state(state)
+        last_timestamp = wpt_counter.last_timestamp
+        if last_timestamp is not None and any(len(track) and int(track.time.min()) <= last_timestamp
+                                              for track in tracks):
+            raise ValueError('Tracks overlap the scored state, rescore all tracks')
+    # The reference engine cannot resume, only runs from scratch are shadowed
+    score = _score_igc_tracks(tracks, wpt_counter, shadow=state is None)
+    return score, wpt_counter.get_state()
+
+
+def score_igc_tracks_with_metrics(tracks: List[IgcTrack], wpt_file: dict, wpt_config: dict,
+                                  engine: str = 'optimized', index: CompetitionIndex = None) -> Tuple[dict, dict]:
+    """
+    Score parsed tracks and measure each stage, see ScoringMetrics
+
+    :param engine: key of PILOT_ENGINES
+    :return: score report and ScoringMetrics.as_dict()
+    """
+    metrics = ScoringMetrics()
+    score = _score_igc_tracks(tracks, _engine(engine, wpt_file, wpt_config, index, metrics))
+    return score, metrics.as_dict()
+
+
+def _score_igc_tracks(tracks: List[IgcTrack], wpt_counter, shadow: bool = True):
+    shadow = _sample_shadow(wpt_counter) if shadow else None
+    tracks = order_igc_tracks(tracks)
+    for track in tracks:
+        score_igc_track(track, wpt_counter)
+    score = _get_score_report(wpt_counter, getattr(wpt_counter, 'metrics', None))
+    if shadow is not None:
+        shadow.submit(tracks, wpt_counter, score)
+    return score
+
+
+def _get_score_report(wpt_counter, metrics: Optional[ScoringMetrics]):
+    with stage(metrics, 'report'):
+        score = wpt_counter.get_score_report()
+    emit_metrics(metrics)
+    return score
+
+
+def score_igc(igc: IgcSource, wpt_counter):
     """
     Take an igc file, a wpt file, and wpt, definitions and receive a score report
 
-    :param igc:
+    :param igc: path, bytes, file object or iterable of lines of the IGC file
     :param wpt_counter
-    :return:
+    :return: the track scored
     """
-    with open(igc, "r") as f:
-        _score_igc(f, wpt_counter)
+    metrics = getattr(wpt_counter, 'metrics', None)
+    with stage(metrics, 'parse'):
+        track = read_igc_track(igc)
+    if metrics is not None:
+        metrics.count('files')
+    score_igc_track(track, wpt_counter)
+    return track
+
+
+def score_igc_track(track: IgcTrack, wpt_counter):
+    wpt_counter.check_igc_track(track)
 
 
 def _score_igc(igc, wpt_counter):
-    igc_parser = IGCParser()
-    for x in igc:
-        igc_info = igc_parser.parse_igc_line(x)
-        if not igc_info:
-            continue
-        wpt_counter.check_igc_log(igc_info)
+    with stage(getattr(wpt_counter, 'metrics', None), 'parse'):
+        track = parse_igc_track(igc)
+    score_igc_track(track, wpt_counter)
+
+
+@dataclass()
+class PilotScore:
+    pilot: str
+    report: Optional[dict]
+    error: Optional[str] = None
+    # Wall time of the pilot in its worker
+    seconds: Optional[float] = None
+    # ScoringMetrics.as_dict() when score_pilots was asked for them
+    metrics: Optional[dict] = None
+
+
+def score_pilots(pilot_igcs: Dict[str, List[str]], wpt_file: dict, wpt_config: dict, processes: int = None,
+                 engine: str = 'optimized', metrics: bool = False) -> Iterator[PilotScore]:
+    """
+    Score every pilot of a competition across a process pool, yielding each pilot's score as it finishes.
+
+    The competition index is built once per worker. A pilot whose tracklogs fail to load or score is
+    yielded with the error instead of a report, the other pilots are not affected.
+
+    :param pilot_igcs: pilot to the paths of their IGC files
+    :param wpt_file:
+    :param wpt_config:
+    :param processes: worker processes, os.cpu_count() when None, 1 scores in this process
+    :param engine: key of PILOT_ENGINES
+    :param metrics: measure each pilot's stages
+    :return:
+    """
+    if engine not in PILOT_ENGINES:
+        raise ValueError('Unknown engine: ' + engine)
+    if processes == 1:
+        _init_worker(wpt_file, wpt_config, engine, metrics)
+        for pilot, igc_list in pilot_igcs.items():
+            yield _score_pilot(pilot, igc_list)
+        return
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(wpt_file, wpt_config, engine, metrics)) as executor:
+        futures = {executor.submit(_score_pilot, pilot, igc_list): pilot for pilot, igc_list in pilot_igcs.items()}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # The worker itself died, the pilot's own errors come back in PilotScore.error
+                yield PilotScore(futures[future], None, repr(e))
+
 
+def _init_worker(wpt_file: dict, wpt_config: dict, engine: str, metrics: bool = False):
+    global _worker_competition
+    index = CompetitionIndex(wpt_file, wpt_config) if engine in ENGINES else None
+    _worker_competition = (wpt_file, wpt_config, engine, index, metrics)
+
+
+def _score_pilot(pilot: str, igc_list: List[str]) -> PilotScore:
+    wpt_file, wpt_config, engine, index, with_metrics = _worker_competition
+    metrics = ScoringMetrics() if with_metrics else None
+    seconds = perf_counter()
+    try:
+        report = _score_igcs(igc_list, _engine(engine, wpt_file, wpt_config, index, metrics))
+    except Exception as e:
+        logger.exception('Unable to score pilot ' + pilot)
+        return PilotScore(pilot, None, repr(e), perf_counter() - seconds)
+    return PilotScore(pilot, report, None, perf_counter() - seconds,
+                      metrics.as_dict() if metrics is not None else None)
+
+
+def _run_in_process(sender, fn, args, kwargs):
+    try:
+        result = (True, fn(*args, **kwargs))
+    except BaseException:
+        # The exception itself may not pickle
+        result = (False, RuntimeError(traceback.format_exc()))
+    sender.send(result)
+    sender.close()
+
+
+def _receive_result(receiver, process, future: Future):
+    try:
+        succeeded, value = receiver.recv()
+    except EOFError:
+        process.join()
+        succeeded, value = False, RuntimeError('Process exited with code {}'.format(process.exitcode))
+    receiver.close()
+    process.join()
+    if succeeded:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+class SpawnExecutor(Executor):
+    """
+    Runs every call in a fresh interpreter started for it and waits for its result in a thread, which does not
+    hold the GIL.
+
+    Unlike ProcessPoolExecutor it needs no semaphores, which AWS Lambda cannot create for lack of /dev/shm.
+    The interpreter is spawned rather than forked, a fork while another thread holds a lock, e.g. of logging or of
+    a connection pool, can leave the child waiting on it forever.
+    """
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        future.set_running_or_notify_cancel()
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_in_process, args=(sender, fn, args, kwargs), daemon=True)
+        process.start()
+        sender.close()
+        threading.Thread(target=_receive_result, args=(receiver, process, future), daemon=True).start()
+        return future
+
+
+def shadow_executor() -> Executor:
+    """
+    A single spawned worker process so the comparisons do not compete for the GIL of the process returning scores,
+    a SpawnExecutor where a process pool cannot be created, e.g. in AWS Lambda
+    """
+    try:
+        return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    except OSError:
+        return SpawnExecutor()
+
+
+class ShadowMode:
+    """
+    Scores a sampled fraction of the runs of the fast engines again with the reference WaypointCounter in a
+    separate process and logs every run where the two disagree, see set_shadow_mode.
+
+    A mode set in one process does nothing in processes forked from it, e.g. the workers of score_pilots.
+    """
+
+    def __init__(self, fraction: float, executor: Executor = None, hook: Callable[[dict], None] = None,
+                 seed: int = None):
+        if not 0 <= fraction <= 1:
+            raise ValueError('Shadow fraction must be between 0 and 1: ' + str(fraction))
+        self.fraction = fraction
+        self.executor = executor if executor is not None else shadow_executor()
+        self.hook = hook
+        self.compared = 0
+        self.divergences = 0
+        self._random = random.Random(seed)
+        self._pid = os.getpid()
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def sample(self) -> bool:
+        with self._idle:
+            return os.getpid() == self._pid and self._random.random() < self.fraction
+
+    def submit(self, tracks: List[IgcTrack], wpt_counter, report: dict):
+        with self._idle:
+            self._pending += 1
+        # The caller may change its report once it is returned, e.g. the handler adds its bonuses
+        future = self.executor.submit(compare_with_reference, tracks, wpt_counter.wpt_data, wpt_counter.wpt_config,
+                                      copy.deepcopy(report), type(wpt_counter).__name__)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        try:
+            divergence = future.result()
+            if divergence is not None:
+                logger.warning('shadow_divergence ' + json.dumps(divergence))
+                if self.hook is not None:
+                    self.hook(divergence)
+        except Exception:
+            logger.exception('Shadow comparison failed')
+            divergence = None
+        with self._idle:
+            self.compared += 1
+            self.divergences += divergence is not None
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait for the comparisons submitted so far
+
+        :return: False when some are still running after timeout seconds
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+
+def set_shadow_mode(fraction: Optional[float], executor: Executor = None, hook: Callable[[dict], None] = None,
+                    seed: int = None) -> Optional[ShadowMode]:
+    """
+    Check a sampled fraction of the optimized and vectorized scoring runs against the reference engine.
+    The reference runs in executor, off the path returning the score. None or 0 turns it off.
+
+    :param fraction: of the scoring runs to compare
+    :param executor: shadow_executor() when None, a thread pool keeps the comparisons in this process
+    :param hook: called with every divergence after it is logged
+    :param seed: of the sampling
+    :return: the mode set
+    """
+    global _shadow_mode
+    _shadow_mode = ShadowMode(fraction, executor, hook, seed) if fraction else None
+    return _shadow_mode
+
+
+def get_shadow_mode() -> Optional[ShadowMode]:
+    return _shadow_mode
+
+
+def _sample_shadow(wpt_counter) -> Optional[ShadowMode]:
+    shadow = _shadow_mode
+    if shadow is None or not isinstance(wpt_counter, tuple(ENGINES.values())) or not shadow.sample():
+        return None
+    return shadow
+
+
+def compare_with_reference(tracks: List[IgcTrack], wpt_file: dict, wpt_config: dict, report: dict,
+                           engine: str = None) -> Optional[dict]:
+    """
+    Score tracks with the reference engine and diff its report with the report of a fast engine
+
+    :param tracks: ordered as they were scored
+    :param wpt_file:
+    :param wpt_config:
+    :param report: of the fast engine
+    :param engine: name of the fast engine, for the log
+    :return: None when they agree, see diff_reports
+    """
+    from parascoring.scoring.WptOriginal import ReferenceCounter
+    reference_counter = ReferenceCounter(wpt_file, wpt_config)
+    # Not a scoring run of its own for the metrics hook
+    reference_counter.metrics = None
+    reference = _score_igc_tracks(tracks, reference_counter, shadow=False)
+    divergence = diff_reports(report, reference, wpt_file)
+    if divergence is None:
+        return None
+    divergence['engine'] = engine
+    # The fix of the first hit, for the log
+    for hit in (divergence['hit'], divergence['reference_hit']):
+        if hit is not None:
+            fix = find_fix(tracks, hit['time'])
+            if fix is not None:
+                divergence['fix'] = {name: getattr(fix, name) for name in IgcFix.__slots__}
+                break
+    return divergence
+
+
+def diff_reports(report: dict, reference: dict, wpt_file: dict) -> Optional[dict]:
+    """
+    First waypoint, in time, where the scoring waypoints of a fast engine report and the reference report disagree.
+
+    The reference engine knows nothing of the finish, START, FINISH and waypoints without points are left
+    out of its list and the totals, which include the finish penalty, are not compared.
+    Hits at the same time may be listed in any order, the waypoints are compared rather than the lists.
+
+    :return: None when they agree, else the waypoint and the hit of each report, None when a report lacks it
+    """
+    expected = {hit['wpt']: hit for hit in reference['wpt_list']
+                if hit['wpt'] != 'FINISH' and wpt_file[hit['wpt']].pts != 0}
+    actual = {hit['wpt']: hit for hit in report['wpt_list']}
+    times = {}
+    for hit in report['wpt_list'] + reference['wpt_list']:
+        timestamp = _report_timestamp(hit['time'])
+        times[hit['wpt']] = min(timestamp, times.get(hit['wpt'], timestamp))
+    for name in sorted(set(actual) | set(expected), key=lambda name: (times[name], name)):
+        if actual.get(name) != expected.get(name):
+            return {'wpt': name, 'hit': actual.get(name), 'reference_hit': expected.get(name)}
+    return None
+
+
+def _report_timestamp(time: str) -> int:
+    return date_to_epoch(datetime.strptime(time, REPORT_TIME_FORMAT))
+
+
+def find_fix(tracks: List[IgcTrack], time: str) -> Optional[IgcFix]:
+    """
+    Fix of the tracks at a time of a score report
+    """
+    timestamp = _report_timestamp(time)
+    for track in tracks:
+        i = int(numpy.searchsorted(track.time, timestamp))
+        if i < len(track) and track.time[i] == timestamp:
+            return track.fix(i)
+    return None
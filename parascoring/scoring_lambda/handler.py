@@ -1,18 +1,50 @@
 import json
 import os
-import boto3 as boto3
+import time
 import uuid
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List
 
-import parascoring.scoring.Utils
-from parascoring.scoring import scorer as s
 import logging
-from botocore.exceptions import ClientError
 
-from parascoring.scoring.WaypointOptimizer import WaypointOptimizer
+from parascoring.scoring.Instrumentation import set_metrics_hook
+
+# boto3, botocore and the scoring modules, which need numpy, are imported by the functions using them: a cold start
+# answering a validation error pays for none of them, one answering "Still computing score" only for the table
+if TYPE_CHECKING:
+    from parascoring.scoring.CompetitionArtifact import Competition
+    from parascoring.scoring.IgcTrack import IgcTrack
+    from parascoring.scoring.TrackCache import TrackCache
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+TRACK_CACHE_DIR = os.environ.get('TRACK_CACHE_DIR', '/tmp/track-cache')
+# TrackCache.DEFAULT_MAX_BYTES when None
+TRACK_CACHE_MAX_BYTES = int(os.environ['TRACK_CACHE_MAX_BYTES']) if 'TRACK_CACHE_MAX_BYTES' in os.environ else None
+# Sub prefix of a pilot's upload folder, hidden from the tracklog listing by its '/' delimiter
+TRACK_STORE_PREFIX = '.parsed/'
+# Log the stage timings and counters of every scoring run, for a metric filter to pick up
+if os.environ.get('SCORING_METRICS') == 'log':
+    set_metrics_hook(lambda metrics: logger.info('scoring_metrics ' + json.dumps(metrics)))
+# Concurrent S3 requests of one invocation, the competition files and every tracklog share them
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 8))
+# Fraction of scoring runs checked against the reference engine in the background, see scorer.set_shadow_mode.
+# They run in a separate process, see scorer.SpawnExecutor; one still running when a response is returned is frozen
+# with the container until its next invocation and is lost if the container is not invoked again.
+SHADOW_FRACTION = float(os.environ.get('SCORING_SHADOW_FRACTION', 0))
+# Seconds a scoring request holds the lock of a pilot's record, past them another request may take it over.
+# Keep it above the function timeout.
+LEASE_SECONDS = int(os.environ.get('SCORING_LEASE_SECONDS', 900))
+
+
+def _scorer():
+    from parascoring.scoring import scorer
+    if SHADOW_FRACTION and scorer.get_shadow_mode() is None:
+        scorer.set_shadow_mode(SHADOW_FRACTION)
+    return scorer
+
 
 def _return_https(status_code, message):
     return {
@@ -28,6 +60,7 @@ def _return_https(status_code, message):
 
 def get_record_by_user(competition_id, user_id, dynamo=None):
     if not dynamo:
+        import boto3
         dynamo = boto3.resource('dynamodb').Table('SampleTable')
     response = dynamo.get_item(Key={"competition_name": competition_id, "person_id": user_id})
     if 'Item' in response:
@@ -35,67 +68,256 @@ def get_record_by_user(competition_id, user_id, dynamo=None):
     return None
 
 
+def new_stats():
+    return {
+        'total': 0,
+        'waypoints': [],
+        'finish_time': None,
+        'meta_info': None,
+        'tracklogs': [],
+    }
+
+
 class ActiveContextManager(object):
-    def __init__(self, competition_id, user_id, table):
+    """
+    Lease on the compute_active flag of a pilot's record, so one request at a time scores the pilot.
+
+    acquire() takes it in a single conditional update that also creates a missing record and returns it.
+    A lease held past lease_expires, e.g. by an invocation that timed out, is taken over. The final stats
+    write releases it, see BusinessHandler.update_stat_record, leaving the block any other way releases it
+    with one more update.
+    """
+
+    def __init__(self, competition_id, user_id, table, lease_seconds=None):
         self.competition_id = competition_id
         self.user_id = user_id
         self.table = table
+        self.lease_seconds = lease_seconds if lease_seconds is not None else LEASE_SECONDS
+        self.lease_id = uuid.uuid4().hex
+        self.held = False
 
-    def __enter__(self):
+    @property
+    def key(self):
+        return {"competition_name": self.competition_id, "person_id": self.user_id}
+
+    def acquire(self):
+        """
+        :return: the record, None when another request holds an unexpired lease
+        """
+        from botocore.exceptions import ClientError
         logger.info('Locking record')
-        response = self.table.update_item(
-            Key={"competition_name": self.competition_id, "person_id": self.user_id},
-            UpdateExpression="set compute_active=:r",
-            ExpressionAttributeValues={
-                ':r': True
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        logger.info('Locked response')
-        logger.info(response)
-        return True
+        now = int(time.time())
+        try:
+            response = self.table.update_item(
+                Key=self.key,
+                UpdateExpression="set compute_active=:t, lease_expires=:e, lease_id=:l, "
+                                 "stats=if_not_exists(stats, :s)",
+                # Records locked before leases existed have no lease_expires, they count as expired
+                ConditionExpression="attribute_not_exists(compute_active) OR compute_active = :f OR "
+                                    "attribute_not_exists(lease_expires) OR lease_expires < :n",
+                ExpressionAttributeValues={
+                    ':t': True,
+                    ':f': False,
+                    ':e': now + self.lease_seconds,
+                    ':n': now,
+                    ':l': self.lease_id,
+                    ':s': new_stats()
+                },
+                ReturnValues="ALL_NEW"
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.info('Record locked by another request')
+                return None
+            raise
+        self.held = True
+        logger.info('Locked record')
+        return response['Attributes']
 
-    def __exit__(self, type, value, traceback):
+    def release(self):
+        from botocore.exceptions import ClientError
         logger.info('Unlocking record')
-        response = self.table.update_item(
-            Key={"competition_name": self.competition_id, "person_id": self.user_id},
-            UpdateExpression="set compute_active=:r",
-            ExpressionAttributeValues={
-                ':r': False
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        logger.info('Unlocked response')
-        logger.info(response)
+        self.held = False
+        try:
+            self.table.update_item(
+                Key=self.key,
+                UpdateExpression="set compute_active=:f remove lease_expires, lease_id",
+                ConditionExpression="lease_id = :l",
+                ExpressionAttributeValues={
+                    ':f': False,
+                    ':l': self.lease_id
+                },
+                ReturnValues="NONE"
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.warning('Lease expired and was taken over before it was released')
+
+    def __enter__(self):
+        if not self.held and self.acquire() is None:
+            raise RuntimeError('Record is locked by another request')
         return True
 
+    def __exit__(self, type, value, traceback):
+        if self.held:
+            self.release()
+        return False
+
+
+class S3TrackStore(object):
+    """
+    Parsed track sidecars stored in the upload bucket next to the pilot's tracklogs
+    """
+
+    def __init__(self, s3_client, bucket, prefix):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+        from parascoring.scoring.TrackCache import CACHE_SUFFIX, track_from_bytes
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + key + CACHE_SUFFIX)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                logger.warning('Unable to read parsed track ' + key + ': ' + str(e))
+            return None
+        try:
+            return track_from_bytes(response['Body'].read())
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            # Truncated or foreign sidecar, parsing again overwrites it
+            logger.warning('Invalid parsed track ' + key + ': ' + str(e))
+            return None
+
+    def put(self, key, track: 'IgcTrack'):
+        from botocore.exceptions import ClientError
+        from parascoring.scoring.TrackCache import CACHE_SUFFIX, track_to_bytes
+        try:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + key + CACHE_SUFFIX,
+                                      Body=track_to_bytes(track))
+        except ClientError as e:
+            logger.warning('Unable to store parsed track ' + key + ': ' + str(e))
+
+
+def load_track(s3_client, bucket, track, track_cache: 'TrackCache', track_store: S3TrackStore) -> 'IgcTrack':
+    """
+    Load a listed tracklog from the local cache, then the bucket sidecar, and only parse the IGC on a miss
+
+    :param s3_client:
+    :param bucket:
+    :param track: entry of a list_objects_v2 response
+    :param track_cache:
+    :param track_store:
+    :return:
+    """
+    from parascoring.scoring.IgcTrack import read_igc_track
+    from parascoring.scoring.TrackCache import etag_key
+    key = etag_key(track['ETag'])
+    igc_track = track_cache.get(key)
+    if igc_track is not None:
+        return igc_track
+    igc_track = track_store.get(key)
+    if igc_track is None:
+        # Parsed straight from the response body, nothing is written to /tmp
+        response = s3_client.get_object(Bucket=bucket, Key=track['Key'])
+        igc_track = read_igc_track(response['Body'])
+        track_store.put(key, igc_track)
+    track_cache.put(key, igc_track)
+    return igc_track
+
+
+def fetch_tracks(executor: ThreadPoolExecutor, s3_client, bucket, tracks: List[dict], track_cache: 'TrackCache',
+                 track_store: S3TrackStore, futures: Dict[str, Future] = None) -> Dict[str, Future]:
+    """
+    Start loading the listed tracklogs that are not in futures yet, each one is parsed as soon as its object
+    arrives
+
+    :param executor:
+    :param s3_client:
+    :param bucket:
+    :param tracks: entries of a list_objects_v2 response
+    :param track_cache:
+    :param track_store:
+    :param futures: loads already started, by key
+    :return: futures of IgcTrack by key
+    """
+    futures = dict(futures or {})
+    for track in tracks:
+        if track['Key'] not in futures:
+            futures[track['Key']] = executor.submit(load_track, s3_client, bucket, track, track_cache, track_store)
+    return futures
+
+
+def load_competition_files(s3_client, bucket, competition_id) -> 'Competition':
+    """
+    Load the compiled competition artifact if one was uploaded and it was compiled from the current
+    competition.wpt and competition.json, otherwise parse them
+
+    :param s3_client:
+    :param bucket:
+    :param competition_id:
+    :return:
+    """
+    from parascoring.scoring.CompetitionArtifact import ARTIFACT_NAME, Competition, competition_hash, \
+        load_competition
+    from parascoring.scoring.Utils import parse_wpt_lines
+    from parascoring.scoring.WaypointOptimizer import CompetitionIndex
+    prefix = 'public/' + competition_id + '/'
+    # The source files are small, they are fetched with the artifact to tell whether it is stale
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        artifact_future = executor.submit(_get_competition_artifact, s3_client, bucket, prefix + ARTIFACT_NAME)
+        # Get Competition Waypoints
+        wpt_future = executor.submit(s3_client.get_object, Bucket=bucket, Key=prefix + 'competition.wpt')
+        # Get Competition Config
+        wpt_config_future = executor.submit(s3_client.get_object, Bucket=bucket, Key=prefix + 'competition.json')
+        wpt_bytes = wpt_future.result()['Body'].read()
+        wpt_config_dict = json.loads(wpt_config_future.result()['Body'].read())
+        artifact = artifact_future.result()
+    content_hash = competition_hash(wpt_bytes, wpt_config_dict)
+
+    if artifact is not None:
+        try:
+            competition = load_competition(artifact)
+        except (ValueError, KeyError, OSError, zipfile.BadZipFile) as e:
+            logger.warning('Invalid competition artifact: ' + str(e))
+        else:
+            if competition.content_hash == content_hash:
+                logger.info('Competition artifact loaded')
+                return competition
+            logger.warning('Competition artifact is stale, competition.wpt or competition.json changed since it '
+                           'was compiled')
+
+    wpt_dict = parse_wpt_lines(wpt_bytes.decode('utf-8').splitlines())
+    logger.info('Waypoint file parsed')
+    return Competition(wpt_dict, wpt_config_dict, CompetitionIndex(wpt_dict, wpt_config_dict), content_hash)
+
+
+def _get_competition_artifact(s3_client, bucket, key):
+    from botocore.exceptions import ClientError
+    try:
+        return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            logger.warning('Unable to read competition artifact: ' + str(e))
+        return None
+
 
 class BusinessHandler:
-    def __init__(self, event):
+    def __init__(self, event, table=None, s3_client=None):
         self._event = event
         self.competition_id = None
         self.user_id = None
-        self.table = boto3.resource('dynamodb').Table('SampleTable')
-
-    def get_record(self):
-        record = get_record_by_user(self.competition_id, self.user_id, self.table)
-        if not record:
-            record = {
-                'competition_name': self.competition_id,
-                'person_id': self.user_id,
-                'compute_active': False,
-                'stats': {
-                    'total': 0,
-                    'waypoints': [],
-                    'finish_time': None,
-                    'meta_info': None,
-                    'tracklogs': [],
-                }
-            }
-            response = self.table.put_item(
-                Item=record
-            )
-        return record
+        self._table = table
+        self.s3_client = s3_client
+
+    @property
+    def table(self):
+        if self._table is None:
+            import boto3
+            self._table = boto3.resource('dynamodb').Table('SampleTable')
+        return self._table
 
     def validate_event_handler(self, event):
         if 'compid' in event['pathParameters']:
@@ -118,18 +340,51 @@ class BusinessHandler:
                 return True
         return False
 
+    @staticmethod
+    def _load_scoring_state(record):
+        scoring_state = record['stats'].get('scoring_state')
+        if not scoring_state:
+            return None
+        return json.loads(scoring_state)
+
+    @staticmethod
+    def _get_saved_state(saved, competition, tracklogs):
+        """
+        Scoring state saved with the record, if it was scored against the same competition files and
+        every tracklog it covers is still listed unchanged
+        """
+        if saved is None:
+            return None
+        if saved.get('competition') != competition:
+            return None
+        etags = {item['Key']: item['ETag'] for item in tracklogs}
+        for key, etag in saved['tracklogs'].items():
+            if etags.get(key) != etag:
+                return None
+        return saved
+
     def handle_event(self):
         invalid = self.validate_event_handler(self._event)
         if invalid:
             return invalid
-        record = self.get_record()
-        if record['compute_active']:
+        # Creating a missing record, checking compute_active and locking it is one round trip
+        lease = ActiveContextManager(self.competition_id, self.user_id, self.table)
+        record = lease.acquire()
+        if record is None:
             return _return_https(200, "Still computing score")
+        s = _scorer()
+        from parascoring.scoring.TrackCache import TrackCache
         # Use with here
-        with ActiveContextManager(self.competition_id, self.user_id, self.table) as c:
-            s3_client = boto3.client('s3')
+        with lease as c, \
+                ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            s3_client = self.s3_client
+            if s3_client is None:
+                import boto3
+                s3_client = boto3.client('s3')
             key_dir = 'public/' + self.competition_id + '/' + self.user_id + '/'
             bucket = os.environ['STORAGE_S34FF28839_BUCKETNAME']
+            # The competition files do not depend on the listing, fetch them meanwhile
+            competition_future = executor.submit(load_competition_files, s3_client, bucket, self.competition_id)
             response = s3_client.list_objects_v2(
                 Bucket=bucket,
                 Delimiter='/',
@@ -137,44 +392,55 @@ class BusinessHandler:
             )
             logger.info('response')
             logger.info(response)
-            if response['KeyCount'] == 0:
+            tracks = response.get('Contents', [])
+            if not tracks:
                 return _return_https(400, "No uploaded tracks")
-            tracks = response['Contents']
-            logger.info(response['Contents'])
+            logger.info(tracks)
             isChanged = self._has_tracks_changed(record, tracks)
 
-            # Download all files
-            igc_files = []
-            for track in tracks:
-                key = track['Key']
-                tmpkey = key.replace('/', '')
-                download_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
-                igc_files.append(download_path)
-                s3_client.download_file(bucket, key, download_path)
-            logger.info('Using tracks' + str([track['Key'] for track in tracks]))
-            # Get Competition Waypoints
-            wpt_key = 'public/' + self.competition_id + '/competition.wpt'
-            tmpkey = wpt_key.replace('/', '')
-            wpt_file_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
-            s3_client.download_file(bucket, wpt_key, wpt_file_path)
-
-            # Get Competition Config
-            wpt_config = 'public/' + self.competition_id + '/competition.json'
-            tmpkey = wpt_config.replace('/', '')
-            wpt_config_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
-            s3_client.download_file(bucket, wpt_config, wpt_config_path)
-            with open(wpt_config_path) as f:
-                wpt_config_dict = json.load(f)
-            wpt_dict = parascoring.scoring.Utils.parse_wpt_file(wpt_file_path)
-            logger.info('Waypoint file parsed')
-            score = s.score_igcs_optimized(igc_files, wpt_dict, wpt_config_dict)
+            track_cache = TrackCache(TRACK_CACHE_DIR) if TRACK_CACHE_MAX_BYTES is None \
+                else TrackCache(TRACK_CACHE_DIR, TRACK_CACHE_MAX_BYTES)
+            track_store = S3TrackStore(s3_client, bucket, key_dir + TRACK_STORE_PREFIX)
+            # Tracklogs the saved state does not cover are scored whether or not it can be resumed
+            saved = self._load_scoring_state(record)
+            saved_tracklogs = saved['tracklogs'] if saved is not None else {}
+            futures = fetch_tracks(executor, s3_client, bucket,
+                                   [track for track in tracks if track['Key'] not in saved_tracklogs] if isChanged
+                                   else [], track_cache, track_store)
+
+            competition = competition_future.result()
+            wpt_dict = competition.wpt_data
+            wpt_config_dict = competition.wpt_config
+            saved = self._get_saved_state(saved, competition.content_hash, tracks)
+            score = None
+            if saved is not None:
+                # Only tracklogs uploaded since the saved state are downloaded and scored
+                new_tracks = [track for track in tracks if track['Key'] not in saved['tracklogs']] if isChanged else []
+                logger.info('Resuming with tracks' + str([track['Key'] for track in new_tracks]))
+                futures = fetch_tracks(executor, s3_client, bucket, new_tracks, track_cache, track_store, futures)
+                igc_tracks = [futures[track['Key']].result() for track in new_tracks]
+                try:
+                    score, state = s.score_igc_tracks_resumable(igc_tracks, wpt_dict, wpt_config_dict,
+                                                                saved['state'], competition.index)
+                except ValueError as e:
+                    logger.info('Full rescore: ' + str(e))
+            if score is None:
+                # Load all tracks, only tracklogs never seen before are downloaded and parsed
+                futures = fetch_tracks(executor, s3_client, bucket, tracks, track_cache, track_store, futures)
+                igc_tracks = [futures[track['Key']].result() for track in tracks]
+                logger.info('Using tracks' + str([track['Key'] for track in tracks]))
+                score, state = s.score_igc_tracks_resumable(igc_tracks, wpt_dict, wpt_config_dict,
+                                                            index=competition.index)
+            scoring_state = json.dumps({'competition': competition.content_hash,
+                                        'tracklogs': {track['Key']: track['ETag'] for track in tracks},
+                                        'state': state})
             meta = {}
             if 'night_checkpoint' in self._event['queryStringParameters']:
                 meta = {'night_checkpoint': self._event['queryStringParameters']['night_checkpoint'] == 'true'}
             if 'night_checkpoint' in meta and meta['night_checkpoint']:
                 score['total'] = score['total'] + 5
             score['tracklogs'] = [{'Key': track['Key']} for track in tracks]
-            if not self.update_stat_record(score, meta):
+            if not self.update_stat_record(score, meta, scoring_state, lease):
                 return {
                     'statusCode': 400,
                     'headers': {
@@ -194,25 +460,45 @@ class BusinessHandler:
                 'body': {'message': 'Success', 'record': json.dumps(score)}
             }
 
-    def update_stat_record(self, score, meta):
+    def update_stat_record(self, score, meta, scoring_state=None, lease: ActiveContextManager = None):
+        """
+        Write the score, releasing the lease in the same update when one is given
+
+        :return: None when the update failed, e.g. the lease expired and was taken over
+        """
+        from botocore.exceptions import ClientError
         logger.info('Updating stat record')
+        update_expression = "set stats.score=:t, stats.tracklogs=:r, stats.waypoints=:w, stats.finish_time=:f, " \
+                            "stats.meta_info=:i, stats.scoring_state=:s"
+        values = {
+            ':t': score['total'],
+            ':r': score['tracklogs'],
+            ':w': score['wpt_list'],
+            ':f': score['finish_time'],
+            ':i': meta,
+            ':s': scoring_state
+        }
+        condition = {}
+        if lease is not None:
+            update_expression += ", compute_active=:a remove lease_expires, lease_id"
+            values.update({':a': False, ':l': lease.lease_id})
+            condition['ConditionExpression'] = "lease_id = :l"
         try:
             response = self.table.update_item(
                 Key={"competition_name": self.competition_id, "person_id": self.user_id},
-                UpdateExpression=
-                "set stats.score=:t, stats.tracklogs=:r, stats.waypoints=:w, stats.finish_time=:f, stats.meta_info=:i",
-                ExpressionAttributeValues={
-                    ':t': score['total'],
-                    ':r': score['tracklogs'],
-                    ':w': score['wpt_list'],
-                    ':f': score['finish_time'],
-                    ':i': meta
-                },
-                ReturnValues="UPDATED_NEW"
+                UpdateExpression=update_expression,
+                ExpressionAttributeValues=values,
+                ReturnValues="UPDATED_NEW",
+                **condition
             )
         except ClientError as e:
-            print(e.response['Error']['Message'])
+            logger.error(e.response['Error']['Message'])
+            if lease is not None and e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                # Taken over by another request, nothing left to release
+                lease.held = False
             return None
+        if lease is not None:
+            lease.held = False
         logger.info(response)
         return response
 
@@ -0,0 +1,374 @@
+import json
+import math
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy
+
+from parascoring.scoring.Utils import WptDefinition, WptType, parse_wpt_lines
+
+# Synthetic competitions for the benchmarks and tests, kept with the scripts so it is never deployed with the handler
+
+METERS_PER_DEGREE = 111320.0
+DEFAULT_WPT_CONFIG = {'cylinder_km': 1.02, 'time_landed_min': 1, 'time_altitude_var_meters': 30,
+                      'distance_variance_meters': 10, 'precision_km': 2, 'finish_penalty_pts': -8}
+DEFAULT_START = datetime(year=2021, month=2, day=5, hour=20)
+DEFAULT_CENTRE = (-44.7, 169.1)
+HIKE_KMH = 4.0
+GLIDE_KMH = 35.0
+THERMAL_KMH = 30.0
+THERMAL_RADIUS_M = 80.0
+THERMAL_CLIMB_MS = 2.0
+HIKE_HOP_KM = 3.0
+GLIDE_HOP_KM = 10.0
+# Landing fixes wander this far around the landing spot, well inside distance_variance_meters
+LANDING_JITTER_M = 1.0
+# Resolution of IGC coordinates, a thousandth of a minute of latitude
+IGC_RESOLUTION_M = 1.86
+# landed: stays longer than time_landed_min
+# short: stays one sample less than time_landed_min
+# drift: creeps away, clearing distance_variance_meters plus jitter at 0.8 time_landed_min
+# altitude: steps by just over time_altitude_var_meters plus jitter every 0.8 time_landed_min
+# The misses stay narrow as long as sample_seconds is below 0.2 time_landed_min
+LANDING_KINDS = ('landed', 'short', 'drift', 'altitude')
+
+
+@dataclass()
+class SyntheticLanding:
+    wpt: str
+    kind: str
+    landed: bool
+    # First fix on the ground, seconds since the epoch
+    timestamp: int
+
+
+@dataclass()
+class SyntheticFlight:
+    # One IGC file per day
+    igc_files: List[bytes]
+    landings: List[SyntheticLanding] = field(default_factory=list)
+
+
+class TrackBuilder:
+    """
+    Appends flight segments sampled every sample_seconds to a track, up to max_fixes fixes.
+
+    Positions move on a local flat approximation, fine over the few km of one segment.
+    """
+
+    def __init__(self, lat: float, lon: float, alt: float, start: datetime, sample_seconds: int = 1,
+                 max_fixes: int = None, random: numpy.random.RandomState = None):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.start = start
+        self.sample_seconds = sample_seconds
+        self.max_fixes = max_fixes
+        self.random = random if random is not None else numpy.random.RandomState(0)
+        # Seconds since start of the last fix
+        self.seconds = 0
+        self.fixes = 0
+        self._chunks = []
+
+    def full(self) -> bool:
+        return self.max_fixes is not None and self.fixes >= self.max_fixes
+
+    def _append(self, count: int, lats, lons, alts) -> bool:
+        """
+        Add count fixes following the last one
+
+        :return: False when the track filled up before the last of them
+        """
+        lats, lons, alts = [numpy.broadcast_to(numpy.asarray(values, dtype=numpy.float64), (count,))
+                            for values in (lats, lons, alts)]
+        complete = True
+        if self.max_fixes is not None and self.fixes + count > self.max_fixes:
+            count = self.max_fixes - self.fixes
+            complete = False
+        if count <= 0:
+            return complete
+        seconds = self.seconds + self.sample_seconds * numpy.arange(1, count + 1)
+        lats, lons, alts = lats[:count], lons[:count], alts[:count]
+        self._chunks.append((seconds, lats, lons, alts))
+        self.seconds = int(seconds[-1])
+        self.lat, self.lon, self.alt = float(lats[-1]), float(lons[-1]), float(alts[-1])
+        self.fixes += count
+        return complete
+
+    def _meters(self, lat: float, lon: float):
+        north = (lat - self.lat) * METERS_PER_DEGREE
+        east = (lon - self.lon) * METERS_PER_DEGREE * math.cos(math.radians(self.lat))
+        return east, north
+
+    def _offset(self, east, north):
+        return (self.lat + numpy.asarray(north) / METERS_PER_DEGREE,
+                self.lon + numpy.asarray(east) / (METERS_PER_DEGREE * math.cos(math.radians(self.lat))))
+
+    def travel(self, lat: float, lon: float, speed_kmh: float, end_alt: float, skip_m: float = 0) -> bool:
+        """
+        Straight line to lat, lon at speed_kmh, the altitude changing linearly to end_alt
+
+        :param skip_m: no fixes over the first skip_m meters, the logger was off while packing up
+        """
+        east, north = self._meters(lat, lon)
+        distance = math.hypot(east, north)
+        count = max(1, int(math.ceil(distance / (speed_kmh / 3.6 * self.sample_seconds))))
+        fractions = numpy.arange(1, count + 1) / count
+        lats, lons = self._offset(east * fractions, north * fractions)
+        alts = self.alt + (end_alt - self.alt) * fractions
+        if skip_m > 0:
+            skipped = int(numpy.count_nonzero(fractions * distance < skip_m))
+            if skipped == count:
+                skipped = count - 1
+            self.seconds += skipped * self.sample_seconds
+            lats, lons, alts, count = lats[skipped:], lons[skipped:], alts[skipped:], count - skipped
+        return self._append(count, lats, lons, alts)
+
+    def hike(self, lat: float, lon: float, end_alt: float, skip_m: float = 0) -> bool:
+        return self.travel(lat, lon, HIKE_KMH, end_alt, skip_m)
+
+    def glide(self, lat: float, lon: float, end_alt: float) -> bool:
+        return self.travel(lat, lon, GLIDE_KMH, end_alt)
+
+    def thermal(self, seconds: int, climb_ms: float = THERMAL_CLIMB_MS, radius_m: float = THERMAL_RADIUS_M,
+                drift_ms: float = 1.0) -> bool:
+        """
+        Circles starting at the current position, climbing and drifting east with the wind
+        """
+        count = max(1, seconds // self.sample_seconds)
+        t = self.sample_seconds * numpy.arange(1, count + 1)
+        angle = t * (THERMAL_KMH / 3.6) / radius_m
+        lats, lons = self._offset(radius_m * numpy.sin(angle) + drift_ms * t, radius_m * (1 - numpy.cos(angle)))
+        return self._append(count, lats, lons, numpy.clip(self.alt + climb_ms * t, 0, 9999))
+
+    def land(self, seconds: int, ground_alt: float, drift_ms: float = 0.0, alt_step_m: float = 0.0,
+             alt_step_seconds: int = None) -> bool:
+        """
+        Stay on the ground for seconds after a first fix at the current position, on ground_alt. The last
+        fix before should be more than time_altitude_var_meters higher so the landing window starts here.
+
+        :param drift_ms: creep east at this speed
+        :param alt_step_m: climb this much every alt_step_seconds
+        """
+        count = seconds // self.sample_seconds + 1
+        t = self.sample_seconds * numpy.arange(count)
+        jitter = self.random.uniform(-LANDING_JITTER_M, LANDING_JITTER_M, (2, count))
+        lats, lons = self._offset(drift_ms * t + jitter[0], jitter[1])
+        alts = ground_alt + self.random.randint(-1, 2, count)
+        if alt_step_seconds:
+            alts = alts + alt_step_m * (t // alt_step_seconds)
+        return self._append(count, lats, lons, alts)
+
+    def timestamp(self) -> int:
+        """
+        Time of the last fix, seconds since the epoch
+        """
+        return int((self.start - datetime(year=1970, month=1, day=1)).total_seconds()) + self.seconds
+
+    def to_igc(self, pilot: str = 'Synthetic') -> bytes:
+        """
+        IGC file of the track, with a HFDTE header at the start and again whenever a fix is on a new day
+        """
+        lines = ['AXXX synthetic', 'HFDTE' + self.start.strftime('%d%m%y'), 'HFPLTPILOT:' + pilot,
+                 'HODTM100GPSDATUM: WGS-84']
+        if not self._chunks:
+            return ('\r\n'.join(lines) + '\r\n').encode()
+        seconds, lats, lons, alts = [numpy.concatenate(column) for column in zip(*self._chunks)]
+        start_of_day = self.start.hour * 3600 + self.start.minute * 60 + self.start.second
+        day_seconds = seconds + start_of_day
+        day = 0
+        alts = numpy.clip(numpy.round(alts), 0, 99999).astype(int).tolist()
+        for i, (fix_seconds, lat, lon) in enumerate(zip(day_seconds.tolist(), lats.tolist(), lons.tolist())):
+            if fix_seconds // 86400 != day:
+                day = fix_seconds // 86400
+                lines.append('HFDTE' + (self.start + timedelta(days=day)).strftime('%d%m%y'))
+            time_of_day = fix_seconds % 86400
+            lines.append('B{:02d}{:02d}{:02d}{}{}A{:05d}{:05d}'.format(
+                time_of_day // 3600, time_of_day // 60 % 60, time_of_day % 60, _igc_degrees(lat, 2, 'NS'),
+                _igc_degrees(lon, 3, 'EW'), max(alts[i] - 20, 0), alts[i]))
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def _igc_degrees(value: float, width: int, directions: str) -> str:
+    thousandths = int(round(abs(value) * 60000))
+    return '{:0{}d}{:05d}{}'.format(thousandths // 60000, width, thousandths % 60000,
+                                    directions[0] if value >= 0 else directions[1])
+
+
+def _wpt_degrees(value: float, directions: str) -> str:
+    hundredths = int(round(abs(value) * 360000))
+    return '{} {} {:02d} {:05.2f}'.format(directions[0] if value >= 0 else directions[1], hundredths // 360000,
+                                          hundredths // 6000 % 60, hundredths % 6000 / 100)
+
+
+def generate_wpt_lines(count: int, seed: int, centre=DEFAULT_CENTRE, radius_km: float = 50,
+                       land_fraction: float = 0.2, camp_fraction: float = 0.05) -> List[str]:
+    """
+    Lines of a .wpt file with START, FINISH and count scoring waypoints spread over a disc
+
+    :param count:
+    :param seed:
+    :param centre: latitude, longitude
+    :param radius_km:
+    :param land_fraction: share of landing waypoints
+    :param camp_fraction: share of camp waypoints
+    :return:
+    """
+    random = numpy.random.RandomState(seed)
+    distance = radius_km * 1000 * numpy.sqrt(random.uniform(0, 1, count + 2))
+    bearing = random.uniform(0, 2 * math.pi, count + 2)
+    lats = centre[0] + distance * numpy.cos(bearing) / METERS_PER_DEGREE
+    lons = centre[1] + distance * numpy.sin(bearing) / (METERS_PER_DEGREE * numpy.cos(numpy.radians(lats)))
+    msls = random.randint(200, 2500, count + 2)
+    kinds = random.uniform(0, 1, count)
+    pts = random.randint(1, 10, count)
+    names = ['START', 'FINISH']
+    for i in range(count):
+        kind = 'X' if kinds[i] < land_fraction else 'S' if kinds[i] < land_fraction + camp_fraction else ''
+        names.append('{}{}_W{:05d}'.format(pts[i], kind, i))
+    lines = ['$FormatGEO']
+    for name, lat, lon, msl in zip(names, lats.tolist(), lons.tolist(), msls.tolist()):
+        lines.append('{}    {}    {}  {}  '.format(name, _wpt_degrees(lat, 'NS'), _wpt_degrees(lon, 'EW'), msl))
+    return lines
+
+
+def generate_waypoints(count: int, seed: int, **kwargs) -> Dict[str, WptDefinition]:
+    """
+    Waypoints of generate_wpt_lines, as parse_wpt_file reads them back
+    """
+    return parse_wpt_lines(generate_wpt_lines(count, seed, **kwargs))
+
+
+def generate_flight(wpt_data: dict, wpt_config: dict, seed: int, days: int = 1, fixes_per_day: int = 20000,
+                    sample_seconds: int = 1, start: datetime = DEFAULT_START,
+                    landing_kinds=LANDING_KINDS) -> SyntheticFlight:
+    """
+    A pilot hiking to nearby waypoints, thermalling, gliding and now and then landing on a landing waypoint,
+    every landing of one of landing_kinds. Each day is a separate IGC file starting a day after the previous
+    one, from where the pilot camped.
+
+    Landing waypoints are only used once and only when no other landing cylinder overlaps theirs, so the
+    landings recorded are the only way they can be hit.
+
+    :param wpt_data: waypoints as parsed by parse_wpt_file
+    :param wpt_config:
+    :param seed:
+    :param days:
+    :param fixes_per_day:
+    :param sample_seconds:
+    :param start: time of the first fix
+    :param landing_kinds: of LANDING_KINDS
+    :return:
+    """
+    random = numpy.random.RandomState(seed)
+    wpts = list(wpt_data.values())
+    # WptDefinition keeps latitude in longitude, see parse_wpt_file
+    lats = numpy.array([wpt.longitude for wpt in wpts])
+    lons = numpy.array([wpt.latitude for wpt in wpts])
+    is_land = numpy.array([wpt.wpt_type is WptType.LAND for wpt in wpts])
+    landable = is_land & _isolated(lats, lons, is_land, 2 * wpt_config['cylinder_km'] * 1000)
+    time_landed_seconds = wpt_config['time_landed_min'] * 60
+    alt_variance = wpt_config['time_altitude_var_meters']
+    distance_variance = wpt_config['distance_variance_meters']
+
+    first = int(random.randint(len(wpts)))
+    lat, lon, alt = float(lats[first]), float(lons[first]), float(wpts[first].msl)
+    flight = SyntheticFlight([])
+    for day in range(days):
+        builder = TrackBuilder(lat, lon, alt, start + timedelta(days=day), sample_seconds, fixes_per_day, random)
+        skip_m = 0
+        while not builder.full():
+            target = _nearby(builder, lats, lons, ~is_land, HIKE_HOP_KM, random)
+            builder.hike(lats[target], lons[target], wpts[target].msl, skip_m)
+            skip_m = 0
+            builder.thermal(int(random.randint(120, 600)))
+            target = _nearby(builder, lats, lons, landable, GLIDE_HOP_KM, random) if random.uniform() < 0.5 else None
+            if target is None:
+                target = _nearby(builder, lats, lons, ~is_land, GLIDE_HOP_KM, random)
+                builder.glide(lats[target], lons[target], wpts[target].msl + 300)
+                continue
+            landable[target] = False
+            ground = wpts[target].msl
+            if not builder.glide(lats[target], lons[target], ground + alt_variance + 20):
+                break
+            kind = landing_kinds[int(random.randint(len(landing_kinds)))]
+            timestamp = builder.timestamp() + sample_seconds
+            if kind == 'landed':
+                complete = builder.land(time_landed_seconds + sample_seconds * int(random.randint(1, 240)), ground)
+            elif kind == 'short':
+                complete = builder.land(time_landed_seconds - sample_seconds, ground)
+            elif kind == 'drift':
+                drift_m = distance_variance + 3 * LANDING_JITTER_M + IGC_RESOLUTION_M
+                complete = builder.land(2 * time_landed_seconds, ground,
+                                        drift_ms=drift_m / (0.8 * time_landed_seconds))
+            elif kind == 'altitude':
+                complete = builder.land(2 * time_landed_seconds, ground, alt_step_m=alt_variance + 3,
+                                        alt_step_seconds=int(0.8 * time_landed_seconds))
+            else:
+                raise ValueError('Unknown landing kind: ' + kind)
+            if complete:
+                flight.landings.append(SyntheticLanding(wpts[target].name, kind, kind == 'landed', timestamp))
+            # The next fix is out of reach of the landing window
+            skip_m = 3 * distance_variance
+        flight.igc_files.append(builder.to_igc())
+        lat, lon, alt = builder.lat, builder.lon, builder.alt
+    return flight
+
+
+def _isolated(lats, lons, mask, distance_m):
+    """
+    Waypoints with no other waypoint of mask closer than distance_m
+    """
+    isolated = numpy.ones(len(lats), dtype=bool)
+    rows = numpy.flatnonzero(mask)
+    for i in range(len(lats)):
+        north = (lats[rows] - lats[i]) * METERS_PER_DEGREE
+        east = (lons[rows] - lons[i]) * METERS_PER_DEGREE * math.cos(math.radians(lats[i]))
+        isolated[i] = numpy.count_nonzero(numpy.hypot(east, north) < distance_m) <= (1 if mask[i] else 0)
+    return isolated
+
+
+def _nearby(builder: TrackBuilder, lats, lons, mask, hop_km: float, random) -> Optional[int]:
+    """
+    Random waypoint of mask within hop_km of the pilot, else the nearest one
+    """
+    rows = numpy.flatnonzero(mask)
+    if not len(rows):
+        return None
+    north = (lats[rows] - builder.lat) * METERS_PER_DEGREE
+    east = (lons[rows] - builder.lon) * METERS_PER_DEGREE * math.cos(math.radians(builder.lat))
+    distance = numpy.hypot(east, north)
+    near = rows[(distance < hop_km * 1000) & (distance > 100)]
+    if len(near):
+        return int(near[random.randint(len(near))])
+    return int(rows[numpy.argmin(distance)])
+
+
+def write_competition(directory: str, pilots: int = 10, days: int = 2, waypoints: int = 1000, seed: int = 0,
+                      sample_seconds: int = 1, fixes_per_day: int = 20000,
+                      wpt_config: dict = None) -> Dict[str, SyntheticFlight]:
+    """
+    Write competition.wpt, competition.json and a folder of daily IGC files per pilot, the layout the
+    handler reads from the bucket
+
+    :return: flight of each pilot folder
+    """
+    wpt_config = wpt_config if wpt_config is not None else DEFAULT_WPT_CONFIG
+    os.makedirs(directory, exist_ok=True)
+    wpt_lines = generate_wpt_lines(waypoints, seed)
+    with open(os.path.join(directory, 'competition.wpt'), 'w', newline='\r\n') as f:
+        f.write('\n'.join(wpt_lines) + '\n')
+    with open(os.path.join(directory, 'competition.json'), 'w') as f:
+        json.dump(wpt_config, f)
+    wpt_data = parse_wpt_lines(wpt_lines)
+    flights = {}
+    for i in range(pilots):
+        pilot = 'pilot{:03d}'.format(i)
+        flights[pilot] = generate_flight(wpt_data, wpt_config, seed + 1 + i, days, fixes_per_day, sample_seconds)
+        os.makedirs(os.path.join(directory, pilot), exist_ok=True)
+        for day, igc in enumerate(flights[pilot].igc_files):
+            with open(os.path.join(directory, pilot, 'day{}.igc'.format(day + 1)), 'wb') as f:
+                f.write(igc)
+    return flights
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARK_VERSION = 1
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Milliseconds of a fresh interpreter importing the handler and answering its first request
+BUDGETS_MS = {'import': 100, 'validation': 100, 'still_computing': 100, 'first_score': 3000}
+STAGES = list(BUDGETS_MS)
+# Reported when loaded by the end of a stage
+HEAVY_MODULES = ['boto3', 'botocore', 'numpy', 'geopy', 'parascoring.scoring.scorer', 'parascoring.scoring.WptOriginal']
+COMPETITION = 'COMP'
+PILOT = 'pilot000'
+
+
+def child(stage: str, root: str):
+    """
+    Run in a fresh interpreter: import the handler, answer one request of stage and print the timings
+    """
+    os.environ['STORAGE_S34FF28839_BUCKETNAME'] = 'bucket'
+    os.environ['TRACK_CACHE_DIR'] = os.path.join(root, 'track-cache')
+    start = time.perf_counter()
+    from parascoring.scoring_lambda import handler
+    import_seconds = time.perf_counter() - start
+    request_seconds = 0.0
+    if stage != 'import':
+        from LocalAws import DirectoryS3, MemoryTable
+        import logging
+        logging.disable(logging.INFO)
+        table = MemoryTable()
+        event = {'pathParameters': {'compid': COMPETITION}, 'queryStringParameters': {'userid': PILOT}}
+        if stage == 'validation':
+            event = {'pathParameters': {}, 'queryStringParameters': {}}
+        elif stage == 'still_computing':
+            table.put_item({'competition_name': COMPETITION, 'person_id': PILOT, 'compute_active': True,
+                            'stats': {}, 'lease_expires': int(time.time()) + 60, 'lease_id': 'benchmark'})
+        start = time.perf_counter()
+        response = handler.BusinessHandler(event, table, DirectoryS3(root)).handle_event()
+        request_seconds = time.perf_counter() - start
+        expected = 400 if stage == 'validation' else 200
+        if response['statusCode'] != expected or \
+                (stage == 'still_computing') != ('Still computing score' in str(response['body'])):
+            raise RuntimeError('{} answered {}'.format(stage, response))
+    print(json.dumps({'import_seconds': import_seconds, 'request_seconds': request_seconds,
+                      'modules': [module for module in HEAVY_MODULES if module in sys.modules]}))
+
+
+def run_child(stage: str, root: str) -> dict:
+    # Parsed tracks stored by an earlier run would make the first request warm
+    shutil.rmtree(os.path.join(root, 'bucket', 'public', COMPETITION, PILOT, '.parsed'), ignore_errors=True)
+    shutil.rmtree(os.path.join(root, 'track-cache'), ignore_errors=True)
+    # LocalAws lives with the tests, out of the deployed package
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, 'test'),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, root], env=env,
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start of the scoring Lambda handler in fresh '
+                                                 'interpreters against its budgets, and write the results as JSON.')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per stage, the best is kept')
+    parser.add_argument('--fixes', type=int, default=20000, help='fixes of the synthetic track of first_score')
+    parser.add_argument('--waypoints', type=int, default=1000)
+    parser.add_argument('--budget', action='append', default=[], metavar='STAGE=MS',
+                        help='override a budget, of ' + ', '.join('{}={}'.format(*item) for item in BUDGETS_MS.items()))
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+    budgets = dict(BUDGETS_MS)
+    for budget in args.budget:
+        stage, _, milliseconds = budget.partition('=')
+        if stage not in budgets:
+            parser.error('Unknown stage: ' + stage)
+        budgets[stage] = float(milliseconds)
+
+    from TrackGenerator import write_competition
+    root = tempfile.mkdtemp()
+    try:
+        write_competition(os.path.join(root, 'bucket', 'public', COMPETITION), pilots=1, days=1,
+                          waypoints=args.waypoints, fixes_per_day=args.fixes)
+        results = []
+        over_budget = 0
+        for stage in STAGES:
+            runs = [run_child(stage, root) for _ in range(args.repeat)]
+            best = min(runs, key=lambda run: run['import_seconds'] + run['request_seconds'])
+            milliseconds = (best['import_seconds'] + best['request_seconds']) * 1000
+            over = milliseconds > budgets[stage]
+            over_budget += over
+            results.append({'stage': stage, 'import_ms': best['import_seconds'] * 1000,
+                            'request_ms': best['request_seconds'] * 1000, 'total_ms': milliseconds,
+                            'budget_ms': budgets[stage], 'modules': best['modules']})
+            print('{:16} {:8.1f} ms of {:8.1f} ms{} {}'.format(stage, milliseconds, budgets[stage],
+                                                              ' OVER BUDGET' if over else '',
+                                                              ' '.join(best['modules'])), file=sys.stderr)
+    finally:
+        shutil.rmtree(root)
+
+    output = {
+        'version': BENCHMARK_VERSION,
+        'created': datetime.utcnow().isoformat(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key != 'child'},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy
+
+from parascoring.scoring.IgcTrack import parse_igc_bytes
+from parascoring.scoring.Utils import parse_wpt_file
+from parascoring.scoring.WaypointOptimizer import CompetitionIndex, WaypointOptimizer
+from parascoring.scoring.WaypointVectorizer import WaypointVectorizer
+from parascoring.scoring.WptOriginal import WaypointCounter
+from parascoring.scoring.scorer import _score_igc_tracks
+
+from TrackGenerator import generate_flight, generate_waypoints
+
+BENCHMARK_VERSION = 2
+WPT_CONFIG = {'cylinder_km': 1.02, 'time_landed_min': 1, 'time_altitude_var_meters': 30,
+              'distance_variance_meters': 10, 'precision_km': 2, 'finish_penalty_pts': 0}
+ENGINES = {'original': WaypointCounter, 'optimized': WaypointOptimizer, 'vectorized': WaypointVectorizer}
+
+
+def measure(function, repeat: int):
+    """
+    Best wall time of repeat runs, then one more run under tracemalloc for the peak memory
+
+    :return: (result, seconds, peak bytes)
+    """
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def synthetic_igc(wpt_data: dict, fixes: int, args) -> bytes:
+    """
+    One day of a pilot hiking, flying and landing between the waypoints, see TrackGenerator
+    """
+    flight = generate_flight(wpt_data, WPT_CONFIG, args.seed, days=1, fixes_per_day=fixes,
+                             sample_seconds=args.sample_seconds)
+    return flight.igc_files[0]
+
+
+def bench_case(results: list, suite: str, case: str, igc_bytes: bytes, wpt_data: dict, args):
+    track, seconds, peak = measure(lambda: parse_igc_bytes(igc_bytes), args.repeat)
+    fixes = len(track)
+    base = {'suite': suite, 'case': case, 'fixes': fixes, 'waypoints': len(wpt_data)}
+    results.append(dict(base, stage='parse', engine=None, seconds=seconds,
+                        fixes_per_second=fixes / seconds if seconds else None, peak_bytes=peak))
+    index, seconds, peak = measure(lambda: CompetitionIndex(wpt_data, WPT_CONFIG), args.repeat)
+    results.append(dict(base, stage='index', engine=None, seconds=seconds, fixes_per_second=None, peak_bytes=peak))
+    for engine in args.engines:
+        if engine == 'original' and fixes * len(wpt_data) > args.max_original_checks:
+            continue
+        if engine == 'original':
+            score = lambda: _score_igc_tracks([track], WaypointCounter(wpt_data, WPT_CONFIG))
+        else:
+            score = lambda: _score_igc_tracks([track], ENGINES[engine](wpt_data, WPT_CONFIG, index))
+        _, seconds, peak = measure(score, args.repeat)
+        results.append(dict(base, stage='score', engine=engine, seconds=seconds,
+                            fixes_per_second=fixes / seconds if seconds else None, peak_bytes=peak))
+        print('{:9} {:28} {:>8} fixes {:>6} wpts {:10} {:9.4f} s {:12.0f} fixes/s'.format(
+            suite, case, fixes, len(wpt_data), engine, seconds, fixes / seconds), file=sys.stderr)
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> int:
+    """
+    Print the speed of every result against the same case of a baseline run
+
+    :return: number of results slower than the baseline by more than tolerance
+    """
+    with open(baseline_path) as f:
+        baseline = {_result_key(result): result for result in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        before = baseline.get(_result_key(result))
+        if before is None or not before['seconds']:
+            continue
+        ratio = result['seconds'] / before['seconds']
+        slower = ratio > 1 + tolerance
+        regressions += slower
+        print('{} {:.2f}x{}'.format(' '.join(str(part) for part in _result_key(result)), ratio,
+                                    ' REGRESSION' if slower else ''))
+    return regressions
+
+
+def _result_key(result):
+    return result['suite'], result['case'], result['stage'], result['engine']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing and scoring over the resource files and '
+                                                 'synthetic tracks, and write the results as JSON.')
+    parser.add_argument('--resources', default=os.path.join(os.path.dirname(__file__), '..', 'test', 'resources'),
+                        help='directory of IGC files and WanakaHikeFly2.wpt, empty to skip them')
+    parser.add_argument('--fixes', default='1000,10000,100000,1000000',
+                        help='track lengths of the track sweep, with --sweep-waypoints waypoints')
+    parser.add_argument('--waypoints', default='10,100,1000,10000',
+                        help='waypoint counts of the waypoint sweep, with --sweep-fixes fixes')
+    parser.add_argument('--sweep-fixes', type=int, default=100000)
+    parser.add_argument('--sweep-waypoints', type=int, default=100)
+    parser.add_argument('--engines', default=','.join(ENGINES), help='comma separated, of ' + ', '.join(ENGINES))
+    parser.add_argument('--max-original-checks', type=float, default=2e6,
+                        help='skip the original engine when fixes * waypoints is larger')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is kept')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sample-seconds', type=int, default=1, help='fix interval of the synthetic tracks')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against --compare')
+    args = parser.parse_args()
+    args.engines = args.engines.split(',')
+    for engine in args.engines:
+        if engine not in ENGINES:
+            parser.error('Unknown engine: ' + engine)
+    logging.disable(logging.INFO)
+
+    results = []
+    if args.resources:
+        wpt_data = parse_wpt_file(os.path.join(args.resources, 'WanakaHikeFly2.wpt'))
+        for igc_file in sorted(glob.glob(os.path.join(args.resources, '*.[iI][gG][cC]'))):
+            with open(igc_file, "rb") as f:
+                bench_case(results, 'resources', os.path.basename(igc_file), f.read(), wpt_data, args)
+    sweep_wpts = generate_waypoints(args.sweep_waypoints, args.seed)
+    for fixes in [int(value) for value in args.fixes.split(',')]:
+        bench_case(results, 'fixes', str(fixes), synthetic_igc(sweep_wpts, fixes, args), sweep_wpts, args)
+    sweep_igc = synthetic_igc(sweep_wpts, args.sweep_fixes, args)
+    for waypoints in [int(value) for value in args.waypoints.split(',')]:
+        bench_case(results, 'waypoints', str(waypoints), sweep_igc, generate_waypoints(waypoints, args.seed), args)
+
+    output = {
+        'version': BENCHMARK_VERSION,
+        'created': datetime.utcnow().isoformat(),
+        'environment': {'python': platform.python_version(), 'numpy': numpy.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'config': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -0,0 +1,25 @@
+import argparse
+import json
+
+from parascoring.scoring.CompetitionArtifact import ARTIFACT_NAME, compile_competition
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a WPT file and competition config into one artifact.')
+    parser.add_argument('wpt', help='competition .wpt file')
+    parser.add_argument('config', help='competition.json file')
+    parser.add_argument('-o', '--output', default=ARTIFACT_NAME,
+                        help='artifact path, upload it next to the wpt file. The handler ignores it once either '
+                             'file changes, compile it again after edits')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        wpt_config = json.load(f)
+    data = compile_competition(args.wpt, wpt_config)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print('Wrote {} ({} bytes)'.format(args.output, len(data)))
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
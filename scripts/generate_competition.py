@@ -0,0 +1,27 @@
+import argparse
+
+from TrackGenerator import write_competition
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic competition: a wpt file, competition.json and '
+                                                 'a folder of daily IGC files per pilot.')
+    parser.add_argument('directory', help='output directory, laid out like a competition in the bucket')
+    parser.add_argument('--pilots', type=int, default=10)
+    parser.add_argument('--days', type=int, default=2, help='IGC files per pilot')
+    parser.add_argument('--waypoints', type=int, default=1000)
+    parser.add_argument('--fixes-per-day', type=int, default=20000)
+    parser.add_argument('--sample-seconds', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    flights = write_competition(args.directory, args.pilots, args.days, args.waypoints, args.seed,
+                                args.sample_seconds, args.fixes_per_day)
+    for pilot, flight in sorted(flights.items()):
+        landed = [landing.wpt for landing in flight.landings if landing.landed]
+        print('{} {} files, {} landings, landed at {}'.format(pilot, len(flight.igc_files), len(flight.landings),
+                                                              ', '.join(landed) or 'none'))
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -1,20 +1,96 @@
-import configargparse
-from scoring import scorer
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+
+from parascoring.scoring import scorer
+from parascoring.scoring.Utils import parse_wpt_file
+
+IGC_EXTENSION = '.igc'
+
+
+def find_pilot_igcs(directory: str) -> dict:
+    """
+    IGC files of every pilot folder of directory, a pilot's files can be nested in further folders
+
+    :param directory:
+    :return: pilot folder name to its IGC file paths
+    """
+    pilot_igcs = {}
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.is_dir():
+            continue
+        igc_files = []
+        for root, _, files in os.walk(entry.path):
+            igc_files.extend(os.path.join(root, name) for name in files if name.lower().endswith(IGC_EXTENSION))
+        if igc_files:
+            pilot_igcs[entry.name] = sorted(igc_files)
+    return pilot_igcs
+
+
+def pilot_line(score: scorer.PilotScore, timings: bool) -> dict:
+    line = {'pilot': score.pilot}
+    if score.error is None:
+        line.update(score.report)
+    else:
+        line['error'] = score.error
+    if timings:
+        line['seconds'] = score.seconds
+        line['metrics'] = score.metrics
+    return line
 
 
 def main():
-    print("Scoring IGC file")
-    parser = configargparse.ArgumentParser(description='Score the IGC file against a WPT file.')
-    parser.add('-c', '--config', required=True, is_config_file=True, help='config file path')
-    parser.add_argument('IGC File', type=str, nargs='+', dest='igc',
-                        help='an integer for the accumulator')
-    parser.add('vcf', nargs='+', help='variant file(s)')
+    parser = argparse.ArgumentParser(description='Score every pilot folder of a competition against a WPT file, '
+                                                 'writing one JSON line per pilot as it finishes.')
+    parser.add_argument('wpt', help='competition .wpt file')
+    parser.add_argument('config', help='competition.json file')
+    parser.add_argument('pilots', help='directory with a folder of IGC files per pilot')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='worker processes, 1 scores in this process (default: %(default)s)')
+    parser.add_argument('-e', '--engine', default='optimized', choices=sorted(scorer.PILOT_ENGINES),
+                        help='original is WaypointCounter, optimized WaypointOptimizer and vectorized '
+                             'WaypointVectorizer (default: %(default)s)')
+    parser.add_argument('-t', '--timings', action='store_true',
+                        help='add the seconds and stage metrics of each pilot, and a summary on stderr')
+    parser.add_argument('-o', '--output', help='write the JSON lines to this file instead of stdout')
     args = parser.parse_args()
-    score_report = s.(args.igc)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    logging.disable(logging.INFO)
+
+    with open(args.config) as f:
+        wpt_config = json.load(f)
+    wpt_file = parse_wpt_file(args.wpt)
+    pilot_igcs = find_pilot_igcs(args.pilots)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    seconds = time.perf_counter()
+    errors = 0
+    stage_totals = defaultdict(float)
+    try:
+        for score in scorer.score_pilots(pilot_igcs, wpt_file, wpt_config, args.jobs, args.engine, args.timings):
+            errors += score.error is not None
+            if score.metrics is not None:
+                for name, value in score.metrics['timings'].items():
+                    stage_totals[name] += value
+            output.write(json.dumps(pilot_line(score, args.timings)) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    seconds = time.perf_counter() - seconds
+    print('Scored {} pilots in {:.2f} s with {} jobs, {} failed'.format(len(pilot_igcs), seconds, args.jobs, errors),
+          file=sys.stderr)
+    if args.timings:
+        for name, value in sorted(stage_totals.items(), key=lambda item: -item[1]):
+            print('{:12} {:9.3f} s'.format(name, value), file=sys.stderr)
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     # execute only if run as a script
     main()
-
-
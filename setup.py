@@ -10,6 +10,5 @@ setup(name='HikeFlyScoring',
       packages=['parascoring/scoring', 'parascoring/scoring_lambda'],
       package_dir={'scoring': 'parascoring/scoring', 'scoring_lambda': 'parascoring/scoring_lambda'},
       requires=[
-          'numpy',
-          'configargparse'
+          'numpy'
         ])
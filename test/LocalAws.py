@@ -0,0 +1,178 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+# Stand-ins for the S3 client and DynamoDB table of the scoring Lambda, for its tests and benchmarks.
+# Kept out of the parascoring package so they are never deployed with the handler.
+
+
+class DirectoryS3(object):
+    """
+    S3 client stand-in backed by a directory, every request waits latency seconds like a round trip would
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def list_objects_v2(self, Bucket, Delimiter, Prefix):
+        self._request()
+        directory = self._path(Bucket, Prefix)
+        contents = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    etag = '"{}"'.format(hashlib.md5(f.read()).hexdigest())
+                contents.append({'Key': Prefix + name, 'ETag': etag})
+        return {'Contents': contents}
+
+    def get_object(self, Bucket, Key):
+        self._request()
+        try:
+            with open(self._path(Bucket, Key), 'rb') as f:
+                return {'Body': io.BytesIO(f.read())}
+        except FileNotFoundError:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+    def put_object(self, Bucket, Key, Body):
+        self._request()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+
+
+class MemoryTable(object):
+    """
+    The calls the handler makes to its DynamoDB table, on a dict.
+
+    Update expressions may have a set clause, with if_not_exists, and a remove clause. Condition expressions
+    are attribute_exists, attribute_not_exists and comparisons joined by AND or OR, without parentheses, AND
+    binding tighter. Updates are atomic like DynamoDB's and create missing items.
+    """
+
+    def __init__(self, latency=0.0):
+        self.items = {}
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        """
+        Wait for the round trip, the lock returned applies the request atomically
+        """
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+        return self._lock
+
+    @staticmethod
+    def _key(key):
+        return key['competition_name'], key['person_id']
+
+    def get_item(self, Key):
+        with self._request():
+            item = self.items.get(self._key(Key))
+            return {'Item': _copy(item)} if item else {}
+
+    def put_item(self, Item):
+        with self._request():
+            self.items[self._key(Item)] = _copy(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues='NONE',
+                    ConditionExpression=None):
+        with self._request():
+            key = self._key(Key)
+            item = self.items.get(key)
+            if ConditionExpression is not None and \
+                    not _evaluate_condition(item or {}, ConditionExpression, ExpressionAttributeValues):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'UpdateItem')
+            item = _copy(item) if item else dict(Key)
+            for action, clause in UPDATE_CLAUSE.findall(UpdateExpression):
+                for operation in ARGUMENT_SEPARATOR.split(clause.strip()):
+                    if action.lower() == 'remove':
+                        parent, name = _parent(item, operation.strip())
+                        parent.pop(name, None)
+                        continue
+                    path, value = [part.strip() for part in operation.split('=', 1)]
+                    match = IF_NOT_EXISTS.match(value)
+                    if match:
+                        current = _get(item, match.group(1))
+                        value = current if current is not MISSING else _copy(ExpressionAttributeValues[match.group(2)])
+                    else:
+                        value = _copy(ExpressionAttributeValues[value])
+                    parent, name = _parent(item, path)
+                    parent[name] = value
+            self.items[key] = item
+            if ReturnValues == 'ALL_NEW':
+                return {'Attributes': _copy(item)}
+            return {'Attributes': {}} if ReturnValues != 'NONE' else {}
+
+
+UPDATE_CLAUSE = re.compile(r'(?i)\b(set|remove)\s+(.*?)(?=\s+\b(?:set|remove)\s+|$)')
+# Commas outside of function arguments
+ARGUMENT_SEPARATOR = re.compile(r',\s*(?![^()]*\))')
+IF_NOT_EXISTS = re.compile(r'if_not_exists\(\s*([\w.]+)\s*,\s*(:\w+)\s*\)')
+CONDITION = re.compile(r'(attribute_exists|attribute_not_exists)\(\s*([\w.]+)\s*\)|'
+                       r'([\w.]+)\s*(<>|<=|>=|=|<|>)\s*(:\w+)')
+COMPARISONS = {'=': lambda a, b: a == b, '<>': lambda a, b: a != b, '<': lambda a, b: a < b,
+               '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+
+# Attribute that is not in an item, None is an attribute stored as NULL
+MISSING = object()
+
+
+def _copy(value):
+    return json.loads(json.dumps(value))
+
+
+def _get(item, path):
+    for name in path.split('.'):
+        if not isinstance(item, dict) or name not in item:
+            return MISSING
+        item = item[name]
+    return item
+
+
+def _parent(item, path):
+    *parents, name = path.split('.')
+    for parent in parents:
+        item = item[parent]
+    return item, name
+
+
+def _evaluate_condition(item, condition, values) -> bool:
+    return any(all(_evaluate_term(item, term.strip(), values) for term in re.split(r'(?i)\s+AND\s+', any_of))
+               for any_of in re.split(r'(?i)\s+OR\s+', condition))
+
+
+def _evaluate_term(item, term, values) -> bool:
+    match = CONDITION.fullmatch(term)
+    if match is None:
+        raise ValueError('Unsupported condition: ' + term)
+    function, path, attribute, operator, value = match.groups()
+    if function is not None:
+        return (_get(item, path) is not MISSING) == (function == 'attribute_exists')
+    current = _get(item, attribute)
+    # A missing attribute fails every comparison, as in DynamoDB
+    return current is not MISSING and COMPARISONS[operator](current, values[value])
@@ -0,0 +1,51 @@
+import io
+import json
+import unittest
+
+import numpy
+
+from parascoring.scoring import scorer as s
+from parascoring.scoring.CompetitionArtifact import compile_competition, competition_hash, load_competition
+from parascoring.scoring.IgcTrack import load_igc_track
+from parascoring.scoring.Utils import parse_wpt_file
+from parascoring.scoring.WaypointOptimizer import CompetitionIndex
+
+WPT_FILE = 'resources/WanakaHikeFly2.wpt'
+
+
+class TestCompetitionArtifact(unittest.TestCase):
+    def setUp(self):
+        with open('competition.json') as f:
+            self.wpt_config = json.load(f)
+        self.data = compile_competition(WPT_FILE, self.wpt_config)
+
+    def test_round_trip(self):
+        competition = load_competition(self.data)
+        self.assertEqual(parse_wpt_file(WPT_FILE), competition.wpt_data)
+        self.assertEqual(self.wpt_config, competition.wpt_config)
+        with open(WPT_FILE, "rb") as f:
+            self.assertEqual(competition_hash(f.read(), self.wpt_config), competition.content_hash)
+
+    def test_prebuilt_grid(self):
+        index = CompetitionIndex(parse_wpt_file(WPT_FILE), self.wpt_config)
+        competition = load_competition(self.data)
+        self.assertEqual({key: [wrapper.wpt for wrapper in cell] for key, cell in index.grid.cells.items()},
+                         {key: [wrapper.wpt for wrapper in cell] for key, cell in competition.index.grid.cells.items()})
+
+    def test_score(self):
+        competition = load_competition(self.data)
+        tracks = [load_igc_track('resources/2020-11-29-XCT-KMA-01.igc')]
+        self.assertEqual(s.score_igc_tracks_optimized(tracks, parse_wpt_file(WPT_FILE), self.wpt_config),
+                         s.score_igc_tracks_optimized(tracks, competition.wpt_data, competition.wpt_config,
+                                                      competition.index))
+
+    def test_version(self):
+        buffer = io.BytesIO()
+        with numpy.load(io.BytesIO(self.data)) as artifact:
+            numpy.savez(buffer, **dict(artifact, version=numpy.array(0)))
+        with self.assertRaises(ValueError):
+            load_competition(buffer.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from botocore.exceptions import ClientError
+
+from parascoring.scoring import scorer as s
+from parascoring.scoring.CompetitionArtifact import ARTIFACT_NAME, compile_competition
+from parascoring.scoring.Utils import parse_wpt_file
+from parascoring.scoring_lambda import handler
+
+from LocalAws import DirectoryS3, MemoryTable
+
+IGC_FILES = ['resources/Flymaster Day 1.igc', 'resources/Flymaster - Day 2.igc',
+             'resources/2020-11-11-XCT-KMA-01.igc', 'resources/2021-02-05-XFH-000-01.IGC']
+
+
+class TestHandlerPipeline(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        competition_dir = os.path.join(self.root, 'bucket', 'public', 'COMP')
+        os.makedirs(os.path.join(competition_dir, 'pilot'))
+        shutil.copy('resources/WanakaHikeFly2.wpt', os.path.join(competition_dir, 'competition.wpt'))
+        self.wpt_config = {'cylinder_km': 1.02, 'time_landed_min': 1, 'time_altitude_var_meters': 30,
+                           'distance_variance_meters': 10, 'precision_km': 2, 'finish_penalty_pts': 0}
+        with open(os.path.join(competition_dir, 'competition.json'), 'w') as f:
+            json.dump(self.wpt_config, f)
+        for i, igc_file in enumerate(IGC_FILES):
+            shutil.copy(igc_file, os.path.join(competition_dir, 'pilot', '{}.igc'.format(i)))
+        os.environ['STORAGE_S34FF28839_BUCKETNAME'] = 'bucket'
+        self.track_cache_dir = handler.TRACK_CACHE_DIR
+        handler.TRACK_CACHE_DIR = os.path.join(self.root, 'track-cache')
+        self.event = {'pathParameters': {'compid': 'COMP'}, 'queryStringParameters': {'userid': 'pilot'}}
+
+    def tearDown(self):
+        handler.TRACK_CACHE_DIR = self.track_cache_dir
+        shutil.rmtree(self.root)
+
+    def _handle(self, s3_client, table):
+        response = handler.BusinessHandler(self.event, table, s3_client).handle_event()
+        self.assertEqual(200, response['statusCode'])
+        return json.loads(response['body']['record'])
+
+    def test_score_matches_direct(self):
+        score = self._handle(DirectoryS3(self.root), MemoryTable())
+        expected = s.score_igcs_optimized(IGC_FILES, parse_wpt_file('resources/WanakaHikeFly2.wpt'), self.wpt_config)
+        self.assertEqual(expected['total'], score['total'])
+        self.assertEqual(expected['wpt_list'], score['wpt_list'])
+
+    def test_concurrent_fetch_latency(self):
+        latency = 0.2
+        s3_client = DirectoryS3(self.root, latency)
+        seconds = time.time()
+        self._handle(s3_client, MemoryTable())
+        seconds = time.time() - seconds
+        print('{} requests of {} s in {:.2f} s'.format(s3_client.requests, latency, seconds))
+        self.assertLess(seconds, s3_client.requests * latency * 0.6)
+
+    def test_truncated_track_store(self):
+        s3_client = DirectoryS3(self.root)
+        expected = self._handle(s3_client, MemoryTable())
+        parsed_dir = os.path.join(self.root, 'bucket', 'public', 'COMP', 'pilot', handler.TRACK_STORE_PREFIX)
+        for name in os.listdir(parsed_dir):
+            with open(os.path.join(parsed_dir, name), 'r+b') as f:
+                f.truncate(100)
+        shutil.rmtree(handler.TRACK_CACHE_DIR)
+        self.assertEqual(expected, self._handle(s3_client, MemoryTable()))
+        # Parsed again and stored over the truncated sidecars
+        shutil.rmtree(handler.TRACK_CACHE_DIR)
+        s3_client.requests = 0
+        self.assertEqual(expected, self._handle(s3_client, MemoryTable()))
+        # The artifact lookup, competition files and listing, then one sidecar per tracklog
+        self.assertEqual(4 + len(IGC_FILES), s3_client.requests)
+
+    def test_competition_artifact(self):
+        competition_dir = os.path.join(self.root, 'bucket', 'public', 'COMP')
+        with open(os.path.join(competition_dir, ARTIFACT_NAME), 'wb') as f:
+            f.write(compile_competition('resources/WanakaHikeFly2.wpt', self.wpt_config))
+        with self.assertLogs(level='INFO') as logs:
+            score = self._handle(DirectoryS3(self.root), MemoryTable())
+        self.assertIn('Competition artifact loaded', '\n'.join(logs.output))
+        expected = s.score_igcs_optimized(IGC_FILES, parse_wpt_file('resources/WanakaHikeFly2.wpt'), self.wpt_config)
+        self.assertEqual(expected['wpt_list'], score['wpt_list'])
+
+        # Edited after the artifact was compiled, the artifact is ignored
+        wpt_config = dict(self.wpt_config, cylinder_km=0.4)
+        with open(os.path.join(competition_dir, 'competition.json'), 'w') as f:
+            json.dump(wpt_config, f)
+        with self.assertLogs(level='INFO') as logs:
+            score = self._handle(DirectoryS3(self.root), MemoryTable())
+        self.assertIn('Competition artifact is stale', '\n'.join(logs.output))
+        expected = s.score_igcs_optimized(IGC_FILES, parse_wpt_file('resources/WanakaHikeFly2.wpt'), wpt_config)
+        self.assertEqual(expected['wpt_list'], score['wpt_list'])
+
+        with open(os.path.join(competition_dir, ARTIFACT_NAME), 'r+b') as f:
+            f.truncate(100)
+        with self.assertLogs(level='INFO') as logs:
+            self.assertEqual(score, self._handle(DirectoryS3(self.root), MemoryTable()))
+        self.assertIn('Invalid competition artifact', '\n'.join(logs.output))
+
+    def test_shadow_mode(self):
+        handler.SHADOW_FRACTION = 1.0
+        try:
+            self._handle(DirectoryS3(self.root), MemoryTable())
+            shadow = s.get_shadow_mode()
+            self.assertTrue(shadow.wait(120))
+        finally:
+            handler.SHADOW_FRACTION = 0.0
+            s.set_shadow_mode(None)
+        self.assertEqual(1, shadow.compared)
+        self.assertEqual(0, shadow.divergences)
+
+    def test_cold_import(self):
+        # A fresh interpreter, the test process has loaded everything already
+        code = 'import sys; import parascoring.scoring_lambda.handler; print(" ".join(sys.modules))'
+        modules = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                 cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                                 universal_newlines=True).stdout.split()
+        for module in ['boto3', 'botocore', 'numpy', 'geopy', 'parascoring.scoring.scorer', 'parascoring.scoring.WptOriginal']:
+            self.assertNotIn(module, modules)
+
+    def test_early_returns(self):
+        response = handler.BusinessHandler({'pathParameters': {}, 'queryStringParameters': {}}, MemoryTable(),
+                                           DirectoryS3(self.root)).handle_event()
+        self.assertEqual(400, response['statusCode'])
+        table = MemoryTable()
+        table.put_item({'competition_name': 'COMP', 'person_id': 'pilot', 'compute_active': True, 'stats': {},
+                        'lease_expires': int(time.time()) + 60, 'lease_id': 'other'})
+        table.requests = 0
+        s3_client = DirectoryS3(self.root)
+        response = handler.BusinessHandler(self.event, table, s3_client).handle_event()
+        self.assertEqual('Still computing score', json.loads(response['body'])['message'])
+        self.assertEqual(0, s3_client.requests)
+        self.assertEqual(1, table.requests)
+        self.assertEqual('other', table.items[('COMP', 'pilot')]['lease_id'])
+
+    def test_lock_round_trips(self):
+        table = MemoryTable()
+        for _ in range(2):
+            table.requests = 0
+            self._handle(DirectoryS3(self.root), table)
+            # The lock creating the record and the stats write releasing it
+            self.assertEqual(2, table.requests)
+            record = table.items[('COMP', 'pilot')]
+            self.assertFalse(record['compute_active'])
+            self.assertNotIn('lease_id', record)
+            self.assertNotIn('lease_expires', record)
+            self.assertEqual(4, len(record['stats']['tracklogs']))
+
+    def test_expired_lease(self):
+        for lease in [{'lease_expires': int(time.time()) - 1, 'lease_id': 'timed out'}, {}]:
+            table = MemoryTable()
+            table.put_item(dict({'competition_name': 'COMP', 'person_id': 'pilot', 'compute_active': True,
+                                 'stats': handler.new_stats()}, **lease))
+            self._handle(DirectoryS3(self.root), table)
+            self.assertFalse(table.items[('COMP', 'pilot')]['compute_active'])
+
+    def test_lease_taken_over(self):
+        table = MemoryTable()
+        first = handler.ActiveContextManager('COMP', 'pilot', table, lease_seconds=-1)
+        self.assertIsNotNone(first.acquire())
+        second = handler.ActiveContextManager('COMP', 'pilot', table)
+        self.assertIsNotNone(second.acquire())
+        self.assertIsNone(handler.ActiveContextManager('COMP', 'pilot', table).acquire())
+        first.release()
+        self.assertTrue(table.items[('COMP', 'pilot')]['compute_active'])
+        with second:
+            pass
+        self.assertFalse(table.items[('COMP', 'pilot')]['compute_active'])
+
+    def test_failure_releases_lease(self):
+        os.remove(os.path.join(self.root, 'bucket', 'public', 'COMP', 'competition.json'))
+        table = MemoryTable()
+        with self.assertRaises(ClientError):
+            handler.BusinessHandler(self.event, table, DirectoryS3(self.root)).handle_event()
+        record = table.items[('COMP', 'pilot')]
+        self.assertFalse(record['compute_active'])
+        self.assertNotIn('lease_id', record)
+
+    def test_concurrent_requests(self):
+        table = MemoryTable(latency=0.05)
+        s3_client = DirectoryS3(self.root, latency=0.05)
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(
+            handler.BusinessHandler(self.event, table, s3_client).handle_event())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        messages = sorted(json.loads(response['body'])['message'] if isinstance(response['body'], str)
+                          else response['body']['message'] for response in responses)
+        self.assertEqual(['Still computing score'] * 3 + ['Success'], messages)
+        self.assertFalse(table.items[('COMP', 'pilot')]['compute_active'])
+
+
+if __name__ == '__main__':
+    unittest.main()
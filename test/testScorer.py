@@ -1,16 +1,32 @@
+import glob
+import io
+import json
+import os
+import random
+import subprocess
 import sys
 import unittest
 
+import numpy
+from geopy.distance import geodesic
+
 import parascoring.scoring.IgcUtils
 import parascoring.scoring.Utils
 from parascoring.scoring import scorer as s
 import time
 from datetime import datetime, timedelta
 
-from parascoring.scoring.WaypointOptimizer import WaypointOptimizer
+from parascoring.scoring.WaypointOptimizer import LandWpt, WaypointOptimizer
 from parascoring.scoring.scorer import _score_igc
-from parascoring.scoring.WptOriginal import WaypointCounter
-from parascoring.scoring.Utils import parse_wpt_file, WptType
+from parascoring.scoring.WptOriginal import ReferenceCounter, WaypointCounter, WptStatus
+from parascoring.scoring.Utils import parse_wpt_file, WptDefinition, WptType
+from parascoring.scoring.Distance import TrackDistance, WptProjection, GEODESIC_DISTANCE, within_distance
+from parascoring.scoring.IgcTrack import IgcTrack, load_igc_track, parse_igc_track, parse_igc_bytes, read_igc_track
+from parascoring.scoring.IgcUtils import IgcFix
+from parascoring.scoring.Instrumentation import set_metrics_hook
+from parascoring.scoring.Landing import find_landings
+from parascoring.scoring.SpatialIndex import WaypointGrid
+from parascoring.scoring.WaypointVectorizer import WaypointVectorizer
 
 WPT_DICT = parse_wpt_file('resources/WanakaHikeFly2.wpt')
 WPT_CONFIG = {'cylinder_km': 1.02, 'time_landed_min': 1,
@@ -26,6 +42,138 @@ class TestScorerMethods(unittest.TestCase):
             .get_distance_from_lat_lon_in_km(169.3166983, -44.5913107, 169.317167, -44.592956)
         print(distance)
 
+    def test_distances_kernel(self):
+        track = load_igc_track('resources/2021-02-05-XFH-000-01.IGC')
+        lons, lats = track.latitude[::50], track.longitude[::50]
+        wpt = WPT_DICT['2_BENMOR']
+        distances = parascoring.scoring.Utils.get_distances_from_lat_lon_in_km(lons, lats, wpt.latitude, wpt.longitude)
+        for lon, lat, distance in zip(lons.tolist(), lats.tolist(), distances.tolist()):
+            expected = parascoring.scoring.Utils.get_distance_from_lat_lon_in_km(lon, lat, wpt.latitude, wpt.longitude)
+            self.assertAlmostEqual(expected, distance, delta=parascoring.scoring.Utils.ELLIPSOIDAL_MAX_ERROR_KM)
+        wpts = list(WPT_DICT.values())
+        matrix = parascoring.scoring.Utils.get_distances_from_lat_lon_in_km(
+            lons[:, None], lats[:, None], [w.latitude for w in wpts], [w.longitude for w in wpts])
+        self.assertEqual((len(lons), len(wpts)), matrix.shape)
+        self.assertEqual(0, parascoring.scoring.Utils.get_distances_from_lat_lon_in_km(lons, lats, lons, lats).max())
+
+    def test_track_distance_boundary(self):
+        track = load_igc_track('resources/2021-02-05-XFH-000-01.IGC')
+        wpt = WPT_DICT['2_BENMOR']
+        distances = parascoring.scoring.Utils.get_distances_from_lat_lon_in_km(
+            track.latitude, track.longitude, wpt.latitude, wpt.longitude)
+        track_distance = TrackDistance(track, batch_size=7)
+        for i in range(0, len(track), 13):
+            igc_fix = track.fix(i)
+            # Cylinder edge exactly on the kernel distance forces the exact geodesic
+            cylinder_km = float(distances[i])
+            track_distance.index = i
+            self.assertEqual(GEODESIC_DISTANCE.in_cylinder(igc_fix, wpt, cylinder_km),
+                             track_distance.in_cylinder(igc_fix, wpt, cylinder_km))
+            self.assertEqual(GEODESIC_DISTANCE.in_cylinder(igc_fix, wpt, 1.02),
+                             track_distance.in_cylinder(igc_fix, wpt, 1.02))
+
+    def test_wpt_projection(self):
+        track = load_igc_track('resources/2021-02-05-XFH-000-01.IGC')
+        for name in ['2_BENMOR', 'START', '1X_BREAST']:
+            wpt = WPT_DICT[name]
+            projection = WptProjection(wpt)
+            for i in range(0, len(track), 7):
+                igc_fix = track.fix(i)
+                east, north = projection.project(igc_fix)
+                distance = parascoring.scoring.Utils.get_distance_from_lat_lon_in_km(
+                    igc_fix.latitude, igc_fix.longitude, wpt.latitude, wpt.longitude)
+                cylinders_km = [0.4, 1.02]
+                if distance < 10:
+                    self.assertAlmostEqual(distance, (east ** 2 + north ** 2) ** 0.5, delta=1e-4)
+                    cylinders_km.append(distance)
+                for cylinder_km in cylinders_km:
+                    self.assertEqual(GEODESIC_DISTANCE.in_cylinder(igc_fix, wpt, cylinder_km),
+                                     projection.in_cylinder(igc_fix, wpt, cylinder_km))
+                start_igc = track.fix(max(i - 20, 0))
+                for variance_meters in [10, 100]:
+                    self.assertEqual(GEODESIC_DISTANCE.within_drift(igc_fix, start_igc, variance_meters),
+                                     projection.within_drift(igc_fix, start_igc, variance_meters))
+
+    def test_wpt_projection_tiers(self):
+        wpt = WPT_DICT['2_BENMOR']
+        projection = WptProjection(wpt, epsilon_km=0)
+        track = load_igc_track('resources/2021-02-05-XFH-000-01.IGC')
+        for i in range(len(track)):
+            igc_fix = track.fix(i)
+            counts = projection.counts.as_dict()
+            inside = projection.in_cylinder(igc_fix, wpt, 1.02)
+            self.assertEqual(GEODESIC_DISTANCE.in_cylinder(igc_fix, wpt, 1.02), inside)
+            if projection.counts.bounds > counts['bounds']:
+                self.assertFalse(inside)
+        counts = projection.counts.as_dict()
+        self.assertEqual(len(track), sum(counts.values()))
+        self.assertGreater(counts['bounds'], counts['planar'])
+        self.assertLess(counts['geodesic'], len(track) / 100)
+
+    def test_wpt_projection_high_latitudes(self):
+        # Fixes a metre or less either side of the drift and cylinder limits, with no epsilon to hide errors
+        rng = random.Random(3)
+        for _ in range(40):
+            lat = rng.choice([-1, 1]) * rng.uniform(40, 85)
+            wpt = WptDefinition('W', lat, rng.uniform(-180, 180), 0, WptType.LAND, 1)
+            projection = WptProjection(wpt, epsilon_km=0)
+            for _ in range(25):
+                cylinder_km = rng.choice([1.02, 5])
+                start = geodesic(kilometers=rng.uniform(0, cylinder_km)).destination((lat, wpt.latitude),
+                                                                                      rng.uniform(0, 360))
+                variance_meters = rng.choice([10, 1000])
+                end = geodesic(kilometers=variance_meters / 1000 + rng.uniform(-1e-3, 1e-3)).destination(
+                    start, rng.uniform(0, 360))
+                edge = geodesic(kilometers=cylinder_km + rng.uniform(-1e-3, 1e-3)).destination(
+                    (lat, wpt.latitude), rng.uniform(0, 360))
+                start_igc, igc_fix, edge_fix = [IgcFix(0, point.latitude, point.longitude, 0, 0, True)
+                                                for point in [start, end, edge]]
+                self.assertEqual(GEODESIC_DISTANCE.within_drift(igc_fix, start_igc, variance_meters),
+                                 projection.within_drift(igc_fix, start_igc, variance_meters))
+                self.assertEqual(GEODESIC_DISTANCE.in_cylinder(edge_fix, wpt, cylinder_km),
+                                 projection.in_cylinder(edge_fix, wpt, cylinder_km))
+        self.assertIsNone(WptProjection(WptDefinition('W', 89.5, 0, 0, WptType.LAND, 1)).margin_km(1))
+
+    def test_distance_counts(self):
+        wpt_counter = WaypointOptimizer(WPT_DICT, WPT_CONFIG)
+        s.score_igc('resources/2020-11-11-XCT-KMA-01.igc', wpt_counter)
+        counts = wpt_counter.get_distance_counts()
+        self.assertEqual({'bounds', 'planar', 'geodesic'}, set(counts))
+        self.assertGreater(counts['planar'], 0)
+        self.assertLess(counts['geodesic'], counts['planar'])
+
+    def test_projection_epsilon(self):
+        for projection_epsilon_km in [0, 0.01, 5]:
+            wpt_config = dict(WPT_CONFIG, projection_epsilon_km=projection_epsilon_km)
+            wpt_counter = WaypointOptimizer(WPT_DICT, wpt_config)
+            s.score_igc('resources/2020-11-11-XCT-KMA-01.igc', wpt_counter)
+            self.assertEqual(6, wpt_counter.get_score_report()['total'])
+
+    def test_waypoint_grid(self):
+        grid = WaypointGrid(1)
+        grid.add('a', -44.5, 169.1, 0.01, 0.01)
+        grid.add('b', -44.5, 169.1, 0.001, 0.001)
+        self.assertEqual(2, len(grid))
+        self.assertEqual(['a', 'b'], list(grid.get(grid.key(-44.5, 169.1))))
+        self.assertEqual(grid.key(-44.5, 169.1), int(grid.keys(numpy.array([-44.5]), numpy.array([169.1]))[0]))
+        grid.remove('a')
+        self.assertEqual(['b'], list(grid.get(grid.key(-44.5, 169.1))))
+        grid.remove('b')
+        self.assertEqual(0, len(grid))
+        self.assertEqual({}, grid.cells)
+
+    def test_waypoint_grid_finds_cylinders(self):
+        wpt_counter = WaypointOptimizer(WPT_DICT, WPT_CONFIG)
+        grid = wpt_counter.grid
+        track = load_igc_track('resources/2020-11-29-XCT-KMA-01.igc')
+        keys = grid.keys(track.longitude, track.latitude).tolist()
+        wrappers = {wrapper for cell in grid.cells.values() for wrapper in cell}
+        for wrapper in wrappers:
+            distances = parascoring.scoring.Utils.get_distances_from_lat_lon_in_km(
+                track.latitude, track.longitude, wrapper.wpt.latitude, wrapper.wpt.longitude)
+            for i in numpy.flatnonzero(distances <= WPT_CONFIG['cylinder_km']).tolist():
+                self.assertIn(wrapper, grid.get(keys[i]))
+
     def test_real_igc_1(self):
         import time
         seconds = time.time()
@@ -34,6 +182,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.real_igc_1(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.real_igc_1(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_real_igc_2(self):
         import time
@@ -43,6 +194,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.real_igc_2(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.real_igc_2(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_real_igc_3(self):
         import time
@@ -52,6 +206,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.real_igc_3(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.real_igc_3(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_multi_real_igc_3(self):
         import time
@@ -117,6 +274,438 @@ class TestScorerMethods(unittest.TestCase):
         self.assertEqual(igc_info.alt_pressure, 631)
         self.assertEqual(igc_info.alt_gps, 596)
 
+    def test_load_igc_track(self):
+        igc_parser = parascoring.scoring.IgcUtils.IGCParser()
+        with open('resources/2021-02-05-XFH-000-01.IGC') as f:
+            igc_infos = [igc_parser.parse_igc_line(x) for x in f]
+        igc_infos = [igc_info for igc_info in igc_infos if igc_info]
+        track = load_igc_track('resources/2021-02-05-XFH-000-01.IGC')
+        self.assertEqual(len(igc_infos), len(track))
+        for i, igc_info in enumerate(igc_infos):
+            self.assertEqual(parascoring.scoring.IgcUtils.to_igc_fix(igc_info), track.fix(i))
+        self.assertEqual(igc_infos[0].time, track.get_datetime())
+
+    def test_igc_fix(self):
+        igc_line = 'B1102255206417N00006098WA0063100596'
+        igc_info = parascoring.scoring.IgcUtils.parse_igc_basic_line(igc_line, datetime(year=2020, month=10, day=19))
+        igc_fix = parascoring.scoring.IgcUtils.to_igc_fix(igc_info)
+        self.assertFalse(hasattr(igc_fix, '__dict__'))
+        self.assertEqual(int((igc_info.time - datetime(year=1970, month=1, day=1)).total_seconds()), igc_fix.timestamp)
+        self.assertEqual(igc_info.time, igc_fix.time)
+        self.assertEqual(igc_info.latitude, igc_fix.latitude)
+        self.assertEqual(igc_info.alt_gps, igc_fix.alt_gps)
+        self.assertLess(sys.getsizeof(igc_fix), sys.getsizeof(igc_info) + sys.getsizeof(igc_info.__dict__))
+
+    def test_parse_igc_track_date_header(self):
+        track = parse_igc_track(['HFDTE270920', 'B1102255206417N00006098WA0063100596',
+                                 'HFDTEDATE:280920,01', 'B1102265206417N00006098WV0063100596'])
+        self.assertEqual(2, len(track))
+        self.assertEqual(datetime(year=2020, month=9, day=27, hour=11, minute=2, second=25), track.fix(0).time)
+        self.assertEqual(datetime(year=2020, month=9, day=28, hour=11, minute=2, second=26), track.fix(1).time)
+        self.assertEqual([True, False], track.valid.tolist())
+
+    def test_parse_igc_bytes(self):
+        for igc_file in sorted(glob.glob('resources/*.[iI][gG][cC]')):
+            with open(igc_file) as f:
+                text_track = parse_igc_track(f)
+            bytes_track = load_igc_track(igc_file)
+            self.assertEqual(len(text_track), len(bytes_track))
+            for column in ['time', 'longitude', 'latitude', 'alt_pressure', 'alt_gps', 'valid']:
+                self.assertEqual(getattr(text_track, column).tolist(), getattr(bytes_track, column).tolist())
+
+    def test_parse_igc_bytes_malformed_lines(self):
+        igc_lines = ['HFDTE270920', 'B1102255206417N00006098WA0063100596', 'B110225520641',
+                     'B1102255206417N00006098WA-006300596', 'B1102265206417N00006098WV0063100596XYZ']
+        text_track = parse_igc_track(igc_lines)
+        bytes_track = parse_igc_bytes('\r\n'.join(igc_lines).encode())
+        self.assertEqual(2, len(bytes_track))
+        self.assertEqual(text_track.time.tolist(), bytes_track.time.tolist())
+        self.assertEqual(text_track.latitude.tolist(), bytes_track.latitude.tolist())
+        self.assertEqual(text_track.valid.tolist(), bytes_track.valid.tolist())
+
+    def test_parse_rate(self):
+        for igc_file in sorted(glob.glob('resources/*.[iI][gG][cC]')):
+            seconds = time.time()
+            with open(igc_file) as f:
+                track = parse_igc_track(f)
+            text_seconds = time.time() - seconds
+            seconds = time.time()
+            track = load_igc_track(igc_file)
+            bytes_seconds = time.time() - seconds
+            print('{}: {} fixes, text {:.0f} fixes/s, bytes {:.0f} fixes/s'.format(
+                igc_file, len(track), len(track) / text_seconds, len(track) / bytes_seconds))
+
+    def test_order_igc_files(self):
+        igc_files = ['resources/2021-02-05-XFH-000-01.IGC',
+                     'resources/GPX Converted - Day 2.igc',
+                     'resources/2020-11-29-XCT-KMA-01.igc',
+                     'resources/GPX Converted - Day 1.igc',
+                     'resources/2020-11-11-XCT-KMA-01.igc']
+        ordered = parascoring.scoring.IgcUtils.order_igc_files(igc_files)
+        self.assertEqual(['resources/2020-11-11-XCT-KMA-01.igc',
+                          'resources/2020-11-29-XCT-KMA-01.igc',
+                          'resources/2021-02-05-XFH-000-01.IGC',
+                          'resources/GPX Converted - Day 1.igc',
+                          'resources/GPX Converted - Day 2.igc'], ordered)
+        start_datetimes = [parascoring.scoring.IgcUtils.IGCFileParser(igc_file).get_datetime()
+                           for igc_file in ordered]
+        self.assertEqual(sorted(start_datetimes), start_datetimes)
+
+    def test_read_igc_track(self):
+        igc_file = 'resources/2021-02-05-XFH-000-01.IGC'
+        track = load_igc_track(igc_file)
+        with open(igc_file, 'rb') as f:
+            data = f.read()
+        with open(igc_file) as f:
+            lines = f.readlines()
+        sources = [data, bytearray(data), io.BytesIO(data), io.StringIO(data.decode()), lines,
+                   iter(data.splitlines())]
+        for source in sources:
+            read_track = read_igc_track(source)
+            for column in ['time', 'longitude', 'latitude', 'alt_pressure', 'alt_gps', 'valid']:
+                self.assertEqual(getattr(track, column).tolist(), getattr(read_track, column).tolist())
+
+    def test_order_igc_sources(self):
+        igc_files = ['resources/2021-02-05-XFH-000-01.IGC',
+                     'resources/2020-11-29-XCT-KMA-01.igc',
+                     'resources/2020-11-11-XCT-KMA-01.igc']
+        contents = []
+        for igc_file in igc_files:
+            with open(igc_file, 'rb') as f:
+                contents.append(f.read())
+        stream = io.BytesIO(contents[1])
+        stream.seek(0)
+        ordered = parascoring.scoring.IgcUtils.order_igc_files(
+            [contents[0], stream, iter(contents[2].decode().splitlines())])
+        self.assertEqual(contents[2].decode().splitlines(), ordered[0])
+        self.assertIs(stream, ordered[1])
+        self.assertEqual(0, stream.tell())
+        self.assertIs(contents[0], ordered[2])
+        self.assertEqual(s.score_igcs_optimized(igc_files, WPT_DICT, WPT_CONFIG),
+                         s.score_igcs_optimized(contents, WPT_DICT, WPT_CONFIG))
+        self.assertEqual(s.score_igcs(igc_files, WPT_DICT, WPT_CONFIG),
+                         s.score_igcs([io.BytesIO(data) for data in contents], WPT_DICT, WPT_CONFIG))
+
+    def test_order_igc_text_streams(self):
+        igc_files = ['resources/2021-02-05-XFH-000-01.IGC', 'resources/2020-11-11-XCT-KMA-01.igc']
+        # Pipes opened in text mode, which cannot seek
+        processes = [subprocess.Popen(['cat', igc_file], stdout=subprocess.PIPE, universal_newlines=True)
+                     for igc_file in igc_files]
+        try:
+            streams = [process.stdout for process in processes]
+            self.assertFalse(any(stream.seekable() for stream in streams))
+            ordered = parascoring.scoring.IgcUtils.order_igc_files(streams)
+        finally:
+            for process in processes:
+                process.stdout.close()
+                process.wait()
+        with open(igc_files[1]) as f:
+            self.assertEqual(f.readlines(), ordered[0])
+        self.assertEqual(s.score_igcs_optimized(igc_files, WPT_DICT, WPT_CONFIG),
+                         s.score_igcs_optimized(ordered, WPT_DICT, WPT_CONFIG))
+
+    def test_parse_wpt_lines(self):
+        with open('resources/WanakaHikeFly2.wpt', 'rb') as f:
+            wpt_lines = f.read().decode().splitlines()
+        self.assertEqual(WPT_DICT, parascoring.scoring.Utils.parse_wpt_lines(wpt_lines))
+
+    def test_scan_igc_start_datetime(self):
+        igc_lines = ['AXSR', 'HFDTE270920', 'B110225', 'B1102255206417N00006098WA0063100596', 'not parsed']
+        start = parascoring.scoring.IgcUtils.scan_igc_start_datetime(igc_lines)
+        self.assertEqual(datetime(year=2020, month=9, day=27, hour=11, minute=2, second=25), start)
+        self.assertIsNone(parascoring.scoring.IgcUtils.scan_igc_start_datetime(['HFDTE270920']))
+
+    def test_check_igc_track(self):
+        for counter_type in [WaypointCounter, WaypointOptimizer]:
+            igc_parser = parascoring.scoring.IgcUtils.IGCParser()
+            log_counter = counter_type(WPT_DICT, WPT_CONFIG)
+            with open('resources/GPX Converted - Day 1.igc') as f:
+                for x in f:
+                    igc_info = igc_parser.parse_igc_line(x)
+                    if igc_info:
+                        log_counter.check_igc_log(igc_info)
+            track_counter = counter_type(WPT_DICT, WPT_CONFIG)
+            track_counter.check_igc_track(load_igc_track('resources/GPX Converted - Day 1.igc'))
+            self.assertEqual(log_counter.get_score_report(), track_counter.get_score_report())
+
+    def test_vectorized_matches_optimized(self):
+        wpt_config = dict(WPT_CONFIG, finish_penalty_pts=-8)
+        igc_files = sorted(glob.glob('resources/*.[iI][gG][cC]'))
+        for igc_file in igc_files:
+            self.assertEqual(s.score_igcs_optimized([igc_file], WPT_DICT, wpt_config),
+                             s.score_igcs_vectorized([igc_file], WPT_DICT, wpt_config))
+        self.assertEqual(s.score_igcs_optimized(igc_files, WPT_DICT, wpt_config),
+                         s.score_igcs_vectorized(igc_files, WPT_DICT, wpt_config))
+
+    def test_vectorized_finish(self):
+        wpt_config = {'cylinder_km': 1, 'time_landed_min': 1,
+                      'time_altitude_var_meters': 30, 'distance_variance_meters': 10,
+                      'precision_km': 1,
+                      'finish_penalty_pts': -8}
+        lon_1 = parascoring.scoring.Utils.deg_wpt_to_deg_igc('S 44 56 57.78')
+        lat_1 = parascoring.scoring.Utils.deg_wpt_to_deg_igc('E 168 32 20.86')
+        igc_list = ['HFDTE270920', 'B110225{}{}A0063100596'.format(lon_1, lat_1)]
+        lon = parascoring.scoring.Utils.deg_wpt_to_deg_igc('S 44 40 20.36')
+        lat = parascoring.scoring.Utils.deg_wpt_to_deg_igc('E 169 00 26.78')
+        igc_list.append('B110325{}{}A0063100596'.format(lon, lat))
+        igc_list.append('B110425{}{}A0063100596'.format(lon, lat))
+        wpt_counter = WaypointVectorizer(WPT_DICT, wpt_config)
+        _score_igc(igc_list, wpt_counter)
+        score_report = wpt_counter.get_score_report()
+        self.assertEqual(2, score_report['total'])
+        self.assertEqual('09/27/2020, 11:04:25', score_report['finish_time'])
+
+    def test_find_landings(self):
+        rng = numpy.random.default_rng(0)
+        wpt = WPT_DICT['2X_BROWP']
+        for trial in range(100):
+            size = int(rng.integers(1, 400))
+            steps = rng.choice([0, 0.00002, 0.00005, 0.003], size=size)[:, None] * rng.normal(size=(size, 2))
+            position = numpy.cumsum(steps, axis=0)
+            alt = 600 + numpy.cumsum(rng.choice([0, 0, 1, 40], size=size) * rng.choice([-1, 1], size=size))
+            track = IgcTrack(1600000000 + numpy.cumsum(rng.choice([1, 2, 30], size=size)),
+                             wpt.longitude + position[:, 0], wpt.latitude + position[:, 1],
+                             alt, alt, numpy.ones(size, dtype=bool))
+            wpt_config = {'cylinder_km': float(rng.choice([0.05, 1])), 'time_landed_min': float(rng.choice([0, 1])),
+                          'time_altitude_var_meters': int(rng.choice([5, 30])),
+                          'distance_variance_meters': int(rng.choice([3, 10]))}
+            land_wpt = LandWpt(wpt, wpt_config)
+            expected = [i for i in range(size) if land_wpt.submit(track.fix(i)) is WptStatus.SUCCESS]
+            rows = numpy.flatnonzero(within_distance(track.latitude, track.longitude, wpt.latitude, wpt.longitude,
+                                                     wpt_config['cylinder_km']))
+            landings, _ = find_landings(track, rows, None, wpt_config['time_altitude_var_meters'],
+                                        wpt_config['distance_variance_meters'],
+                                        wpt_config['time_landed_min'] * 60, False)
+            self.assertEqual(expected, landings)
+            landings, _ = find_landings(track, rows, None, wpt_config['time_altitude_var_meters'],
+                                        wpt_config['distance_variance_meters'], wpt_config['time_landed_min'] * 60)
+            self.assertEqual(expected[:1], landings)
+
+    def test_resume_scoring_state(self):
+        wpt_config = dict(WPT_CONFIG, finish_penalty_pts=-8)
+        tracks = [load_igc_track('resources/Flymaster Day 1.igc'), load_igc_track('resources/Flymaster - Day 2.igc')]
+        score_report = s.score_igc_tracks_optimized(tracks, WPT_DICT, wpt_config)
+        first_report, state = s.score_igc_tracks_resumable(tracks[:1], WPT_DICT, wpt_config)
+        self.assertEqual(s.score_igc_tracks_optimized(tracks[:1], WPT_DICT, wpt_config), first_report)
+        state = json.loads(json.dumps(state))
+        resumed_report, resumed_state = s.score_igc_tracks_resumable(tracks[1:], WPT_DICT, wpt_config, state)
+        self.assertEqual(score_report, resumed_report)
+        self.assertEqual(resumed_report, s.score_igc_tracks_resumable([], WPT_DICT, wpt_config, resumed_state)[0])
+        with self.assertRaises(ValueError):
+            s.score_igc_tracks_resumable(tracks[:1], WPT_DICT, wpt_config, state)
+
+    def test_scoring_state_landing_window(self):
+        lon = parascoring.scoring.Utils.deg_wpt_to_deg_igc('S 44 54 09.64')
+        lat = parascoring.scoring.Utils.deg_wpt_to_deg_igc('E 168 49 11.92')
+        wpt_counter = WaypointOptimizer(WPT_DICT, WPT_CONFIG)
+        _score_igc(['HFDTE270920', 'B110000{}{}A0063100596'.format(lon, lat)], wpt_counter)
+        state = wpt_counter.get_state()
+        self.assertIn('2X_BROWP', state['land_starts'])
+        wpt_counter = WaypointOptimizer(WPT_DICT, WPT_CONFIG)
+        wpt_counter.load_state(state)
+        _score_igc(['HFDTE270920', 'B110100{}{}A0063100596'.format(lon, lat)], wpt_counter)
+        self.assertEqual('2X_BROWP', wpt_counter.get_score_report()['wpt_list'][0]['wpt'])
+        self.assertEqual(['2X_BROWP'], wpt_counter.get_state()['removed'])
+
+    def test_reachability_skipping(self):
+        wpt_config = dict(WPT_CONFIG, max_speed_kmh=100)
+        skipped_fixes = 0
+        for igc_file in sorted(glob.glob('resources/*.[iI][gG][cC]')):
+            tracks = [load_igc_track(igc_file)]
+            wpt_counter = WaypointOptimizer(WPT_DICT, wpt_config)
+            self.assertEqual(s.score_igc_tracks_optimized(tracks, WPT_DICT, WPT_CONFIG),
+                             s._score_igc_tracks(tracks, wpt_counter))
+            skipped_fixes += wpt_counter.get_skipped_fixes()
+        self.assertGreater(skipped_fixes, 0)
+        # A landing window in progress assesses every fix
+        lon = parascoring.scoring.Utils.deg_wpt_to_deg_igc('S 44 54 09.64')
+        lat = parascoring.scoring.Utils.deg_wpt_to_deg_igc('E 168 49 11.92')
+        wpt_counter = WaypointOptimizer(WPT_DICT, wpt_config)
+        _score_igc(['HFDTE270920'] + ['B11{:02d}00{}{}A0063100596'.format(minute, lon, lat) for minute in range(12)],
+                   wpt_counter)
+        self.assertEqual('2X_BROWP', wpt_counter.get_score_report()['wpt_list'][0]['wpt'])
+        self.assertEqual(0, wpt_counter.get_skipped_fixes())
+
+    def test_reachability_landing_left(self):
+        # Two fixes at 2X_BROWP, shorter than time_landed_min, half an hour away and one fix back at the same spot
+        lon = parascoring.scoring.Utils.deg_wpt_to_deg_igc('S 44 54 09.64')
+        lat = parascoring.scoring.Utils.deg_wpt_to_deg_igc('E 168 49 11.92')
+        away = parascoring.scoring.Utils.deg_wpt_to_deg_igc('S 45 30 00.00')
+        igc_list = ['HFDTE270920']
+        for seconds in range(1801):
+            igc_list.append('B11{:02d}{:02d}{}{}A0063100596'.format(seconds // 60, seconds % 60,
+                                                                   away if 2 <= seconds < 1800 else lon, lat))
+        tracks = [parse_igc_track(igc_list)]
+        report, metrics = s.score_igc_tracks_with_metrics(tracks, WPT_DICT, dict(WPT_CONFIG, max_speed_kmh=100))
+        self.assertNotIn('2X_BROWP', [hit['wpt'] for hit in report['wpt_list']])
+        self.assertEqual(s.score_igc_tracks_optimized(tracks, WPT_DICT, WPT_CONFIG), report)
+        self.assertEqual(s.score_igc_tracks(tracks, WPT_DICT, WPT_CONFIG)['wpt_list'], report['wpt_list'])
+        self.assertGreater(metrics['counters']['skipped_fixes'], 1000)
+        self.assertLess(metrics['counters']['assessed_fixes'], 10)
+
+    def test_scoring_metrics(self):
+        igc_files = sorted(glob.glob('resources/*.[iI][gG][cC]'))
+        score_report = s.score_igcs_optimized(igc_files, WPT_DICT, WPT_CONFIG)
+        for engine in s.ENGINES:
+            report, metrics = s.score_igcs_with_metrics(igc_files, WPT_DICT, WPT_CONFIG, engine)
+            self.assertEqual(score_report, report)
+            print(engine, metrics)
+            counters = metrics['counters']
+            self.assertEqual(len(igc_files), counters['files'])
+            self.assertEqual(sum(len(load_igc_track(igc_file)) for igc_file in igc_files), counters['fixes'])
+            self.assertGreater(counters['distance_checks'], 0)
+            self.assertLessEqual(counters['index_hits'], counters['fixes'])
+            self.assertEqual(counters['index_hits'] / counters['fixes'], metrics['index_hit_rate'])
+            for name in ['header_scan', 'parse', 'index_lookup', 'distance', 'report']:
+                self.assertGreaterEqual(metrics['timings'][name], 0)
+        self.assertIsNone(WaypointOptimizer(WPT_DICT, WPT_CONFIG).metrics)
+        report, metrics = s.score_igcs_with_metrics(igc_files, WPT_DICT, WPT_CONFIG, 'original')
+        self.assertEqual(s.score_igcs(igc_files, WPT_DICT, WPT_CONFIG), report)
+        self.assertEqual(len(igc_files), metrics['counters']['header_scans'])
+        self.assertEqual(len(igc_files), metrics['counters']['tracks'])
+        self.assertGreater(metrics['counters']['distance_checks'], 0)
+        for name in ['header_scan', 'parse', 'distance', 'report']:
+            self.assertGreaterEqual(metrics['timings'][name], 0)
+        self.assertIsNone(WaypointCounter(WPT_DICT, WPT_CONFIG).metrics)
+
+    def test_metrics_hook(self):
+        emitted = []
+        set_metrics_hook(emitted.append)
+        try:
+            s.score_igc_tracks_optimized([load_igc_track('resources/Flymaster Day 1.igc')], WPT_DICT, WPT_CONFIG)
+        finally:
+            set_metrics_hook(None)
+        self.assertEqual(1, len(emitted))
+        self.assertEqual(1, emitted[0]['counters']['tracks'])
+        s.score_igc_tracks_optimized([load_igc_track('resources/Flymaster Day 1.igc')], WPT_DICT, WPT_CONFIG)
+        self.assertEqual(1, len(emitted))
+
+    def test_shadow_mode(self):
+        divergences = []
+        shadow = s.set_shadow_mode(1, hook=divergences.append)
+        try:
+            for igc_file in ['resources/Flymaster Day 1.igc', 'resources/2020-11-11-XCT-KMA-01.igc']:
+                s.score_igcs_optimized([igc_file], WPT_DICT, WPT_CONFIG)
+                s.score_igc_tracks_vectorized([load_igc_track(igc_file)], WPT_DICT, WPT_CONFIG)
+            s.score_igcs(['resources/Flymaster Day 1.igc'], WPT_DICT, WPT_CONFIG)
+            self.assertTrue(shadow.wait(60))
+            self.assertEqual(4, shadow.compared)
+            self.assertEqual([], divergences)
+            # Too low a speed bound skips fixes that reach a waypoint
+            wpt_config = dict(WPT_CONFIG, max_speed_kmh=1)
+            s.score_igc_tracks_optimized([load_igc_track('resources/2020-11-11-XCT-KMA-01.igc')], WPT_DICT,
+                                         wpt_config)
+            self.assertTrue(shadow.wait(60))
+        finally:
+            s.set_shadow_mode(None)
+        self.assertEqual(1, shadow.divergences)
+        divergence, = divergences
+        self.assertEqual('WaypointOptimizer', divergence['engine'])
+        self.assertIsNone(divergence['hit'])
+        self.assertEqual('1_MTHYDE', divergence['reference_hit']['wpt'])
+        self.assertEqual(datetime(2020, 11, 11, 1, 27, 1), parascoring.scoring.IgcUtils.EPOCH +
+                         timedelta(seconds=divergence['fix']['timestamp']))
+
+    def test_shadow_mode_sampling(self):
+        self.assertIsNone(s.set_shadow_mode(0))
+        with self.assertRaises(ValueError):
+            s.set_shadow_mode(2)
+        tracks = [load_igc_track('resources/2021-02-05-XFH-000-01.IGC')]
+        shadow = s.set_shadow_mode(0.5, seed=1)
+        try:
+            for _ in range(10):
+                s.score_igc_tracks_optimized(tracks, WPT_DICT, WPT_CONFIG)
+            # A resumed run only has the new tracks, the reference could not score it
+            _, state = s.score_igc_tracks_resumable(tracks[:0], WPT_DICT, WPT_CONFIG)
+            shadow.fraction = 1
+            s.score_igc_tracks_resumable(tracks, WPT_DICT, WPT_CONFIG, state)
+            self.assertTrue(shadow.wait(60))
+        finally:
+            s.set_shadow_mode(None)
+        self.assertLess(0, shadow.compared)
+        self.assertGreater(10, shadow.compared)
+        self.assertEqual(0, shadow.divergences)
+
+    def test_spawn_executor(self):
+        executor = s.SpawnExecutor()
+        self.assertNotEqual(os.getpid(), executor.submit(os.getpid).result(60))
+        self.assertIn('ValueError', str(executor.submit(int, 'x').exception(60)))
+        divergences = []
+        shadow = s.set_shadow_mode(1, executor=executor, hook=divergences.append)
+        try:
+            s.score_igc_tracks_optimized([load_igc_track('resources/2020-11-11-XCT-KMA-01.igc')], WPT_DICT,
+                                         dict(WPT_CONFIG, max_speed_kmh=1))
+            self.assertTrue(shadow.wait(60))
+        finally:
+            s.set_shadow_mode(None)
+        self.assertEqual(1, shadow.divergences)
+        self.assertEqual('1_MTHYDE', divergences[0]['reference_hit']['wpt'])
+
+    def test_shadow_one_tag_per_fix(self):
+        # The fix after the approach is in both cylinders, the reference engine tags B one fix later or never
+        wpt_file = {'A': WptDefinition('A', -44.7, 168.8, 0, WptType.TOUCH, 1),
+                    'B': WptDefinition('B', -44.7, 168.801, 0, WptType.TOUCH, 2)}
+        wpt_config = dict(WPT_CONFIG, cylinder_km=0.4)
+        for fixes_inside in [1, 3]:
+            lons = [168.7] * 3 + [168.8005] * fixes_inside + [168.9] * 3
+            tracks = [IgcTrack(1600000000 + numpy.arange(len(lons)), [-44.7] * len(lons), lons, [0] * len(lons),
+                               [0] * len(lons), [True] * len(lons))]
+            report = s.score_igc_tracks_optimized(tracks, wpt_file, wpt_config)
+            self.assertEqual([report['wpt_list'][0]['time']] * 2, [hit['time'] for hit in report['wpt_list']])
+            reference = s.score_igc_tracks(tracks, wpt_file, wpt_config)
+            self.assertEqual('B', s.diff_reports(report, reference, wpt_file)['wpt'])
+            reference = s._score_igc_tracks(tracks, ReferenceCounter(wpt_file, wpt_config))
+            self.assertIsNone(s.diff_reports(report, reference, wpt_file))
+            self.assertIsNone(s.compare_with_reference(tracks, wpt_file, wpt_config, report))
+        # A fast engine missing B diverges
+        report['wpt_list'] = report['wpt_list'][:1]
+        divergence = s.compare_with_reference(tracks, wpt_file, wpt_config, report)
+        self.assertEqual({'wpt': 'B', 'hit': None, 'reference_hit': reference['wpt_list'][1]},
+                         {key: divergence[key] for key in ['wpt', 'hit', 'reference_hit']})
+
+    def test_shared_competition_index(self):
+        index = s.build_competition_index(WPT_DICT, WPT_CONFIG)
+        cells = {key: list(cell) for key, cell in index.grid.cells.items()}
+        for igc_file in sorted(glob.glob('resources/*.[iI][gG][cC]')):
+            tracks = [load_igc_track(igc_file)]
+            self.assertEqual(s.score_igc_tracks_optimized(tracks, WPT_DICT, WPT_CONFIG),
+                             s.score_igc_tracks_optimized(tracks, WPT_DICT, WPT_CONFIG, index))
+            self.assertEqual(s.score_igc_tracks_optimized(tracks, WPT_DICT, WPT_CONFIG),
+                             s.score_igc_tracks_vectorized(tracks, WPT_DICT, WPT_CONFIG, index))
+        self.assertEqual(cells, {key: list(cell) for key, cell in index.grid.cells.items()})
+
+    def test_score_pilots(self):
+        pilot_igcs = {'kma': ['resources/2020-11-11-XCT-KMA-01.igc', 'resources/2020-11-29-XCT-KMA-01.igc'],
+                      'xfh': ['resources/2021-02-05-XFH-000-01.IGC'],
+                      'missing': ['resources/missing.igc']}
+        for processes in [1, 2]:
+            for engine in s.ENGINES:
+                scores = {score.pilot: score for score in s.score_pilots(pilot_igcs, WPT_DICT, WPT_CONFIG, processes,
+                                                                         engine)}
+                self.assertEqual(set(pilot_igcs), set(scores))
+                for pilot in ['kma', 'xfh']:
+                    self.assertIsNone(scores[pilot].error)
+                    self.assertEqual(s.score_igcs_optimized(pilot_igcs[pilot], WPT_DICT, WPT_CONFIG),
+                                     scores[pilot].report)
+                    self.assertIsNone(scores[pilot].metrics)
+                self.assertIsNone(scores['missing'].report)
+                self.assertIn('FileNotFoundError', scores['missing'].error)
+
+    def test_score_pilots_engines(self):
+        pilot_igcs = {'kma': ['resources/2020-11-11-XCT-KMA-01.igc', 'resources/2020-11-29-XCT-KMA-01.igc']}
+        score, = s.score_pilots(pilot_igcs, WPT_DICT, WPT_CONFIG, 1, 'original')
+        self.assertEqual(s.score_igcs(pilot_igcs['kma'], WPT_DICT, WPT_CONFIG), score.report)
+        self.assertGreater(score.seconds, 0)
+        self.assertIsNone(score.metrics)
+        score, = s.score_pilots(pilot_igcs, WPT_DICT, WPT_CONFIG, 1, 'original', metrics=True)
+        self.assertEqual(2, score.metrics['counters']['files'])
+        self.assertIn('distance', score.metrics['timings'])
+        score, = s.score_pilots(pilot_igcs, WPT_DICT, WPT_CONFIG, 1, 'vectorized', metrics=True)
+        self.assertEqual(2, score.metrics['counters']['files'])
+        self.assertIn('distance', score.metrics['timings'])
+        with self.assertRaises(ValueError):
+            list(s.score_pilots(pilot_igcs, WPT_DICT, WPT_CONFIG, 1, 'unknown'))
+
     def test_get_score_report_1_pt(self):
         import time
         seconds = time.time()
@@ -125,6 +714,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.get_score_report_1_pt(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.get_score_report_1_pt(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_get_score_report_2_pts(self):
         import time
@@ -134,6 +726,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.get_score_report_2_pts(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.get_score_report_2_pts(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_get_score_report_1_pt_land(self):
         import time
@@ -143,6 +738,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.get_score_report_1_pt_land(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.get_score_report_1_pt_land(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_get_score_report_2_pt_land(self):
         import time
@@ -152,6 +750,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.get_score_report_2_pt_land(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.get_score_report_2_pt_land(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_get_score_report_2_pt_land_within_10m_margin(self):
         import time
@@ -161,6 +762,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.get_score_report_2_pt_land_within_10m_margin(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.get_score_report_2_pt_land_within_10m_margin(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_get_score_report_2_pt_fail_no_land(self):
         import time
@@ -170,6 +774,9 @@ class TestScorerMethods(unittest.TestCase):
         seconds = time.time()
         self.get_score_report_2_pt_fail_no_land(WaypointOptimizer)
         print(time.time() - seconds)
+        seconds = time.time()
+        self.get_score_report_2_pt_fail_no_land(WaypointVectorizer)
+        print(time.time() - seconds)
 
     def test_score_report_2_pts_finish(self):
         wpt_config = {'cylinder_km': 1, 'time_landed_min': 1,
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+from parascoring.scoring.IgcTrack import load_igc_track
+from parascoring.scoring.TrackCache import TrackCache, CACHE_SUFFIX, content_key, etag_key, \
+    load_cached_igc_track, track_from_bytes, track_to_bytes
+
+TRACK_COLUMNS = ['time', 'longitude', 'latitude', 'alt_pressure', 'alt_gps', 'valid']
+
+
+class TestTrackCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.track = load_igc_track('resources/GPX Converted - Day 1.igc')
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def assertTrackEqual(self, expected, actual):
+        for column in TRACK_COLUMNS:
+            self.assertEqual(getattr(expected, column).dtype, getattr(actual, column).dtype)
+            self.assertEqual(getattr(expected, column).tolist(), getattr(actual, column).tolist())
+
+    def test_round_trip(self):
+        self.assertTrackEqual(self.track, track_from_bytes(track_to_bytes(self.track)))
+
+    def test_get_put(self):
+        cache = TrackCache(self.cache_dir.name)
+        self.assertIsNone(cache.get('missing'))
+        cache.put('abc', self.track)
+        self.assertTrackEqual(self.track, cache.get('abc'))
+
+    def test_corrupt_entry(self):
+        cache = TrackCache(self.cache_dir.name)
+        cache.put_bytes('abc', b'not a track')
+        self.assertIsNone(cache.get('abc'))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir.name, 'abc' + CACHE_SUFFIX)))
+
+    def test_truncated_entry(self):
+        cache = TrackCache(self.cache_dir.name)
+        data = track_to_bytes(self.track)
+        for size in [10, len(data) // 2, len(data) - 1]:
+            cache.put_bytes('abc', data[:size])
+            self.assertIsNone(cache.get('abc'))
+            self.assertFalse(os.path.exists(os.path.join(self.cache_dir.name, 'abc' + CACHE_SUFFIX)))
+
+    def test_failed_write(self):
+        cache = TrackCache(self.cache_dir.name)
+        with self.assertRaises(TypeError):
+            cache.put_bytes('abc', 'not bytes')
+        self.assertEqual([], os.listdir(self.cache_dir.name))
+
+    def test_evict_least_recently_used(self):
+        entry_size = len(track_to_bytes(self.track))
+        cache = TrackCache(self.cache_dir.name, max_bytes=2 * entry_size)
+        cache.put('first', self.track)
+        cache.put('second', self.track)
+        os.utime(os.path.join(self.cache_dir.name, 'first' + CACHE_SUFFIX), ns=(0, 0))
+        cache.get('second')
+        cache.put('third', self.track)
+        self.assertIsNone(cache.get('first'))
+        self.assertIsNotNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('third'))
+
+    def test_load_cached_igc_track(self):
+        cache = TrackCache(self.cache_dir.name)
+        track = load_cached_igc_track('resources/GPX Converted - Day 1.igc', cache)
+        self.assertTrackEqual(self.track, track)
+        with open('resources/GPX Converted - Day 1.igc', 'rb') as f:
+            self.assertIsNotNone(cache.get(content_key(f.read())))
+
+    def test_etag_key(self):
+        self.assertEqual('9b2cf535f27731c974343645a3985328', etag_key('"9b2cf535f27731c974343645a3985328"'))
+        self.assertEqual('d41d8cd98f00b204e9800998ecf8427e-2', etag_key('"d41d8cd98f00b204e9800998ecf8427e-2"'))
+        self.assertEqual('a_b', etag_key('a/b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
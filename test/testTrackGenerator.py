@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+from parascoring.scoring import scorer as s
+from parascoring.scoring.IgcTrack import parse_igc_bytes
+from parascoring.scoring.Utils import WptType, parse_wpt_file
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from TrackGenerator import DEFAULT_WPT_CONFIG, generate_flight, generate_waypoints, generate_wpt_lines, \
+    write_competition
+
+
+class TestTrackGenerator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wpt_data = generate_waypoints(3000, 1)
+
+    def test_wpt_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'competition.wpt')
+            with open(path, 'w', newline='\r\n') as f:
+                f.write('\n'.join(generate_wpt_lines(3000, 1)) + '\n')
+            wpt_data = parse_wpt_file(path)
+        self.assertEqual(3002, len(wpt_data))
+        self.assertEqual(list(self.wpt_data), list(wpt_data))
+        self.assertIn('START', wpt_data)
+        self.assertIn('FINISH', wpt_data)
+        self.assertTrue(any(wpt.wpt_type is WptType.LAND for wpt in wpt_data.values()))
+        # WptDefinition keeps latitude in longitude
+        lats = [wpt.longitude for wpt in wpt_data.values()]
+        self.assertLess(max(abs(lat + 44.7) for lat in lats), 1)
+
+    def test_seeded(self):
+        first = generate_flight(self.wpt_data, DEFAULT_WPT_CONFIG, 3, fixes_per_day=2000)
+        second = generate_flight(self.wpt_data, DEFAULT_WPT_CONFIG, 3, fixes_per_day=2000)
+        other = generate_flight(self.wpt_data, DEFAULT_WPT_CONFIG, 4, fixes_per_day=2000)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first.igc_files, other.igc_files)
+        self.assertEqual(generate_wpt_lines(100, 2), generate_wpt_lines(100, 2))
+
+    def test_days_and_sample_rate(self):
+        flight = generate_flight(self.wpt_data, DEFAULT_WPT_CONFIG, 5, days=3, fixes_per_day=5000, sample_seconds=5)
+        self.assertEqual(3, len(flight.igc_files))
+        tracks = [parse_igc_bytes(igc) for igc in flight.igc_files]
+        for day, (igc, track) in enumerate(zip(flight.igc_files, tracks)):
+            self.assertTrue(igc.startswith(b'A'))
+            self.assertIn(b'HFDTE', igc)
+            self.assertEqual(5000, len(track))
+            # Gaps only where the logger was off after a landing
+            steps = numpy.diff(track.time)
+            self.assertEqual(0, numpy.count_nonzero(steps % 5))
+            self.assertGreater(numpy.count_nonzero(steps == 5), 0.95 * len(steps))
+            if day:
+                self.assertGreater(track.time[0], tracks[day - 1].time[-1])
+
+    def test_landings_match_engines(self):
+        for sample_seconds in [1, 5]:
+            flight = generate_flight(self.wpt_data, DEFAULT_WPT_CONFIG, 7, days=2, fixes_per_day=20000,
+                                     sample_seconds=sample_seconds)
+            self.assertEqual({'landed', 'short', 'drift', 'altitude'}, {landing.kind for landing in flight.landings})
+            tracks = [parse_igc_bytes(igc) for igc in flight.igc_files]
+            report = s.score_igc_tracks_optimized(tracks, self.wpt_data, DEFAULT_WPT_CONFIG)
+            self.assertEqual(report, s.score_igc_tracks_vectorized(tracks, self.wpt_data, DEFAULT_WPT_CONFIG))
+            tagged = {wpt['wpt'] for wpt in report['wpt_list']}
+            for landing in flight.landings:
+                self.assertEqual(landing.landed, landing.wpt in tagged, landing)
+
+    def test_write_competition(self):
+        with tempfile.TemporaryDirectory() as directory:
+            flights = write_competition(directory, pilots=2, days=2, waypoints=200, fixes_per_day=1000)
+            self.assertEqual(['pilot000', 'pilot001'], sorted(flights))
+            self.assertEqual(['day1.igc', 'day2.igc'], sorted(os.listdir(os.path.join(directory, 'pilot001'))))
+            wpt_data = parse_wpt_file(os.path.join(directory, 'competition.wpt'))
+            self.assertEqual(202, len(wpt_data))
+            igc_files = [os.path.join(directory, 'pilot000', name) for name in ['day2.igc', 'day1.igc']]
+            report = s.score_igcs_optimized(igc_files, wpt_data, DEFAULT_WPT_CONFIG)
+            tagged = {wpt['wpt'] for wpt in report['wpt_list']}
+            for landing in flights['pilot000'].landings:
+                self.assertEqual(landing.landed, landing.wpt in tagged)
+
+
+if __name__ == '__main__':
+    unittest.main()